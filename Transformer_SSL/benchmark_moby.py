@@ -0,0 +1,96 @@
+# --------------------------------------------------------
+# CPU step time benchmark of MoBY (Swin-T)
+# --------------------------------------------------------
+"""Times the momentum update of the key encoder (python loop over the parameter pairs
+vs. the foreach update in MoBY._momentum_update_key_encoder) and a full training step
+(forward, backward, AdamW step) of MoBY on random images.
+
+Usage (from Transformer_SSL/):
+    python benchmark_moby.py --cfg configs/moby_swin_tiny.yaml --batch-size 8 --device cpu
+"""
+
+import copy
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from config import _C, _update_config_from_file
+from models import build_model
+
+
+@torch.no_grad()
+def loop_momentum_update(model, momentum):
+    """the previous momentum update, one python iteration per parameter pair"""
+    for module_q, module_k in [(model.encoder, model.encoder_k), (model.projector, model.projector_k)]:
+        for param_q, param_k in zip(module_q.parameters(), module_k.parameters()):
+            param_k.data = param_k.data * momentum + param_q.data * (1.0 - momentum)
+
+
+def _timeit(fn, repeats, device):
+    fn()  # warm-up
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / repeats
+
+
+def main(args):
+    config = _C.clone()
+    _update_config_from_file(config, args.cfg)
+    config.defrost()
+    config.DATA.BATCH_SIZE = args.batch_size
+    config.DATA.TRAINING_IMAGES = 1000 * args.batch_size
+    config.freeze()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    model = build_model(config).to(device)
+    model.train()
+
+    # both updates must give the same target network
+    reference = copy.deepcopy(model)
+    momentum = 1.0 - (1.0 - model.contrast_momentum) * (np.cos(np.pi * model.k / model.K) + 1) / 2.0
+    loop_momentum_update(reference, momentum)
+    model._momentum_update_key_encoder()
+    max_diff = max(
+        (p - r).abs().max().item()
+        for p, r in zip(model.encoder_k.parameters(), reference.encoder_k.parameters())
+    )
+    print(f"max abs difference of the target parameters: {max_diff:.2e}")
+    del reference
+
+    loop_seconds = _timeit(lambda: loop_momentum_update(model, 0.99), args.repeats, device)
+    foreach_seconds = _timeit(model._momentum_update_key_encoder, args.repeats, device)
+    print(f"momentum update  loop: {loop_seconds * 1000:8.2f}ms  foreach: {foreach_seconds * 1000:8.2f}ms")
+
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    images = torch.randn(
+        2, args.batch_size, config.MODEL.SWIN.IN_CHANS, config.DATA.IMG_SIZE, config.DATA.IMG_SIZE, device=device
+    )
+
+    def train_step():
+        loss = model(images[0], images[1])
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    step_seconds = _timeit(train_step, args.repeats, device)
+    print(
+        f"training step ({config.MODEL.NAME}, batch {args.batch_size}, {device}): "
+        f"{step_seconds:.3f}s, {args.batch_size / step_seconds:.1f} img/s"
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('MoBY step time benchmark')
+    parser.add_argument('--cfg', type=str, default='configs/moby_swin_tiny.yaml', metavar="FILE")
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--device', type=str, default='cpu')
+    main(parser.parse_args())
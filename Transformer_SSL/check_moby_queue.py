@@ -0,0 +1,96 @@
+# --------------------------------------------------------
+# Multi-process check of the MoBY negative queue
+# --------------------------------------------------------
+"""Runs a tiny MoBY on several CPU processes (gloo) and checks that
+- all ranks hold the same queue after every step,
+- the queue receives the keys of all ranks in rank order,
+- batch sizes that do not divide the queue size wrap around the end of the queue,
+- the optional half precision queue behaves the same.
+
+Usage (from Transformer_SSL/):
+    python check_moby_queue.py --world-size 2 --batch-size 3 --num-negative 16
+"""
+
+import os
+import argparse
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+
+from config import _C
+from models.moby import MoBY
+from models.swin_transformer import SwinTransformer
+
+
+def build_tiny_moby(num_negative, queue_fp16):
+    config = _C.clone()
+    config.defrost()
+    config.DATA.TRAINING_IMAGES = 100
+    config.DATA.BATCH_SIZE = 10
+    config.freeze()
+
+    def encoder():
+        return SwinTransformer(
+            img_size=32, patch_size=4, in_chans=3, num_classes=0, embed_dim=24,
+            depths=[1, 1], num_heads=[1, 2], window_size=4,
+        )
+
+    return MoBY(config, encoder(), encoder(), contrast_num_negative=num_negative,
+                contrast_queue_fp16=queue_fp16)
+
+
+def _gather(x):
+    out = [torch.zeros_like(x) for _ in range(dist.get_world_size())]
+    dist.all_gather(out, x)
+    return out
+
+
+def run(rank, args):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(args.port)
+    dist.init_process_group("gloo", rank=rank, world_size=args.world_size)
+
+    for queue_fp16 in [False, True]:
+        # different seeds per rank, as in moby_main.py
+        torch.manual_seed(rank)
+        model = build_tiny_moby(args.num_negative, queue_fp16)
+
+        # a full forward/backward pass, the queue is updated in place after the loss
+        loss = model(torch.randn(args.batch_size, 3, 32, 32), torch.randn(args.batch_size, 3, 32, 32))
+        loss.backward()
+
+        for step in range(args.steps):
+            ptr = int(model.queue_ptr)
+            keys1 = F.normalize(torch.randn(args.batch_size, 256), dim=1)
+            keys2 = F.normalize(torch.randn(args.batch_size, 256), dim=1)
+            model._dequeue_and_enqueue(keys1, keys2)
+
+            all_keys1 = torch.cat(_gather(keys1))
+            idx = torch.arange(ptr, ptr + all_keys1.shape[0]) % args.num_negative
+            atol = 1e-3 if queue_fp16 else 0
+            assert torch.allclose(model.queue1[:, idx].float(), all_keys1.T, atol=atol), step
+
+            for q in _gather(model.queue1.float().contiguous()):
+                assert torch.equal(q, model.queue1.float()), f"queues diverged at step {step}"
+            for q in _gather(model.queue2.float().contiguous()):
+                assert torch.equal(q, model.queue2.float()), f"queues diverged at step {step}"
+
+        if rank == 0:
+            print(f"queue check passed (fp16={queue_fp16}, {args.world_size} ranks, "
+                  f"batch {args.batch_size}, {args.num_negative} negatives)")
+
+    dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('MoBY distributed queue check')
+    parser.add_argument('--world-size', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=3)
+    parser.add_argument('--num-negative', type=int, default=16)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--port', type=int, default=29531)
+    args = parser.parse_args()
+
+    mp.spawn(run, args=(args,), nprocs=args.world_size)
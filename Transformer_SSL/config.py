@@ -34,6 +34,8 @@ _C.DATA.INTERPOLATION = 'bicubic'
 _C.DATA.ZIP_MODE = False
 # Cache Data in Memory, could be overwritten by command line argument
 _C.DATA.CACHE_MODE = 'part'
+# Number of threads per rank that fill the shared memory cache
+_C.DATA.CACHE_NUM_THREADS = 16
 # Pin CPU memory in DataLoader for more efficient (sometimes) transfer to GPU.
 _C.DATA.PIN_MEMORY = True
 # Number of data loading threads
@@ -84,6 +86,8 @@ _C.MODEL.MOBY.CONTRAST_TEMPERATURE = 0.2
 _C.MODEL.MOBY.CONTRAST_NUM_NEGATIVE = 4096
 _C.MODEL.MOBY.PROJ_NUM_LAYERS = 2
 _C.MODEL.MOBY.PRED_NUM_LAYERS = 2
+# Store the negative queue in half precision
+_C.MODEL.MOBY.QUEUE_FP16 = False
 
 # -----------------------------------------------------------------------------
 # Training settings
@@ -106,6 +106,7 @@ def build_dataset(is_train, config):
                 prefix,
                 transform,
                 cache_mode=config.DATA.CACHE_MODE if is_train else "part",
+                cache_num_threads=config.DATA.CACHE_NUM_THREADS,
             )
         else:
             # ToDo: test custom_image_folder
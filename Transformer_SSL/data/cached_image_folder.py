@@ -8,12 +8,13 @@
 
 import io
 import os
-import time
-import torch.distributed as dist
+import hashlib
+import numpy as np
 import torch.utils.data as data
 from PIL import Image
 
 from .zipreader import is_zip_path, ZipReader
+from .shared_cache import SharedSampleCache, get_dist_info
 
 
 def has_file_allowed_extension(filename, extensions):
@@ -91,7 +92,7 @@ class DatasetFolder(data.Dataset):
     """
 
     def __init__(self, root, loader, extensions, ann_file='', img_prefix='', transform=None, target_transform=None,
-                 cache_mode="no"):
+                 cache_mode="no", cache_num_threads=16):
         # image folder mode
         if ann_file == '':
             _, class_to_idx = find_classes(root)
@@ -118,30 +119,37 @@ class DatasetFolder(data.Dataset):
         self.target_transform = target_transform
 
         self.cache_mode = cache_mode
+        self.cache_num_threads = cache_num_threads
+        self.cache = None
         if self.cache_mode != "no":
             self.init_cache()
 
     def init_cache(self):
+        """cache the sample bytes in a shared memory arena per node (see SharedSampleCache).
+        "full" caches every sample, "part" the samples of the ranks on this node
+        (index % world_size == rank, as used by the SubsetRandomSampler in build_loader)"""
         assert self.cache_mode in ["part", "full"]
+        rank, world_size, local_rank, local_world_size = get_dist_info()
         n_sample = len(self.samples)
-        global_rank = dist.get_rank()
-        world_size = dist.get_world_size()
-
-        samples_bytes = [None for _ in range(n_sample)]
-        start_time = time.time()
-        for index in range(n_sample):
-            if index % (n_sample // 10) == 0:
-                t = time.time() - start_time
-                print(f'global_rank {dist.get_rank()} cached {index}/{n_sample} takes {t:.2f}s per block')
-                start_time = time.time()
-            path, target = self.samples[index]
-            if self.cache_mode == "full":
-                samples_bytes[index] = (ZipReader.read(path), target)
-            elif self.cache_mode == "part" and index % world_size == global_rank:
-                samples_bytes[index] = (ZipReader.read(path), target)
-            else:
-                samples_bytes[index] = (path, target)
-        self.samples = samples_bytes
+
+        if self.cache_mode == "full":
+            cached = np.ones(n_sample, dtype=bool)
+        else:
+            node_start = rank - local_rank
+            owner = np.arange(n_sample) % world_size
+            cached = (owner >= node_start) & (owner < node_start + local_world_size)
+
+        paths = [path for path, _ in self.samples]
+        key = f'{os.path.abspath(self.root)}:{paths[0]}:{n_sample}:{self.cache_mode}'
+        name = 'cached_image_folder_' + hashlib.md5(key.encode()).hexdigest()[:16]
+        self.cache = SharedSampleCache(name, paths, cached, num_threads=self.cache_num_threads)
+
+    def _get_sample(self, index):
+        """cached bytes or path of a sample and its target"""
+        path, target = self.samples[index]
+        if self.cache is not None and self.cache.is_cached(index):
+            return self.cache.get(index), target
+        return path, target
 
     def __getitem__(self, index):
         """
@@ -150,7 +158,7 @@ class DatasetFolder(data.Dataset):
         Returns:
             tuple: (sample, target) where target is class_index of the target class.
         """
-        path, target = self.samples[index]
+        path, target = self._get_sample(index)
         sample = self.loader(path)
         if self.transform is not None:
             sample = self.transform(sample)
@@ -226,11 +234,11 @@ class CachedImageFolder(DatasetFolder):
     """
 
     def __init__(self, root, ann_file='', img_prefix='', transform=None, target_transform=None,
-                 loader=default_img_loader, cache_mode="no"):
+                 loader=default_img_loader, cache_mode="no", cache_num_threads=16):
         super(CachedImageFolder, self).__init__(root, loader, IMG_EXTENSIONS,
                                                 ann_file=ann_file, img_prefix=img_prefix,
                                                 transform=transform, target_transform=target_transform,
-                                                cache_mode=cache_mode)
+                                                cache_mode=cache_mode, cache_num_threads=cache_num_threads)
         self.imgs = self.samples
         if not isinstance(self.transform, (tuple, list)) and self.transform is not None:
             self.transform = [self.transform]
@@ -242,7 +250,7 @@ class CachedImageFolder(DatasetFolder):
         Returns:
             tuple: (image, target) where target is class_index of the target class.
         """
-        path, target = self.samples[index]
+        path, target = self._get_sample(index)
         image = self.loader(path)
         
         ret = []
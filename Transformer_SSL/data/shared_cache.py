@@ -0,0 +1,104 @@
+# --------------------------------------------------------
+# Node-wide shared memory cache for CachedImageFolder
+# --------------------------------------------------------
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch.distributed as dist
+
+from .zipreader import is_zip_path, ZipReader
+
+
+def get_dist_info():
+    """(global rank, world size, local rank, local world size), the ranks of a node are
+    assumed to be contiguous (torchrun / torch.distributed.launch). Without LOCAL_WORLD_SIZE
+    every rank is treated as its own node"""
+    if dist.is_available() and dist.is_initialized():
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+    else:
+        rank, world_size = 0, 1
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    return rank, world_size, rank % local_world_size, local_world_size
+
+
+def _barrier():
+    if dist.is_available() and dist.is_initialized():
+        dist.barrier()
+
+
+def get_sample_size(path):
+    if is_zip_path(path):
+        return ZipReader.file_size(path)
+    return os.path.getsize(path)
+
+
+def read_sample(path):
+    """zip members come from the mmap of ZipReader, which is safe to share between threads"""
+    if is_zip_path(path):
+        return ZipReader.read_view(path)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class SharedSampleCache(object):
+    """Bytes of the cached samples in one shared memory arena with an offset index.
+
+    The arena is a file in /dev/shm that is created by the first rank of a node, filled by
+    all ranks of the node with a thread pool each, mapped read-only and unlinked again once
+    every rank has mapped it. The pages are shared by all ranks and DataLoader workers of the
+    node (nothing is copied on fork, unlike a list of bytes objects) and released when the
+    last process exits.
+
+    Args:
+        name (string): unique name of the arena on the node
+        paths (list): sample paths (zip style or plain files)
+        cached (np.ndarray): bool mask of the samples this node caches
+    """
+
+    def __init__(self, name, paths, cached, num_threads=16, cache_dir='/dev/shm'):
+        rank, _, local_rank, local_world_size = get_dist_info()
+        if not os.path.isdir(cache_dir):
+            cache_dir = '/tmp'
+        arena_path = os.path.join(cache_dir, name + '_node' + str(rank // local_world_size))
+
+        cached_idx = np.flatnonzero(cached)
+        sizes = np.zeros(len(paths), dtype=np.int64)
+        sizes[cached_idx] = [get_sample_size(paths[i]) for i in cached_idx]
+        # sample i is cached in arena[offsets[i]:offsets[i + 1]], empty for uncached samples
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)])
+        total_size = max(int(self.offsets[-1]), 1)
+
+        if local_rank == 0:
+            np.memmap(arena_path, dtype=np.uint8, mode='w+', shape=(total_size,)).flush()
+        _barrier()
+
+        start_time = time.time()
+        arena = np.memmap(arena_path, dtype=np.uint8, mode='r+', shape=(total_size,))
+
+        def fill(index):
+            data = read_sample(paths[index])
+            assert len(data) == sizes[index], f'size of {paths[index]} changed while caching'
+            arena[self.offsets[index]:self.offsets[index + 1]] = np.frombuffer(data, dtype=np.uint8)
+
+        # the ranks of a node split the samples of the node between them
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            list(executor.map(fill, cached_idx[local_rank::local_world_size]))
+        arena.flush()
+        del arena
+        print(f'global_rank {rank} cached {len(cached_idx[local_rank::local_world_size])}/{len(paths)} samples '
+              f'({total_size / 2 ** 30:.2f}GB arena per node) in {time.time() - start_time:.2f}s')
+        _barrier()
+
+        self.arena = np.memmap(arena_path, dtype=np.uint8, mode='r', shape=(total_size,))
+        _barrier()
+        if local_rank == 0:
+            os.unlink(arena_path)
+
+    def is_cached(self, index):
+        return self.offsets[index + 1] > self.offsets[index]
+
+    def get(self, index):
+        return self.arena[self.offsets[index]:self.offsets[index + 1]].tobytes()
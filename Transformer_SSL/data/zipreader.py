@@ -6,35 +6,146 @@
 # --------------------------------------------------------
 
 import os
-import zipfile
 import io
+import mmap
+import zlib
+import struct
+import zipfile
 import numpy as np
 from PIL import Image
 from PIL import ImageFile
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
+# fixed part of a local file header, followed by the file name and the extra field
+_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+
 
 def is_zip_path(img_or_path):
     """judge if this is a zip path"""
     return '.zip@' in img_or_path
 
 
+class ZipIndex(object):
+    """Offset table of the members of a zip file (data offset, sizes, compression), parsed
+    from the central directory once and saved as a sidecar <zip>.index.npz next to the zip.
+    Members are read from an mmap of the zip: stored members as zero-copy memoryview slices,
+    deflated members are decompressed directly from the mapping. The mapping is reopened
+    in a forked process (e.g. DataLoader workers) instead of sharing file state."""
+
+    def __init__(self, zip_path):
+        self.zip_path = zip_path
+        self.sidecar_path = zip_path + '.index.npz'
+        self._mmap = None
+        self._pid = None
+
+        stat = os.stat(zip_path)
+        table = self._load_sidecar(stat)
+        if table is None:
+            table = self._parse(zip_path)
+            table['zip_stat'] = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+            # written under a temporary name, several ranks may build the table at once
+            tmp_path = self.sidecar_path + '.' + str(os.getpid())
+            try:
+                with open(tmp_path, 'wb') as f:
+                    np.savez(f, **table)
+                os.replace(tmp_path, self.sidecar_path)
+            except OSError:
+                pass  # read-only dataset location, the table is rebuilt next time
+
+        self.names = {name: i for i, name in enumerate(table['names'].tolist())}
+        self.data_offsets = table['data_offsets']
+        self.compress_sizes = table['compress_sizes']
+        self.file_sizes = table['file_sizes']
+        self.compress_types = table['compress_types']
+
+    def _load_sidecar(self, stat):
+        if not os.path.exists(self.sidecar_path):
+            return None
+        table = dict(np.load(self.sidecar_path))
+        # outdated if the zip was rewritten
+        if table['zip_stat'].tolist() != [stat.st_size, stat.st_mtime_ns]:
+            return None
+        return table
+
+    @staticmethod
+    def _parse(zip_path):
+        with zipfile.ZipFile(zip_path, 'r') as zfile, open(zip_path, 'rb') as f:
+            infos = [info for info in zfile.infolist() if not info.is_dir()]
+            data_offsets = np.zeros(len(infos), dtype=np.int64)
+            for i, info in enumerate(infos):
+                # the extra field of the local header can differ from the central directory
+                f.seek(info.header_offset)
+                header = _LOCAL_HEADER.unpack(f.read(_LOCAL_HEADER.size))
+                name_length, extra_length = header[-2:]
+                data_offsets[i] = info.header_offset + _LOCAL_HEADER.size + name_length + extra_length
+
+        return {
+            'names': np.array([info.filename for info in infos]),
+            'data_offsets': data_offsets,
+            'compress_sizes': np.array([info.compress_size for info in infos], dtype=np.int64),
+            'file_sizes': np.array([info.file_size for info in infos], dtype=np.int64),
+            'compress_types': np.array([info.compress_type for info in infos], dtype=np.int16),
+        }
+
+    def _get_mmap(self):
+        if self._mmap is None or self._pid != os.getpid():
+            with open(self.zip_path, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._pid = os.getpid()
+        return self._mmap
+
+    def file_size(self, name):
+        return int(self.file_sizes[self.names[name]])
+
+    def read(self, name):
+        """memoryview of a stored member, bytes of a compressed one"""
+        i = self.names[name]
+        start = int(self.data_offsets[i])
+        data = memoryview(self._get_mmap())[start:start + int(self.compress_sizes[i])]
+
+        compress_type = self.compress_types[i]
+        if compress_type == zipfile.ZIP_STORED:
+            return data
+        elif compress_type == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(data, -zlib.MAX_WBITS, int(self.file_sizes[i]))
+        # bzip2/lzma members are rare, they go through zipfile
+        return ZipReader.get_zipfile(self.zip_path).read(name)
+
+
 class ZipReader(object):
     """A class to read zipped files"""
     zip_bank = dict()
+    index_bank = dict()
+    bank_pid = None
 
     def __init__(self):
         super(ZipReader, self).__init__()
 
+    @staticmethod
+    def _check_fork():
+        # ZipFile handles share their file position with the parent after a fork
+        if ZipReader.bank_pid != os.getpid():
+            ZipReader.zip_bank = dict()
+            ZipReader.bank_pid = os.getpid()
+
     @staticmethod
     def get_zipfile(path):
+        ZipReader._check_fork()
         zip_bank = ZipReader.zip_bank
         if path not in zip_bank:
             zfile = zipfile.ZipFile(path, 'r')
             zip_bank[path] = zfile
         return zip_bank[path]
 
+    @staticmethod
+    def get_index(path):
+        """ZipIndex of a zip file, loaded lazily (ZipIndex itself is fork-safe)"""
+        index_bank = ZipReader.index_bank
+        if path not in index_bank:
+            index_bank[path] = ZipIndex(path)
+        return index_bank[path]
+
     @staticmethod
     def split_zip_style_path(path):
         pos_at = path.index('@')
@@ -82,18 +193,27 @@ class ZipReader(object):
 
         return file_lists
 
+    @staticmethod
+    def read_view(path):
+        """zero-copy memoryview of stored members (bytes for compressed ones), the view
+        is only valid as long as the process does not fork"""
+        zip_path, path_img = ZipReader.split_zip_style_path(path)
+        return ZipReader.get_index(zip_path).read(path_img)
+
     @staticmethod
     def read(path):
+        data = ZipReader.read_view(path)
+        return data if isinstance(data, bytes) else data.tobytes()
+
+    @staticmethod
+    def file_size(path):
         zip_path, path_img = ZipReader.split_zip_style_path(path)
-        zfile = ZipReader.get_zipfile(zip_path)
-        data = zfile.read(path_img)
-        return data
+        return ZipReader.get_index(zip_path).file_size(path_img)
 
     @staticmethod
     def imread(path):
-        zip_path, path_img = ZipReader.split_zip_style_path(path)
-        zfile = ZipReader.get_zipfile(zip_path)
-        data = zfile.read(path_img)
+        data = ZipReader.read_view(path)
+        path_img = ZipReader.split_zip_style_path(path)[1]
         try:
             im = Image.open(io.BytesIO(data))
         except:
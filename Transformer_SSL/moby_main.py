@@ -72,6 +72,12 @@ def parse_option():
     return args, config
 
 
+def get_device(config):
+    if torch.cuda.is_available():
+        return torch.device("cuda", config.LOCAL_RANK)
+    return torch.device("cpu")
+
+
 def main(config):
     dataset_train, _, data_loader_train, _, _ = build_loader(config)
     
@@ -81,13 +87,15 @@ def main(config):
 
     logger.info(f"Creating model:{config.MODEL.TYPE}/{config.MODEL.NAME}")
     model = build_model(config)
-    model.cuda()
+    model.to(get_device(config))
     logger.info(str(model))
 
     optimizer = build_optimizer(config, model)
     if config.AMP_OPT_LEVEL != "O0":
         model, optimizer = amp.initialize(model, optimizer, opt_level=config.AMP_OPT_LEVEL)
-    model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[config.LOCAL_RANK], broadcast_buffers=False)
+    # CPU nodes: DistributedDataParallel over gloo without device_ids
+    device_ids = [config.LOCAL_RANK] if torch.cuda.is_available() else None
+    model = torch.nn.parallel.DistributedDataParallel(model, device_ids=device_ids, broadcast_buffers=False)
     model_without_ddp = model.module
 
     n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
@@ -136,12 +144,14 @@ def train_one_epoch(config, model, data_loader, optimizer, epoch, lr_scheduler):
     loss_meter = AverageMeter()
     norm_meter = AverageMeter()
 
+    device = get_device(config)
+
     start = time.time()
     end = time.time()
     for idx, (samples_1, samples_2, targets) in enumerate(data_loader):
-        samples_1 = samples_1.cuda(non_blocking=True)
-        samples_2 = samples_2.cuda(non_blocking=True)
-        targets = targets.cuda(non_blocking=True)
+        samples_1 = samples_1.to(device, non_blocking=True)
+        samples_2 = samples_2.to(device, non_blocking=True)
+        targets = targets.to(device, non_blocking=True)
 
         loss = model(samples_1, samples_2)
 
@@ -162,7 +172,8 @@ def train_one_epoch(config, model, data_loader, optimizer, epoch, lr_scheduler):
         optimizer.step()
         lr_scheduler.step_update(epoch * num_steps + idx)
 
-        torch.cuda.synchronize()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
 
         loss_meter.update(loss.item(), targets.size(0))
         norm_meter.update(grad_norm)
@@ -171,7 +182,7 @@ def train_one_epoch(config, model, data_loader, optimizer, epoch, lr_scheduler):
 
         if idx % config.PRINT_FREQ == 0:
             lr = optimizer.param_groups[0]['lr']
-            memory_used = torch.cuda.max_memory_allocated() / (1024.0 * 1024.0)
+            memory_used = torch.cuda.max_memory_allocated() / (1024.0 * 1024.0) if device.type == "cuda" else 0
             etas = batch_time.avg * (num_steps - idx)
             logger.info(
                 f'Train: [{epoch}/{config.TRAIN.EPOCHS}][{idx}/{num_steps}]\t'
@@ -197,8 +208,10 @@ if __name__ == '__main__':
     else:
         rank = -1
         world_size = -1
-    torch.cuda.set_device(config.LOCAL_RANK)
-    torch.distributed.init_process_group(backend='nccl', init_method='env://', world_size=world_size, rank=rank)
+    if torch.cuda.is_available():
+        torch.cuda.set_device(config.LOCAL_RANK)
+    backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    torch.distributed.init_process_group(backend=backend, init_method='env://', world_size=world_size, rank=rank)
     torch.distributed.barrier()
 
     seed = config.SEED + dist.get_rank()
@@ -69,6 +69,7 @@ def build_model(config):
             contrast_num_negative=config.MODEL.MOBY.CONTRAST_NUM_NEGATIVE,
             proj_num_layers=config.MODEL.MOBY.PROJ_NUM_LAYERS,
             pred_num_layers=config.MODEL.MOBY.PRED_NUM_LAYERS,
+            contrast_queue_fp16=config.MODEL.MOBY.get("QUEUE_FP16", False),
         )
     elif model_type == "linear":
         model = enc(
@@ -10,8 +10,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-
-# import torch.distributed as dist
+import torch.distributed as dist
 
 from diffdist import functional
 
@@ -43,6 +42,7 @@ class MoBY(nn.Module):
         contrast_num_negative=4096,
         proj_num_layers=2,
         pred_num_layers=2,
+        contrast_queue_fp16=False,
         **kwargs
     ):
         super().__init__()
@@ -100,14 +100,30 @@ class MoBY(nn.Module):
             * self.cfg.TRAIN.START_EPOCH
         )
 
-        # create the queue
-        self.register_buffer("queue1", torch.randn(256, self.contrast_num_negative))
-        self.register_buffer("queue2", torch.randn(256, self.contrast_num_negative))
-        self.queue1 = F.normalize(self.queue1, dim=0)
-        self.queue2 = F.normalize(self.queue2, dim=0)
+        # create the queue, optionally stored in half precision (the keys are unit length)
+        queue_dtype = torch.float16 if contrast_queue_fp16 else torch.float32
+        self.register_buffer(
+            "queue1",
+            F.normalize(torch.randn(256, self.contrast_num_negative), dim=0).to(queue_dtype),
+        )
+        self.register_buffer(
+            "queue2",
+            F.normalize(torch.randn(256, self.contrast_num_negative), dim=0).to(queue_dtype),
+        )
+        # the random initial queues differ per rank, they are synced on the first enqueue
+        self._queue_synced = False
 
         self.register_buffer("queue_ptr", torch.zeros(1, dtype=torch.long))
 
+        # online/target parameter pairs of the momentum update, flattened once.
+        # Module.to()/cuda() keep the parameter objects, so the lists stay valid
+        self._params_q = list(self.encoder.parameters()) + list(
+            self.projector.parameters()
+        )
+        self._params_k = list(self.encoder_k.parameters()) + list(
+            self.projector_k.parameters()
+        )
+
     @torch.no_grad()
     def _momentum_update_key_encoder(self):
         """
@@ -121,34 +137,36 @@ class MoBY(nn.Module):
         )
         self.k = self.k + 1
 
-        for param_q, param_k in zip(
-            self.encoder.parameters(), self.encoder_k.parameters()
-        ):
-            param_k.data = param_k.data * _contrast_momentum + param_q.data * (
-                1.0 - _contrast_momentum
-            )
-
-        for param_q, param_k in zip(
-            self.projector.parameters(), self.projector_k.parameters()
-        ):
-            param_k.data = param_k.data * _contrast_momentum + param_q.data * (
-                1.0 - _contrast_momentum
-            )
+        # param_k = param_k * m + param_q * (1 - m), in place and in a few fused kernels
+        torch._foreach_mul_(self._params_k, _contrast_momentum)
+        torch._foreach_add_(
+            self._params_k, self._params_q, alpha=1.0 - _contrast_momentum
+        )
 
     @torch.no_grad()
     def _dequeue_and_enqueue(self, keys1, keys2):
-        # gather keys before updating queue
-        #        keys1 = dist_collect(keys1)
-        #        keys2 = dist_collect(keys2)
-
+        distributed = dist.is_available() and dist.is_initialized()
+        if distributed:
+            if not self._queue_synced:
+                dist.broadcast(self.queue1, 0)
+                dist.broadcast(self.queue2, 0)
+                dist.broadcast(self.queue_ptr, 0)
+                self._queue_synced = True
+
+            # gather keys before updating queue, every rank then holds the same queue
+            keys1 = dist_collect(keys1)
+            keys2 = dist_collect(keys2)
+
+        # only the newest keys are kept if the (global) batch is larger than the queue
+        keys1 = keys1[-self.contrast_num_negative :]
+        keys2 = keys2[-self.contrast_num_negative :]
         batch_size = keys1.shape[0]
 
+        # replace the keys at ptr (dequeue and enqueue), wrapping around the end of the queue
         ptr = int(self.queue_ptr)
-        assert self.contrast_num_negative % batch_size == 0  # for simplicity
-
-        # replace the keys at ptr (dequeue and enqueue)
-        self.queue1[:, ptr : ptr + batch_size] = keys1.T
-        self.queue2[:, ptr : ptr + batch_size] = keys2.T
+        idx = torch.arange(ptr, ptr + batch_size, device=keys1.device) % self.contrast_num_negative
+        self.queue1[:, idx] = keys1.T.to(self.queue1.dtype)
+        self.queue2[:, idx] = keys2.T.to(self.queue2.dtype)
         ptr = (ptr + batch_size) % self.contrast_num_negative  # move pointer
 
         self.queue_ptr[0] = ptr
@@ -158,7 +176,10 @@ class MoBY(nn.Module):
         # positive logits: Nx1
         l_pos = torch.einsum("nc,nc->n", [q, k]).unsqueeze(-1)
         # negative logits: NxK
-        l_neg = torch.einsum("nc,ck->nk", [q, queue.clone().detach()])
+        # a copy of the queue, it is updated in place before the backward pass
+        queue = queue.detach()
+        queue = queue.clone() if queue.dtype == q.dtype else queue.to(q.dtype)
+        l_neg = torch.einsum("nc,ck->nk", [q, queue])
 
         # logits: Nx(1+K)
         logits = torch.cat([l_pos, l_neg], dim=1)
@@ -167,7 +188,7 @@ class MoBY(nn.Module):
         logits /= self.contrast_temperature
 
         # labels: positive key indicators
-        labels = torch.zeros(logits.shape[0], dtype=torch.long).cuda()
+        labels = torch.zeros(logits.shape[0], dtype=torch.long, device=logits.device)
 
         return F.cross_entropy(logits, labels)
 
@@ -1102,6 +1102,80 @@ class DoubleSwinTransformerSegmentation(nn.Module):
 
         return output
     
+class DoubleSwinTransformerMultiHead(nn.Module):
+    """One forward_features pass per backbone for several targets: a linear head per entry
+    of fc_out_dims on the pooled features (as DoubleSwinTransformerDownstream) and, with
+    seg_out_dim, the decoders of DoubleSwinTransformerSegmentation on the feature maps.
+    Returns {name: output}, the segmentation output under seg_name.
+
+    freeze_fc_backbone / freeze_seg_backbone: whether the backbones are frozen for the
+    linear heads / the decoders. The backbones are trained if they are not frozen for one
+    of them, the gradients of the heads they are frozen for are stopped at the features"""
+
+    def __init__(
+        self,
+        encoder1,
+        encoder2,
+        fc_out_dims,
+        device,
+        seg_out_dim=None,
+        seg_name="dfc",
+        freeze_fc_backbone=True,
+        freeze_seg_backbone=False,
+    ):
+        super(DoubleSwinTransformerMultiHead, self).__init__()
+
+        self.device = device
+        self.seg_name = seg_name
+        self.freeze_fc_backbone = freeze_fc_backbone
+        self.freeze_seg_backbone = freeze_seg_backbone
+
+        self.backbone1 = encoder1
+        self.backbone2 = encoder2
+
+        self.fcs = nn.ModuleDict(
+            {
+                name: nn.Linear(
+                    self.backbone2.num_features + self.backbone1.num_features,
+                    out_dim,
+                    bias=True,
+                )
+                for name, out_dim in fc_out_dims.items()
+            }
+        )
+        if seg_out_dim is not None:
+            self.decoder1 = SwinTransformerDecoder(self.backbone1, seg_out_dim, device)
+            self.decoder2 = SwinTransformerDecoder(self.backbone2, seg_out_dim, device)
+        else:
+            self.decoder1 = self.decoder2 = None
+
+        # freeze all backbone layers, unless a head trains them
+        freeze_layers = freeze_fc_backbone and (self.decoder1 is None or freeze_seg_backbone)
+        for name, param in self.named_parameters():
+            if name.startswith(("backbone")):
+                param.requires_grad = not freeze_layers
+
+    def forward(self, x):
+        x1_pool, x1, x_seg1 = self.backbone1.forward_features(x["s1"].to(self.device))
+        x2_pool, x2, x_seg2 = self.backbone2.forward_features(x["s2"].to(self.device))
+
+        z = torch.cat([x1_pool, x2_pool], dim=1)
+        if self.freeze_fc_backbone:
+            z = z.detach()
+        output = {name: fc(z) for name, fc in self.fcs.items()}
+
+        if self.decoder1 is not None:
+            if self.freeze_seg_backbone:
+                x1, x2 = x1.detach(), x2.detach()
+                x_seg1 = [t.detach() for t in x_seg1]
+                x_seg2 = [t.detach() for t in x_seg2]
+            x1 = self.decoder1.forward_up_features(x1, x_seg1)
+            x2 = self.decoder2.forward_up_features(x2, x_seg2)
+            output[self.seg_name] = self.decoder1.up_x4(torch.cat([x1, x2], dim=-1))
+
+        return output
+
+
 class DoubleSwinTransformerSegmentationS2(nn.Module):
     def __init__(self, encoder2, out_dim, device, freeze_layers=False): #removed encoder1
         super(DoubleSwinTransformerSegmentationS2, self).__init__()
@@ -1,28 +1,116 @@
+import time
+
+# reference point of the startup report
+STARTUP_START = time.perf_counter()
+
 import sys
 import os
+import json
+import argparse
+import importlib
 import numpy as np
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                              QHBoxLayout, QPushButton, QSizePolicy, QFileDialog,
                              QFrame,QProgressBar, QListWidget, QLabel, QSpacerItem)
 from PyQt5.QtGui import QPalette, QColor, QPainter, QBrush, QPixmap
-from PyQt5.QtCore import Qt, QPropertyAnimation, QEasingCurve, pyqtSlot, QObject
+from PyQt5.QtCore import (Qt, QPropertyAnimation, QEasingCurve, pyqtSlot, QObject,
+                          QThread, pyqtSignal, QTimer)
 from PyQt5.QtWebEngineWidgets import QWebEngineView
 from PyQt5.QtWebChannel import QWebChannel
-from visualisation_ourdata import SegmentationThread 
 from pie_chart_gui import PieChartDemo
-from searcher import get_patches_within_bbox
+
+# the segmentation stack (torch, rasterio, swin, ...), imported by ModelStackLoader after the
+# window is shown, in this order so the report shows where the time goes
+MODEL_STACK_MODULES = [
+    "torch",
+    "torchvision",
+    "rasterio",
+    "Transformer_SSL.models.swin_transformer",
+    "dfc_dataset_sandbox",
+    "visualisation_ourdata",
+]
+
+
+class ModelStackLoader(QThread):
+    loadedSignal = pyqtSignal(object, object)  # SegmentationThread class, {module: seconds}
+    errorSignal = pyqtSignal(str)
+
+    def run(self):
+        import_seconds = {}
+        try:
+            for name in MODEL_STACK_MODULES:
+                start = time.perf_counter()
+                module = importlib.import_module(name)
+                import_seconds[name] = time.perf_counter() - start
+        except Exception as e:
+            self.errorSignal.emit(f"{type(e).__name__}: {e}")
+            return
+        self.loadedSignal.emit(module.SegmentationThread, import_seconds)
+
+
+class StartupReport(object):
+    """seconds from the start of UI_draft.py to the shown window (window) and to the loaded
+    segmentation stack (ready), printed and optionally written to a json file"""
+
+    def __init__(self, start=STARTUP_START, path=None):
+        self.start = start
+        self.path = path
+        self.seconds = {}
+        self.import_seconds = {}
+
+    def mark(self, name):
+        self.seconds[name] = time.perf_counter() - self.start
+        print(f"startup: {name} after {self.seconds[name]:.2f}s")
+        if "window" in self.seconds and "ready" in self.seconds:
+            self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        with open(self.path, "w") as f:
+            json.dump(
+                {
+                    "time_to_window_seconds": self.seconds.get("window"),
+                    "time_to_ready_seconds": self.seconds.get("ready"),
+                    "import_seconds": self.import_seconds,
+                },
+                f,
+                indent=2,
+            )
 
 
 class DesktopUI(QMainWindow):
-    def __init__(self):
+    def __init__(self, profile=False, startup_report=None):
         print("list object created")  
         super().__init__()
+        self.profile = profile
+        self.startup_report = startup_report or StartupReport()
+        self.segmentation_thread_class = None
         self.patch_folder = 'input'
         self.selected_patch_names = []
         self.selected_model_path = []
         self.matching_files = []
         self.init_ui()
 
+    def on_window_shown(self):
+        """called from the event loop once the window is up, loads the segmentation stack"""
+        self.startup_report.mark("window")
+        self.model_stack_loader = ModelStackLoader()
+        self.model_stack_loader.loadedSignal.connect(self.on_model_stack_loaded)
+        self.model_stack_loader.errorSignal.connect(self.on_model_stack_error)
+        self.model_stack_loader.start()
+
+    def on_model_stack_loaded(self, segmentation_thread_class, import_seconds):
+        self.segmentation_thread_class = segmentation_thread_class
+        self.startup_report.import_seconds = import_seconds
+        self.startup_report.mark("ready")
+        self.segment_btn.setText('Start Segmentation')
+        self.segment_btn.setEnabled(True)
+
+    def on_model_stack_error(self, error_message):
+        print(f"Error loading the segmentation model stack: {error_message}")
+        self.segment_btn.setText('Model stack failed to load')
+
     def init_ui(self):
         super(DesktopUI, self).__init__()
         
@@ -119,10 +207,12 @@ class DesktopUI(QMainWindow):
         btn_style = "font-size: 10px; width: 7px; height: 10px;"
 
         
-        segment_btn = QPushButton('Start Segmentation', self)
-        segment_btn.clicked.connect(self.segment_patches)
-        segment_btn.setFixedSize(150, 35)
-        control_layout.addWidget(segment_btn, alignment=Qt.AlignLeft)
+        # enabled once ModelStackLoader has imported the segmentation stack
+        self.segment_btn = QPushButton('Loading models...', self)
+        self.segment_btn.setEnabled(False)
+        self.segment_btn.clicked.connect(self.segment_patches)
+        self.segment_btn.setFixedSize(150, 35)
+        control_layout.addWidget(self.segment_btn, alignment=Qt.AlignLeft)
 
         stop_btn = QPushButton("■")
         stop_btn.setStyleSheet(btn_style)
@@ -221,7 +311,7 @@ class DesktopUI(QMainWindow):
 
         self.selected_patch_names = [item.text() for item in selected_items]
         # self.segmentation_thread = SegmentationThread(self.selected_patch_names)
-        self.segmentation_thread = SegmentationThread(self.selected_model_path, self.selected_patch_names)
+        self.segmentation_thread = self.segmentation_thread_class(self.selected_model_path, self.selected_patch_names, profile=self.profile)
         self.segmentation_thread.updatePieChartSignal.connect(self.update_pie_chart)
         self.segmentation_thread.progressSignal.connect(self.update_progress)
         self.segmentation_thread.finishedSignal.connect(self.on_segmentation_finished)
@@ -434,6 +524,8 @@ class MapHandler(QObject):
         ne_corner = (coords['northEast']['lng'], coords['northEast']['lat'])
         sw_corner = (coords['southWest']['lng'], coords['southWest']['lat'])
         print(f"Selected area NorthEast: {coords['northEast']}, SouthWest: {coords['southWest']}")
+        # imports rasterio, not needed before the first map selection
+        from searcher import get_patches_within_bbox
         matching_files = get_patches_within_bbox(ne_corner, sw_corner)
         
         # Clear the current items in the list widget
@@ -458,7 +550,16 @@ class RoundedSquare(QFrame):
         painter.drawRoundedRect(0, 0, self.width(), self.height(), 10, 10)
 
 if __name__ == "__main__":
-    app = QApplication(sys.argv)
-    window = DesktopUI()
+    parser = argparse.ArgumentParser(description="LULC segmentation desktop UI")
+    # per-stage timing of the segmentation, written to output/segmentation_profile.json
+    parser.add_argument("--profile", action="store_true")
+    # time-to-window and time-to-ready are always printed, this also writes them to json
+    parser.add_argument("--startup_report", default=None, type=str)
+    args, qt_args = parser.parse_known_args()
+
+    app = QApplication(sys.argv[:1] + qt_args)
+    window = DesktopUI(profile=args.profile, startup_report=StartupReport(path=args.startup_report))
     window.show()
+    # runs once the event loop has processed the show and first paint events
+    QTimer.singleShot(0, window.on_window_shown)
     sys.exit(app.exec_())
@@ -0,0 +1,249 @@
+"""Class-balanced sampling for DFCDataset without duplicated observation rows.
+
+The majority class and the multilabel classes (>= 10% of the patch) of every observation
+are computed once from the LC/DFC label maps and cached in a sidecar label index next
+to the observations csv. ClassBalancedSampler then draws observations with per-sample
+weights derived from the class frequencies, for a configurable number of samples per
+epoch and sharded over DDP ranks.
+
+Usage:
+    python balanced_sampler.py /netscratch/lscheibenreif/grss-dfc-20 --mode validation --num_workers 16
+"""
+
+import os
+import math
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.distributed as dist
+from tqdm import tqdm
+
+from dfc_dataset import clean_labels, get_label_classes
+from dfc_sen12ms_dataset import DFCSEN12MSDataset, Seasons, LCBands
+
+WEIGHTINGS = ["inverse", "sqrt", "capped"]
+
+
+def get_label_index_path(base_dir, mode):
+    """location of the sidecar label index for the observations csv of a split"""
+    return os.path.join(base_dir, mode + "_label_index.npz")
+
+
+def _label_chunk(args):
+    base_dir, include_dfc, num_classes, rows = args
+    data = DFCSEN12MSDataset(base_dir)
+
+    labels = np.full((len(rows), 2), 255, dtype=np.uint8)
+    multilabels = np.zeros((len(rows), 2, num_classes), dtype=bool)
+    for i, (season, scene, patch_id) in enumerate(rows):
+        season = Seasons[season[len("Seasons.") :]]
+        label_bands = [LCBands.LC, LCBands.DFC] if include_dfc else [LCBands.LC]
+        for j, bands in enumerate(label_bands):
+            x, _ = data.get_patch(season, scene, int(patch_id), bands)
+            label, multilabel = get_label_classes(clean_labels(x.astype(np.int64)))
+            labels[i, j] = label
+            multilabels[i, j, multilabel] = True
+
+    return labels, multilabels
+
+
+def build_label_index(
+    base_dir, mode, num_classes=8, num_workers=8, chunk_size=64, out_path=None
+):
+    """compute the lc/dfc majority and multilabel classes of all observations of `mode`
+    in parallel and write them to the sidecar label index"""
+    observations = pd.read_csv(
+        os.path.join(base_dir, mode + "_observations.csv"),
+        header=None,
+        names=["Season", "Scene", "ID"],
+    )
+    # high-resolution LC (dfc) labels are not available for the sen12ms split
+    include_dfc = mode != "sen12ms"
+
+    rows = observations.values.tolist()
+    chunks = [
+        (base_dir, include_dfc, num_classes, rows[i : i + chunk_size])
+        for i in range(0, len(rows), chunk_size)
+    ]
+
+    labels, multilabels = [], []
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        for chunk_labels, chunk_multilabels in tqdm(
+            executor.map(_label_chunk, chunks), total=len(chunks), desc="Indexing labels"
+        ):
+            labels.append(chunk_labels)
+            multilabels.append(chunk_multilabels)
+    labels = np.concatenate(labels)
+    multilabels = np.concatenate(multilabels)
+
+    if out_path is None:
+        out_path = get_label_index_path(base_dir, mode)
+    np.savez(
+        out_path,
+        season=observations.Season.values.astype(str),
+        scene=observations.Scene.values,
+        id=observations.ID.values,
+        lc_label=labels[:, 0],
+        dfc_label=labels[:, 1],
+        lc_multilabel=multilabels[:, 0],
+        dfc_multilabel=multilabels[:, 1],
+    )
+    print(f"labels of {len(observations)} observations written to {out_path}")
+
+
+def load_observation_labels(dataset, label="dfc", label_index_path=None):
+    """majority class (N,) and multilabel classes (N, num_classes) of every observation of
+    a DFCDataset, read from the label index. Image parts (cover_all_parts) share the labels
+    of their observation"""
+    if label_index_path is None:
+        label_index_path = get_label_index_path(dataset.data.base_dir, dataset.mode)
+    if not os.path.exists(label_index_path):
+        raise FileNotFoundError(
+            f"No label index at {label_index_path}, run balanced_sampler.py first"
+        )
+    if label == "dfc" and dataset.mode == "sen12ms":
+        raise ValueError("dfc labels are not available for the sen12ms split, use label='lc'")
+
+    index = np.load(label_index_path)
+    keys = pd.MultiIndex.from_arrays([index["season"], index["scene"], index["id"]])
+    positions = keys.get_indexer(
+        pd.MultiIndex.from_frame(dataset.observations[["Season", "Scene", "ID"]])
+    )
+    if (positions < 0).any():
+        raise ValueError(
+            f"{(positions < 0).sum()} observations are missing from {label_index_path}, rebuild it"
+        )
+
+    return index[label + "_label"][positions], index[label + "_multilabel"][positions]
+
+
+def compute_sample_weights(
+    labels, multilabels=None, weighting="inverse", max_weight_ratio=10.0, num_classes=8
+):
+    """per-sample weights from the class frequencies.
+
+    inverse: 1 / n_c, sqrt: 1 / sqrt(n_c), capped: 1 / n_c, but at most max_weight_ratio
+    times the weight of the most frequent class.
+    With multilabels, classes are counted over all their occurrences and a sample gets the
+    weight of its rarest class. Samples without a valid class get the smallest class weight."""
+    if weighting not in WEIGHTINGS:
+        raise ValueError(f"Unsupported weighting {weighting}, must be in {WEIGHTINGS}")
+
+    if multilabels is not None:
+        present = np.asarray(multilabels, dtype=bool)
+    else:
+        labels = np.asarray(labels)
+        present = np.zeros((len(labels), num_classes), dtype=bool)
+        valid = labels < num_classes
+        present[np.flatnonzero(valid), labels[valid]] = True
+
+    counts = present.sum(axis=0).astype(np.float64)
+    class_weights = np.zeros(num_classes)
+    occurring = counts > 0
+    if weighting == "sqrt":
+        class_weights[occurring] = 1.0 / np.sqrt(counts[occurring])
+    else:
+        class_weights[occurring] = 1.0 / counts[occurring]
+        if weighting == "capped":
+            class_weights = np.minimum(
+                class_weights, max_weight_ratio * class_weights[occurring].min()
+            )
+
+    weights = (present * class_weights).max(axis=1)
+    weights[~present.any(axis=1)] = class_weights[occurring].min()
+    return torch.as_tensor(weights, dtype=torch.double)
+
+
+class ClassBalancedSampler(torch.utils.data.Sampler):
+    """Draws num_samples observations per epoch (default: dataset size) with probability
+    proportional to weights. Every rank draws the same global sequence (seeded by seed + epoch)
+    and takes its own shard, like DistributedSampler. Call set_epoch every epoch."""
+
+    def __init__(
+        self,
+        weights,
+        num_samples=None,
+        replacement=True,
+        num_replicas=None,
+        rank=None,
+        seed=0,
+    ):
+        distributed = dist.is_available() and dist.is_initialized()
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if distributed else 1
+        if rank is None:
+            rank = dist.get_rank() if distributed else 0
+
+        self.weights = torch.as_tensor(weights, dtype=torch.double)
+        self.replacement = replacement
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+        if num_samples is None:
+            num_samples = len(self.weights)
+        if not replacement and num_samples > len(self.weights):
+            raise ValueError("num_samples exceeds the dataset size, sample with replacement")
+        self.num_samples = math.ceil(num_samples / self.num_replicas)  # per rank
+        self.total_size = self.num_samples * self.num_replicas
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        indices = torch.multinomial(
+            self.weights, self.total_size, self.replacement, generator=g
+        )
+        return iter(indices[self.rank : self.total_size : self.num_replicas].tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+
+def build_balanced_sampler(
+    dataset,
+    weighting="inverse",
+    label="dfc",
+    use_multilabels=False,
+    max_weight_ratio=10.0,
+    num_samples=None,
+    seed=0,
+):
+    """ClassBalancedSampler for a DFCDataset from its label index"""
+    labels, multilabels = load_observation_labels(dataset, label=label)
+    weights = compute_sample_weights(
+        labels,
+        multilabels if use_multilabels else None,
+        weighting=weighting,
+        max_weight_ratio=max_weight_ratio,
+    )
+    return ClassBalancedSampler(weights, num_samples=num_samples, seed=seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="build the label index of a split")
+    parser.add_argument("base_dir", type=str)
+    parser.add_argument(
+        "--mode",
+        default="dfc",
+        choices=["dfc", "sen12ms", "test", "validation"],
+        type=str,
+    )
+    parser.add_argument("--num_workers", default=8, type=int)
+    parser.add_argument("--chunk_size", default=64, type=int)
+    parser.add_argument("--out_path", default=None, type=str)
+    args = parser.parse_args()
+
+    build_label_index(
+        args.base_dir,
+        args.mode,
+        num_workers=args.num_workers,
+        chunk_size=args.chunk_size,
+        out_path=args.out_path,
+    )
@@ -0,0 +1,315 @@
+"""Batched geometric augmentation of collated DFCDataset samples on the training device.
+
+The Albumentations pipeline of DFCDataset (transforms=...) runs per sample in the loader
+workers and draws its random geometry separately for S1 and S2 (the label maps are not
+transformed at all). BatchAugmentation draws one Affine (rotation + translation) and one
+RandomResizedCrop per sample, composes them into a single 2x3 sampling matrix and warps
+S1, S2 and the label maps of the whole batch with affine_grid / grid_sample, so all
+modalities of a sample share the same geometry.
+
+Usage:
+    augmentation = BatchAugmentation(device=device)
+    for sample in train_loader:
+        sample = augmentation(sample)
+"""
+
+import math
+
+import torch
+import torch.nn.functional as F
+
+IMAGE_KEYS = ["s1", "s2"]
+LABEL_KEYS = ["lc", "dfc"]
+IGNORE_INDEX = 255
+
+
+def _to_matrix(linear, translation=None):
+    """(B, 3, 3) homogeneous matrices from (B, 2, 2) linear parts and (B, 2) translations"""
+    matrix = torch.zeros(linear.shape[0], 3, 3, dtype=linear.dtype, device=linear.device)
+    matrix[:, :2, :2] = linear
+    if translation is not None:
+        matrix[:, :2, 2] = translation
+    matrix[:, 2, 2] = 1
+    return matrix
+
+
+def _diag(x, y, batch_size, device):
+    linear = torch.zeros(batch_size, 2, 2, device=device)
+    linear[:, 0, 0] = x
+    linear[:, 1, 1] = y
+    return _to_matrix(linear)
+
+
+def sample_resized_crops(batch_size, height, width, scale, ratio, generator, device, attempts=10):
+    """crop sizes (B, 2) and top left corners (B, 2) as in RandomResizedCrop, in pixels (x, y).
+    Every sample takes its first valid attempt, the whole image if none is valid"""
+    area = height * width
+    target_area = area * torch.empty(batch_size, attempts, device=device).uniform_(
+        *scale, generator=generator
+    )
+    log_ratio = torch.empty(batch_size, attempts, device=device).uniform_(
+        math.log(ratio[0]), math.log(ratio[1]), generator=generator
+    )
+    aspect = torch.exp(log_ratio)
+    crop_w = torch.sqrt(target_area * aspect).round()
+    crop_h = torch.sqrt(target_area / aspect).round()
+
+    valid = (crop_w > 0) & (crop_w <= width) & (crop_h > 0) & (crop_h <= height)
+    first = valid.float().argmax(dim=1, keepdim=True)
+    crop_w = crop_w.gather(1, first).squeeze(1)
+    crop_h = crop_h.gather(1, first).squeeze(1)
+    fallback = ~valid.any(dim=1)
+    crop_w[fallback] = width
+    crop_h[fallback] = height
+
+    u = torch.rand(batch_size, 2, device=device, generator=generator)
+    x0 = torch.floor(u[:, 0] * (width - crop_w + 1))
+    y0 = torch.floor(u[:, 1] * (height - crop_h + 1))
+    return torch.stack([crop_w, crop_h], dim=1), torch.stack([x0, y0], dim=1)
+
+
+def _crop_matrix(crop_size, crop_corner, height, width, out_height, out_width):
+    """maps centred output pixel coordinates into the crop, in centred input pixel coordinates"""
+    device = crop_size.device
+    crop_center = crop_corner + crop_size / 2 - torch.tensor([width, height], device=device) / 2
+    return _to_matrix(
+        torch.diag_embed(crop_size / torch.tensor([out_width, out_height], device=device)),
+        crop_center,
+    )
+
+
+def _gaussian_blur(x, kernels):
+    """separable blur of (N, C, H, W) with one (K,) kernel per sample, reflect-101 borders"""
+    n, c, h, w = x.shape
+    pad = kernels.shape[1] // 2
+    weight = kernels.repeat_interleave(c, dim=0)
+
+    x = F.pad(x, (pad, pad, 0, 0), mode="reflect").reshape(1, n * c, h, w + 2 * pad)
+    x = F.conv2d(x, weight.view(n * c, 1, 1, -1), groups=n * c).view(n, c, h, w)
+    x = F.pad(x, (0, 0, pad, pad), mode="reflect").reshape(1, n * c, h + 2 * pad, w)
+    return F.conv2d(x, weight.view(n * c, 1, -1, 1), groups=n * c).view(n, c, h, w)
+
+
+class BatchAugmentation(torch.nn.Module):
+    """Affine(translate_px, rotate) followed by RandomResizedCrop(size, scale, ratio), the
+    training augmentation of DFCDataset, for a whole batch at once.
+
+    Images are resampled bilinearly with zero padding, label maps with nearest neighbours
+    and IGNORE_INDEX outside the image. With normalize, the images are divided by their
+    per-channel maximum after warping, like DFCDataset does after its transforms.
+
+    Args:
+        size (int): output size, the input size if None (DFCDataset crops to 208)
+        generator (torch.Generator): optional generator on `device` for reproducible batches
+    """
+
+    def __init__(
+        self,
+        size=None,
+        rotate=20,
+        translate_px=5,
+        scale=(0.2, 1.0),
+        ratio=(3 / 4, 4 / 3),
+        normalize=True,
+        image_keys=IMAGE_KEYS,
+        label_keys=LABEL_KEYS,
+        device=None,
+        generator=None,
+    ):
+        super().__init__()
+        self.size = size
+        self.rotate = rotate
+        self.translate_px = translate_px
+        self.scale = scale
+        self.ratio = ratio
+        self.normalize = normalize
+        self.image_keys = image_keys
+        self.label_keys = label_keys
+        self.device = device
+        self.generator = generator
+
+    def sample_theta(self, batch_size, height, width, out_height, out_width, device):
+        """(B, 2, 3) affine_grid matrices that map output coordinates to input coordinates.
+
+        All transforms are composed in pixel units centred on the image:
+        output -> crop of the affine output -> inverse affine -> input"""
+        g = self.generator
+
+        # RandomResizedCrop on the (input sized) output of the affine transform
+        crop_size, crop_corner = sample_resized_crops(
+            batch_size, height, width, self.scale, self.ratio, g, device
+        )
+        output_to_crop = _crop_matrix(
+            crop_size, crop_corner, height, width, out_height, out_width
+        )
+
+        # inverse of the affine transform x_out = R x_in + t
+        angle = torch.empty(batch_size, device=device).uniform_(
+            -self.rotate, self.rotate, generator=g
+        ) * (math.pi / 180)
+        shift = torch.randint(
+            -self.translate_px, self.translate_px + 1, (batch_size, 2), device=device, generator=g
+        ).float()
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        inverse_rotation = torch.stack(
+            [torch.stack([cos, sin], dim=1), torch.stack([-sin, cos], dim=1)], dim=1
+        )
+        inverse_affine = _to_matrix(inverse_rotation) @ _to_matrix(
+            torch.eye(2, device=device).expand(batch_size, 2, 2), -shift
+        )
+
+        theta = (
+            _diag(2 / width, 2 / height, batch_size, device)
+            @ inverse_affine
+            @ output_to_crop
+            @ _diag(out_width / 2, out_height / 2, batch_size, device)
+        )
+        return theta[:, :2]
+
+    @torch.no_grad()
+    def forward(self, sample):
+        sample = dict(sample)
+        present = [key for key in self.image_keys if key in sample]
+        if not present:
+            return sample
+        reference = sample[present[0]]
+        device = self.device or reference.device
+        batch_size, _, height, width = reference.shape
+        out_height, out_width = (height, width) if self.size is None else (self.size, self.size)
+
+        theta = self.sample_theta(batch_size, height, width, out_height, out_width, device)
+        grid = F.affine_grid(
+            theta, (batch_size, 1, out_height, out_width), align_corners=False
+        )
+
+        for key in present:
+            x = sample[key].to(device, non_blocking=True).float()
+            x = F.grid_sample(x, grid, mode="bilinear", padding_mode="zeros", align_corners=False)
+            if self.normalize:
+                x = x / (x.amax(dim=(-2, -1), keepdim=True) + 1e-5)
+            sample[key] = x
+
+        for key in self.label_keys:
+            if key not in sample or not torch.is_tensor(sample[key]) or sample[key].dim() < 3:
+                continue
+            y = sample[key].to(device, non_blocking=True)
+            squeeze = y.dim() == 3
+            y = y.unsqueeze(1) if squeeze else y
+            warped = F.grid_sample(
+                y.float(), grid, mode="nearest", padding_mode="zeros", align_corners=False
+            )
+            # pixels that come from outside the label map are ignored by the loss
+            outside = (grid.abs() > 1).any(dim=-1, keepdim=True).permute(0, 3, 1, 2)
+            warped = warped.masked_fill(outside, IGNORE_INDEX).to(y.dtype)
+            sample[key] = warped.squeeze(1) if squeeze else warped
+
+        return sample
+
+
+# cv2.getGaussianKernel for sigma <= 0, which albumentations' GaussianBlur uses by default
+CV2_GAUSSIAN_KERNELS = {
+    3: [0.25, 0.5, 0.25],
+    5: [0.0625, 0.25, 0.375, 0.25, 0.0625],
+    7: [0.03125, 0.109375, 0.21875, 0.28125, 0.21875, 0.109375, 0.03125],
+}
+
+
+class UnaugmentedViews(dict):
+    """DFCDataset sample whose "img" still has to go through the TwoViewAugmentation after
+    collation. Reading "img1"/"img2" raises a KeyError that points to get_moby_views
+    (default_collate keeps the mapping type)"""
+
+    def __missing__(self, key):
+        if key in ["img1", "img2"]:
+            raise KeyError(
+                f'"{key}" is generated from the collated batch with a TwoViewAugmentation, '
+                "use get_moby_views(sample, moby_transform)"
+            )
+        raise KeyError(key)
+
+
+def get_moby_views(sample, moby_transform):
+    """(img1, img2) of a collated DFCDataset batch, for both kinds of moby_transform"""
+    if "img" in sample:
+        return moby_transform(sample["img"])
+    return sample["img1"], sample["img2"]
+
+
+class TwoViewAugmentation(torch.nn.Module):
+    """Both MoBY views of a batch in one pass: RandomResizedCrop, HorizontalFlip, GaussianBlur
+    and Normalize of the BYOL pipeline of build_transform (sen12ms).
+
+    The crops and flips of the 2B views are drawn at once and folded into affine_grid
+    matrices. The grids of the two views of an image are stacked along the height, so a
+    single grid_sample call reads every image once and writes both views. The blur is a
+    grouped separable convolution with one cv2 kernel (3, 5 or 7 taps) per view.
+    Normalize follows A.Normalize: (x - mean * max_pixel_value) / (std * max_pixel_value).
+
+    Use with DFCDataset(moby_transform=TwoViewAugmentation(...)), which then returns the
+    unaugmented "img" (as UnaugmentedViews) and leaves the views to the collated batch:
+        img1, img2 = get_moby_views(sample, moby_transform)
+    """
+
+    def __init__(
+        self,
+        mean,
+        std,
+        size=224,
+        scale=(0.08, 1.0),
+        ratio=(3 / 4, 4 / 3),
+        flip_p=0.5,
+        blur_sizes=(3, 5, 7),
+        max_pixel_value=255.0,
+        device=None,
+        generator=None,
+    ):
+        super().__init__()
+        self.size = size
+        self.scale = scale
+        self.ratio = ratio
+        self.flip_p = flip_p
+        self.device = device
+        self.generator = generator
+
+        kernel_size = max(blur_sizes)
+        kernels = torch.zeros(len(blur_sizes), kernel_size)
+        for i, ksize in enumerate(blur_sizes):
+            offset = (kernel_size - ksize) // 2
+            kernels[i, offset : offset + ksize] = torch.tensor(CV2_GAUSSIAN_KERNELS[ksize])
+        self.register_buffer("blur_kernels", kernels)
+        self.register_buffer(
+            "mean", torch.tensor(mean).view(1, -1, 1, 1) * max_pixel_value
+        )
+        self.register_buffer("std", torch.tensor(std).view(1, -1, 1, 1) * max_pixel_value)
+
+    @torch.no_grad()
+    def forward(self, images):
+        """(B, C, H, W) images -> two (B, C, size, size) views"""
+        device = self.device or images.device
+        images = images.to(device, non_blocking=True).float()
+        batch_size, channels, height, width = images.shape
+        n, g = 2 * batch_size, self.generator
+
+        crop_size, crop_corner = sample_resized_crops(
+            n, height, width, self.scale, self.ratio, g, device
+        )
+        flip = 1 - 2 * (torch.rand(n, device=device, generator=g) < self.flip_p).float()
+        theta = (
+            _diag(2 / width, 2 / height, n, device)
+            @ _crop_matrix(crop_size, crop_corner, height, width, self.size, self.size)
+            @ _diag(flip * self.size / 2, self.size / 2, n, device)
+        )
+        grid = F.affine_grid(theta[:, :2], (n, 1, self.size, self.size), align_corners=False)
+        grid = grid.view(2, batch_size, self.size, self.size, 2).transpose(0, 1)
+        grid = grid.reshape(batch_size, 2 * self.size, self.size, 2)
+
+        views = F.grid_sample(
+            images, grid, mode="bilinear", padding_mode="border", align_corners=False
+        )
+        views = views.view(batch_size, channels, 2, self.size, self.size).permute(2, 0, 1, 3, 4)
+        views = views.reshape(n, channels, self.size, self.size)
+
+        blur = torch.randint(len(self.blur_kernels), (n,), device=device, generator=g)
+        views = _gaussian_blur(views, self.blur_kernels.to(device)[blur])
+        views = (views - self.mean.to(device)) / self.std.to(device)
+        return views[:batch_size], views[batch_size:]
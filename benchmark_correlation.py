@@ -0,0 +1,118 @@
+"""Benchmark of the correlation backends used by get_retrieval_statistics /
+get_dataset_similarities on random embedding maps of different sizes.
+
+For every embedding size the time per block of batch_size x column_batch_size
+similarities is measured and the largest deviation from the conv backend is reported.
+Small kernels on small maps favour conv, large maps (and kernels that are a
+sizeable fraction of the map) favour fft, equally sized maps favour matmul.
+
+Usage:
+    python benchmark_correlation.py --channels 128 768 --sizes 8 16 32 --out results.json
+"""
+
+import argparse
+import json
+import time
+
+import torch
+import torch.nn.functional as F
+
+from utils import _block_similarities, CORRELATION_BACKENDS
+
+
+def _time_backend(scan_embeds_1, scan_embeds_2, backend, repeats, device):
+    _block_similarities(scan_embeds_1, scan_embeds_2, backend)  # warm-up
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        similarities = _block_similarities(scan_embeds_1, scan_embeds_2, backend)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+    return (time.perf_counter() - start) / repeats, similarities
+
+
+def benchmark(channels, sizes, kernel_ratios, batch_size, column_batch_size, repeats, device):
+    results = []
+    for c in channels:
+        for size in sizes:
+            for ratio in kernel_ratios:
+                kernel_size = max(1, int(size * ratio))
+                scan_embeds_1 = F.normalize(
+                    torch.randn(batch_size, c, size, size, device=device), dim=1
+                )
+                scan_embeds_2 = F.normalize(
+                    torch.randn(column_batch_size, c, kernel_size, kernel_size, device=device),
+                    dim=1,
+                )
+
+                backends = [b for b in CORRELATION_BACKENDS if b != "auto"]
+                if kernel_size != size:
+                    backends.remove("matmul")
+
+                timings = {}
+                reference = None
+                for backend in backends:
+                    seconds, similarities = _time_backend(
+                        scan_embeds_1, scan_embeds_2, backend, repeats, device
+                    )
+                    if reference is None:
+                        reference = similarities
+                    timings[backend] = {
+                        "seconds": seconds,
+                        "max_abs_diff": (similarities - reference).abs().max().item(),
+                    }
+
+                result = {
+                    "channels": c,
+                    "size": size,
+                    "kernel_size": kernel_size,
+                    "fastest": min(timings, key=lambda b: timings[b]["seconds"]),
+                    "backends": timings,
+                }
+                results.append(result)
+                print(
+                    f"C={c:4d} map={size:3d} kernel={kernel_size:3d}  "
+                    + "  ".join(
+                        f"{b}: {t['seconds'] * 1000:8.2f}ms (diff {t['max_abs_diff']:.1e})"
+                        for b, t in timings.items()
+                    )
+                    + f"  -> {result['fastest']}"
+                )
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the correlation backends")
+    parser.add_argument("--channels", nargs="+", default=[128, 768], type=int)
+    parser.add_argument("--sizes", nargs="+", default=[4, 8, 16, 32], type=int)
+    parser.add_argument(
+        "--kernel_ratios",
+        nargs="+",
+        default=[1.0, 0.5],
+        type=float,
+        help="kernel (s2 embedding) size relative to the s1 embedding size",
+    )
+    parser.add_argument("--batch_size", default=50, type=int)
+    parser.add_argument("--column_batch_size", default=256, type=int)
+    parser.add_argument("--repeats", default=5, type=int)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--out", default=None, type=str, help="optional json output path")
+    args = parser.parse_args()
+
+    results = benchmark(
+        args.channels,
+        args.sizes,
+        args.kernel_ratios,
+        args.batch_size,
+        args.column_batch_size,
+        args.repeats,
+        torch.device(args.device),
+    )
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,204 @@
+"""Input pipeline benchmark of DFCDataset / DataLoader without a model.
+
+Every combination of the given settings (storage location, mode, image_px_size,
+cover_all_parts, balanced_classes, batch size, workers) is measured with
+- samples/sec and p50/p99 batch latency of a DataLoader, the first batch (worker start-up)
+  is reported separately,
+- time per sample of the stages open, read and remap (DFCSEN12MSDataset.get_patch),
+  normalise (labels, transforms and normalisation in DFCDataset.__getitem__) and collate,
+  measured in the main process,
+- RSS of the main process and its workers at the end of the run.
+
+Storage backends are compared by passing one base_dir per storage location (e.g. a local
+SSD copy and the network file system).
+
+Usage:
+    python benchmark_data_loading.py --base_dirs /netscratch/lscheibenreif/grss-dfc-20 \\
+        --modes validation --image_px_sizes 128 224 --num_workers 0 4 8 --out loading.json
+"""
+
+import time
+import json
+import argparse
+import itertools
+from distutils.util import strtobool
+
+import numpy as np
+import psutil
+import torch
+from torch.utils.data.dataloader import default_collate
+
+from dfc_dataset import DFCDataset
+
+SETTINGS = [
+    "base_dir",
+    "mode",
+    "image_px_size",
+    "cover_all_parts",
+    "balanced_classes",
+    "batch_size",
+    "num_workers",
+]
+
+
+def get_rss_mb():
+    """resident memory of this process and all of its (worker) children"""
+    process = psutil.Process()
+    processes = [process] + process.children(recursive=True)
+    rss = 0
+    for p in processes:
+        try:
+            rss += p.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return rss / 2**20
+
+
+def profile_stages(dataset, num_samples, batch_size):
+    """seconds per sample of every stage, in the main process"""
+    num_samples = min(num_samples, len(dataset))
+    dataset.data.timings = {}
+    getitem_seconds, collate_seconds = 0.0, 0.0
+
+    samples = []
+    for idx in np.random.permutation(len(dataset))[:num_samples]:
+        start = time.perf_counter()
+        samples.append(dataset[int(idx)])
+        getitem_seconds += time.perf_counter() - start
+
+        if len(samples) == batch_size:
+            start = time.perf_counter()
+            default_collate(samples)
+            collate_seconds += time.perf_counter() - start
+            samples = []
+
+    timings = dataset.data.timings
+    dataset.data.timings = None
+    stages = {stage: timings.get(stage, 0.0) for stage in ["open", "read", "remap"]}
+    stages["normalise"] = getitem_seconds - sum(stages.values())
+    stages["collate"] = collate_seconds
+    return {stage: seconds / num_samples for stage, seconds in stages.items()}
+
+
+def measure_loader(dataset, batch_size, num_workers, num_batches):
+    loader = torch.utils.data.DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=True,
+        num_workers=num_workers,
+        drop_last=True,
+    )
+
+    latencies = []
+    start = time.perf_counter()
+    iterator = iter(loader)
+    for _ in range(min(num_batches + 1, len(loader))):
+        next(iterator)
+        now = time.perf_counter()
+        latencies.append(now - start)
+        start = now
+    # the workers are still alive here
+    rss = get_rss_mb()
+    del iterator
+
+    first_batch, latencies = latencies[0], np.array(latencies[1:])
+    return {
+        "samples_per_sec": batch_size * len(latencies) / latencies.sum()
+        if len(latencies)
+        else None,
+        "first_batch_seconds": first_batch,
+        "p50_batch_seconds": float(np.percentile(latencies, 50)) if len(latencies) else None,
+        "p99_batch_seconds": float(np.percentile(latencies, 99)) if len(latencies) else None,
+        "num_batches": len(latencies),
+        "rss_mb": rss,
+    }
+
+
+def run(args):
+    results = []
+    for values in itertools.product(
+        args.base_dirs,
+        args.modes,
+        args.image_px_sizes,
+        args.cover_all_parts,
+        args.balanced_classes,
+        args.batch_sizes,
+        args.num_workers,
+    ):
+        setting = dict(zip(SETTINGS, values))
+        result = dict(setting)
+        try:
+            dataset = DFCDataset(
+                setting["base_dir"],
+                mode=setting["mode"],
+                clip_sample_values=True,
+                image_px_size=setting["image_px_size"],
+                cover_all_parts=setting["cover_all_parts"],
+                balanced_classes=setting["balanced_classes"],
+                seed=args.seed,
+                exclude_invalid=args.exclude_invalid,
+            )
+            result["num_observations"] = len(dataset)
+            result["stage_seconds_per_sample"] = profile_stages(
+                dataset, args.profile_samples, setting["batch_size"]
+            )
+            result.update(
+                measure_loader(
+                    dataset, setting["batch_size"], setting["num_workers"], args.num_batches
+                )
+            )
+        except Exception as e:
+            # e.g. no balanced classes csv for this split, keep going with the matrix
+            result["error"] = f"{type(e).__name__}: {e}"
+            print(", ".join(f"{k}={v}" for k, v in setting.items()), "->", result["error"])
+            results.append(result)
+            continue
+
+        stages = "  ".join(
+            f"{stage} {seconds * 1000:.2f}ms"
+            for stage, seconds in result["stage_seconds_per_sample"].items()
+        )
+        print(
+            ", ".join(f"{k}={v}" for k, v in setting.items())
+            + f" -> {result['samples_per_sec'] or 0:.1f} samples/s"
+            + f", p50 {result['p50_batch_seconds'] or 0:.3f}s, p99 {result['p99_batch_seconds'] or 0:.3f}s"
+            + f", rss {result['rss_mb']:.0f}MB\n    per sample: {stages}"
+        )
+        results.append(result)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the DFCDataset input pipeline")
+    parser.add_argument("--base_dirs", nargs="+", required=True, type=str)
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        default=["validation"],
+        choices=["dfc", "sen12ms", "test", "validation"],
+        type=str,
+    )
+    parser.add_argument("--image_px_sizes", nargs="+", default=[224], type=int)
+    parser.add_argument("--cover_all_parts", nargs="+", default=["False"], type=str)
+    parser.add_argument("--balanced_classes", nargs="+", default=["False"], type=str)
+    parser.add_argument("--batch_sizes", nargs="+", default=[50], type=int)
+    parser.add_argument("--num_workers", nargs="+", default=[0, 8], type=int)
+    parser.add_argument("--num_batches", default=20, type=int)
+    parser.add_argument("--profile_samples", default=200, type=int)
+    parser.add_argument("--exclude_invalid", default="False", type=str)
+    parser.add_argument("--seed", default=42, type=int)
+    parser.add_argument("--out", default=None, type=str, help="optional json output path")
+    args = parser.parse_args()
+
+    args.cover_all_parts = [bool(strtobool(v)) for v in args.cover_all_parts]
+    args.balanced_classes = [bool(strtobool(v)) for v in args.balanced_classes]
+    args.exclude_invalid = bool(strtobool(args.exclude_invalid))
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    results = run(args)
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
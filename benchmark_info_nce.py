@@ -0,0 +1,139 @@
+"""Equivalence check and benchmark of InfoNCELoss against SwinTrainer.info_nce_loss
+(+ CrossEntropyLoss and accuracy()) on random features.
+
+For every batch size the loss, the feature gradients and the top-1/top-5 accuracies of both
+implementations are compared (the script fails if they differ), then the time of a
+forward + backward step and the peak memory (CUDA only) are reported.
+
+Usage:
+    python benchmark_info_nce.py --batch_sizes 50 256 1024 --chunk_size 256 --out results.json
+"""
+
+import argparse
+import json
+import time
+from types import SimpleNamespace
+
+import torch
+
+from utils import InfoNCELoss, dotdictify
+from d_swin_utils import SwinTrainer, accuracy
+
+
+def reference_loss(features, temperature, n_views):
+    """the current SwinTrainer.info_nce_loss, called without a trainer instance"""
+    trainer = SimpleNamespace(
+        distributed=False,
+        gather_views=lambda f: f,
+        args=dotdictify(
+            {
+                "n_views": n_views,
+                "device": features.device,
+                "TRAIN": {"CONTRAST_TEMPERATURE": temperature},
+            }
+        ),
+    )
+    logits, labels = SwinTrainer.info_nce_loss(trainer, features)
+    loss = torch.nn.functional.cross_entropy(logits, labels)
+    top1, top5 = accuracy(logits, labels, topk=(1, 5))
+    return loss, [top1[0], top5[0]]
+
+
+def _measure(loss_fn, features, repeats, device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base_memory = torch.cuda.memory_allocated(device)
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        features.grad = None
+        loss, _ = loss_fn(features)
+        loss.backward()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        peak_memory = (torch.cuda.max_memory_allocated(device) - base_memory) / 2**20
+    else:
+        peak_memory = None
+
+    return (time.perf_counter() - start) / repeats, peak_memory
+
+
+def benchmark(batch_sizes, dim, temperature, n_views, chunk_size, repeats, device):
+    results = []
+    for batch_size in batch_sizes:
+        features = torch.randn(batch_size * n_views, dim, device=device, requires_grad=True)
+
+        implementations = {
+            "reference": lambda f: reference_loss(f, temperature, n_views),
+            "cached": InfoNCELoss(temperature, n_views=n_views),
+        }
+        if chunk_size is not None and chunk_size < batch_size * n_views:
+            implementations["chunked"] = InfoNCELoss(
+                temperature, n_views=n_views, chunk_size=chunk_size
+            )
+
+        # equivalence of loss, gradients and accuracies
+        outputs = {}
+        for name, loss_fn in implementations.items():
+            features.grad = None
+            loss, accuracies = loss_fn(features)
+            loss.backward()
+            outputs[name] = (loss.detach(), features.grad.clone(), accuracies)
+
+        ref_loss, ref_grad, ref_acc = outputs["reference"]
+        for name, (loss, grad, accuracies) in outputs.items():
+            assert torch.allclose(loss, ref_loss, rtol=1e-5, atol=1e-6), (name, loss, ref_loss)
+            assert torch.allclose(grad, ref_grad, rtol=1e-4, atol=1e-7), name
+            for acc, ref in zip(accuracies, ref_acc):
+                assert abs(float(acc) - float(ref)) < 1e-3, (name, acc, ref)
+
+        result = {"batch_size": batch_size, "loss": ref_loss.item(), "implementations": {}}
+        for name, loss_fn in implementations.items():
+            seconds, peak_memory = _measure(loss_fn, features, repeats, device)
+            result["implementations"][name] = {
+                "seconds": seconds,
+                "peak_memory_mb": peak_memory,
+            }
+        results.append(result)
+
+        print(
+            f"batch {batch_size:5d}  "
+            + "  ".join(
+                f"{name}: {r['seconds'] * 1000:8.2f}ms"
+                + (f" {r['peak_memory_mb']:8.1f}MB" if r["peak_memory_mb"] is not None else "")
+                for name, r in result["implementations"].items()
+            )
+        )
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="check and benchmark InfoNCELoss")
+    parser.add_argument("--batch_sizes", nargs="+", default=[50, 256, 1024], type=int)
+    parser.add_argument("--dim", default=768, type=int, help="pooled Swin-T feature size")
+    parser.add_argument("--temperature", default=0.2, type=float)
+    parser.add_argument("--n_views", default=2, type=int)
+    parser.add_argument("--chunk_size", default=256, type=int)
+    parser.add_argument("--repeats", default=10, type=int)
+    parser.add_argument("--seed", default=42, type=int)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--out", default=None, type=str, help="optional json output path")
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    results = benchmark(
+        args.batch_sizes,
+        args.dim,
+        args.temperature,
+        args.n_views,
+        args.chunk_size,
+        args.repeats,
+        torch.device(args.device),
+    )
+    print("InfoNCELoss matches SwinTrainer.info_nce_loss for all batch sizes")
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,133 @@
+"""Views/sec of the two MoBY views: the per-sample Albumentations pipelines of build_transform
+(BYOL, sen12ms), as DFCDataset runs them with moby_transform, against TwoViewAugmentation
+on collated batches.
+
+Both paths get the same random 15 channel (S1 + S2) images. The per-channel mean and std of
+the views are printed for both paths as a sanity check of the batched pipeline.
+
+Usage:
+    python benchmark_moby_views.py --batch_size 64 --num_batches 10 --device cuda --out views.json
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+
+from batch_augmentation import TwoViewAugmentation
+from dfc_dataset import s1_mean, s1_std, s2_mean, s2_std
+from Transformer_SSL.config import _C
+from Transformer_SSL.data.build import build_transform
+
+
+def get_byol_config(img_size, crop):
+    config = _C.clone()
+    config.defrost()
+    config.AUG.SSL_AUG = True
+    config.AUG.SSL_AUG_TYPE = "byol"
+    config.AUG.SSL_AUG_CROP = crop
+    config.DATA.IMG_SIZE = img_size
+    config.train_mode = "sen12ms"
+    config.freeze()
+    return config
+
+
+def albumentations_views(transform, images):
+    """the moby_transform branch of DFCDataset.__getitem__ for every image"""
+    views = []
+    for img in images:
+        img = np.moveaxis(img, 0, -1)
+        views.append((transform[0](image=img)["image"], transform[1](image=img)["image"]))
+    return views
+
+
+def batched_views(augmentation, images, device):
+    img1, img2 = augmentation(torch.from_numpy(images))
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return img1, img2
+
+
+def _channel_stats(views):
+    return views.mean(dim=(0, 2, 3)).tolist(), views.std(dim=(0, 2, 3)).tolist()
+
+
+def benchmark(args):
+    device = torch.device(args.device)
+    config = get_byol_config(args.img_size, args.crop)
+    mean, std = s1_mean + s2_mean, s1_std + s2_std
+
+    transform = build_transform(True, config)
+    augmentation = TwoViewAugmentation(
+        mean, std, size=config.DATA.IMG_SIZE, scale=(config.AUG.SSL_AUG_CROP, 1.0), device=device
+    )
+
+    rng = np.random.default_rng(args.seed)
+    batches = [
+        rng.normal(
+            np.array(mean)[:, None, None],
+            np.array(std)[:, None, None],
+            size=(args.batch_size, len(mean), args.image_px_size, args.image_px_size),
+        ).astype(np.float32)
+        for _ in range(args.num_batches)
+    ]
+    num_views = 2 * args.batch_size * args.num_batches
+
+    albumentations_views(transform, batches[0][:2])  # warm-up
+    start = time.perf_counter()
+    for images in batches:
+        reference = albumentations_views(transform, images)
+    albumentations_seconds = time.perf_counter() - start
+
+    batched_views(augmentation, batches[0], device)  # warm-up
+    start = time.perf_counter()
+    for images in batches:
+        img1, img2 = batched_views(augmentation, images, device)
+    batched_seconds = time.perf_counter() - start
+
+    reference = torch.stack([v for pair in reference for v in pair])
+    batched = torch.cat([img1, img2]).cpu()
+    results = {
+        "batch_size": args.batch_size,
+        "image_px_size": args.image_px_size,
+        "img_size": args.img_size,
+        "device": str(device),
+        "albumentations_views_per_sec": num_views / albumentations_seconds,
+        "batched_views_per_sec": num_views / batched_seconds,
+        "albumentations_channel_stats": _channel_stats(reference),
+        "batched_channel_stats": _channel_stats(batched),
+    }
+
+    print(
+        f"albumentations: {results['albumentations_views_per_sec']:10.1f} views/s  "
+        f"batched ({device}): {results['batched_views_per_sec']:10.1f} views/s"
+    )
+    for name in ["albumentations", "batched"]:
+        means, stds = results[name + "_channel_stats"]
+        print(
+            f"{name:>14} channel means: "
+            + " ".join(f"{m:6.3f}" for m in means)
+            + "\n" + " " * 15 + "channel stds:  "
+            + " ".join(f"{s:6.3f}" for s in stds)
+        )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the MoBY two-view augmentation")
+    parser.add_argument("--batch_size", default=64, type=int)
+    parser.add_argument("--num_batches", default=10, type=int)
+    parser.add_argument("--image_px_size", default=256, type=int)
+    parser.add_argument("--img_size", default=224, type=int)
+    parser.add_argument("--crop", default=0.08, type=float, help="AUG.SSL_AUG_CROP")
+    parser.add_argument("--seed", default=42, type=int)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--out", default=None, type=str, help="optional json output path")
+    args = parser.parse_args()
+
+    results = benchmark(args)
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
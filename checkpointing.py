@@ -0,0 +1,337 @@
+"""Asynchronous model checkpoints with retention for train_evaluation.py.
+
+CheckpointManager.save takes a CPU snapshot of the state_dict (device copies are queued
+without blocking, like AsyncStatsWriter) and a background thread serialises it, so the
+training loop only waits for the copy. Every file is written to a temporary file in the
+same directory and renamed, so a preempted run never leaves a truncated checkpoint.
+
+With head_only, the state of frozen parameters (requires_grad=False) and of buffers of
+modules without trainable parameters is written once to <prefix>-backbone-<sha1>.pth, and
+the epoch checkpoints only hold the trainable part plus a reference to that file. The
+backbone is re-hashed only if one of its tensors was modified in place (e.g. BatchNorm
+running statistics in train mode), and a new backbone file is only written if its content
+changed. Models without frozen parameters are saved in full.
+
+Retention keeps the keep_last most recent and the keep_best best checkpoints by the given
+metric, and the backbone files they reference. <prefix>-checkpoints.json lists them.
+Backbone files nothing references anymore are removed after every save and save_state.
+
+Full checkpoints are plain state_dicts as before. load_model_weights reads both kinds:
+    model.load_state_dict(load_model_weights(path))
+
+save_state writes other files through the same thread, e.g. the resume state of resume.py:
+the model (head-only as above) under "model_weights", plus CPU copies of optimizer and
+training state. These files are not subject to retention, but the backbones they reference
+are kept until the file is overwritten with another backbone.
+"""
+
+import os
+import copy
+import json
+import queue
+import hashlib
+import threading
+
+import torch
+
+HEAD_ONLY_KEY = "head_only_weights"
+
+
+def atomic_save(obj, path):
+    """torch.save to a temporary file next to path, then rename it to path"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _atomic_write_json(obj, path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def state_dict_sha1(state_dict):
+    """content hash of a (CPU) state_dict over its keys, dtypes, shapes and values"""
+    sha1 = hashlib.sha1()
+    for key in sorted(state_dict):
+        tensor = state_dict[key].contiguous()
+        sha1.update(f"{key}:{tensor.dtype}:{tuple(tensor.shape)}".encode())
+        # bytes of the raw storage, also for dtypes numpy does not have (bfloat16)
+        sha1.update(tensor.view(-1).view(torch.uint8).numpy().tobytes())
+    return sha1.hexdigest()
+
+
+def merge_backbone(weights, directory, map_location="cpu"):
+    """full state_dict of weights, head-only weights are merged with their backbone, whose
+    file is relative to directory"""
+    if not (isinstance(weights, dict) and HEAD_ONLY_KEY in weights):
+        return weights
+    backbone_path = os.path.join(directory, weights["backbone_file"])
+    state_dict = torch.load(backbone_path, map_location=map_location)
+    state_dict.update(weights[HEAD_ONLY_KEY])
+    return state_dict
+
+
+def load_model_weights(path, map_location="cpu"):
+    """full state_dict of a checkpoint, head-only checkpoints are merged with their backbone"""
+    weights = torch.load(path, map_location=map_location)
+    return merge_backbone(weights, os.path.dirname(path), map_location=map_location)
+
+
+def _cpu_copy(obj, cuda_copies):
+    """copy of a nested dict/list of tensors on the cpu, device copies are only queued and
+    counted in cuda_copies"""
+    if torch.is_tensor(obj):
+        obj = obj.detach()
+        if obj.is_cuda:
+            cuda_copies.append(obj.device)
+            return obj.to("cpu", non_blocking=True)
+        return obj.clone()
+    if isinstance(obj, dict):
+        return {k: _cpu_copy(v, cuda_copies) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_cpu_copy(v, cuda_copies) for v in obj)
+    return copy.deepcopy(obj)
+
+
+def split_head(model):
+    """names of the state_dict entries that are trained: trainable parameters and the
+    buffers of modules with trainable parameters"""
+    head = set()
+    for module_name, module in model.named_modules():
+        prefix = module_name + "." if module_name else ""
+        trainable = False
+        for name, param in module.named_parameters(recurse=False):
+            if param.requires_grad:
+                head.add(prefix + name)
+                trainable = True
+        if trainable:
+            head.update(prefix + name for name, _ in module.named_buffers(recurse=False))
+    return head
+
+
+class CheckpointManager(object):
+    """Saves model snapshots as <directory>/<prefix>-epoch-<epoch>.pth in a background thread.
+
+    Args:
+        keep_last (int): most recent checkpoints to keep, all if None
+        keep_best (int): best checkpoints by metric to keep
+        mode (str): "min" or "max", whether a lower or higher metric is better
+        head_only (bool): reference the frozen part of the model by content hash
+        max_pending (int): snapshots waiting to be written before save blocks
+    """
+
+    def __init__(
+        self,
+        directory,
+        prefix,
+        keep_last=2,
+        keep_best=1,
+        mode="min",
+        head_only=True,
+        max_pending=1,
+    ):
+        if mode not in ["min", "max"]:
+            raise ValueError(f"Unsupported mode {mode}, must be in ['min', 'max']")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.prefix = prefix
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.mode = mode
+        self.head_only = head_only
+
+        # written checkpoints, read back from the manifest when a run is restarted
+        self.manifest_path = os.path.join(directory, prefix + "-checkpoints.json")
+        self.records = []
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as f:
+                self.records = json.load(f)
+
+        # backbone of the last snapshot {key: (data_ptr, version)}, and (writer thread only)
+        # its file and the files of all backbones written by this run by sha1
+        self.backbone_versions = None
+        self.backbone_file = None
+        self.backbone_sha1s = {}
+        # backbone files referenced by the files of save_state {path: backbone file}
+        self.state_backbones = {}
+
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _snapshot(self, state_dict):
+        """CPU copies of all tensors, the device to host copies are only queued"""
+        event = None
+        snapshot = {}
+        for key, tensor in state_dict.items():
+            tensor = tensor.detach()
+            if tensor.is_cuda:
+                if event is None:
+                    event = torch.cuda.Event()
+                snapshot[key] = tensor.to("cpu", non_blocking=True)
+            else:
+                snapshot[key] = tensor.clone()
+        if event is not None:
+            event.record()
+        return snapshot, event
+
+    def _snapshot_model(self, model):
+        """CPU copies of the head, of the backbone if it changed (None otherwise) and
+        whether the model has a backbone"""
+        state_dict = model.state_dict(keep_vars=True)
+        head = split_head(model) if self.head_only else set(state_dict)
+        backbone_keys = [key for key in state_dict if key not in head]
+
+        # None: the backbone of the previous snapshot is unchanged
+        backbone = None
+        if backbone_keys:
+            versions = {
+                key: (state_dict[key].data_ptr(), state_dict[key]._version)
+                for key in backbone_keys
+            }
+            if versions != self.backbone_versions:
+                backbone = self._snapshot({key: state_dict[key] for key in backbone_keys})
+                self.backbone_versions = versions
+
+        weights, event = self._snapshot({key: state_dict[key] for key in head})
+        return weights, event, backbone, bool(backbone_keys)
+
+    def save(self, model, epoch, metric=None):
+        """queue a snapshot of model, metric decides which checkpoints are the best"""
+        record = {
+            "file": f"{self.prefix}-epoch-{epoch}.pth",
+            "epoch": epoch,
+            "metric": None if metric is None else float(metric),
+            "backbone_file": None,
+        }
+        self.queue.put((record, *self._snapshot_model(model)))
+
+    def save_state(self, path, model, **state):
+        """queue a snapshot of model (as "model_weights") and of the tensors, arrays and values
+        in state (e.g. optim_state), written to path outside of the retention"""
+        weights, event, backbone, head_only = self._snapshot_model(model)
+        cuda_copies = []
+        state = _cpu_copy(state, cuda_copies)
+        if cuda_copies:
+            # the model copies were queued before, one event covers both
+            event = torch.cuda.Event()
+            event.record()
+        record = {"file": path}
+        self.queue.put((record, weights, event, backbone, head_only, state))
+
+    def track_state(self, path, weights):
+        """keep the backbone referenced by the "model_weights" of an existing save_state file,
+        e.g. the resume state a run was restarted from"""
+        if isinstance(weights, dict) and HEAD_ONLY_KEY in weights:
+            self.state_backbones[path] = os.path.basename(weights["backbone_file"])
+
+    def _write_backbone(self, backbone, event):
+        """file of the backbone, only written if no backbone with the same content was"""
+        if event is not None:
+            event.synchronize()
+        sha1 = state_dict_sha1(backbone)
+        if sha1 not in self.backbone_sha1s:
+            backbone_file = f"{self.prefix}-backbone-{sha1[:16]}.pth"
+            path = os.path.join(self.directory, backbone_file)
+            if not os.path.exists(path):
+                atomic_save(backbone, path)
+            self.backbone_sha1s[sha1] = backbone_file
+        return self.backbone_sha1s[sha1]
+
+    def _write(self, record, weights, event, backbone, head_only, state=None):
+        if backbone is not None:
+            self.backbone_file = self._write_backbone(*backbone)
+
+        if event is not None:
+            event.synchronize()
+        if state is not None:
+            self._write_state(record["file"], weights, head_only, state)
+            return
+        if head_only:
+            record["backbone_file"] = self.backbone_file
+            weights = {HEAD_ONLY_KEY: weights, "backbone_file": self.backbone_file}
+        atomic_save(weights, os.path.join(self.directory, record["file"]))
+
+        self.records = [r for r in self.records if r["file"] != record["file"]] + [record]
+        self._apply_retention()
+
+    def _write_state(self, path, weights, head_only, state):
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        if head_only:
+            backbone_path = os.path.join(self.directory, self.backbone_file)
+            weights = {
+                HEAD_ONLY_KEY: weights,
+                "backbone_file": os.path.relpath(backbone_path, directory),
+            }
+        atomic_save({"model_weights": weights, **state}, path)
+        # the backbone of the previous state stays referenced until it is replaced
+        previous = self.state_backbones.get(path)
+        self.state_backbones[path] = self.backbone_file if head_only else None
+        self._apply_retention(released=[previous])
+
+    def _apply_retention(self, released=()):
+        """remove the checkpoints that are not kept, and the backbone files of removed
+        checkpoints, of this run and in released that nothing references anymore"""
+        by_epoch = sorted(self.records, key=lambda r: r["epoch"])
+        if self.keep_last is not None:
+            by_epoch = by_epoch[-self.keep_last :] if self.keep_last > 0 else []
+        scored = [r for r in self.records if r["metric"] is not None]
+        scored.sort(key=lambda r: r["metric"], reverse=self.mode == "max")
+        keep = {r["file"] for r in by_epoch + scored[: self.keep_best]}
+
+        # the current backbone is referenced by the next head-only snapshots
+        kept_backbones = {r["backbone_file"] for r in self.records if r["file"] in keep}
+        kept_backbones.add(self.backbone_file)
+        kept_backbones.update(self.state_backbones.values())
+        backbones = set(released) | set(self.backbone_sha1s.values())
+        for r in self.records:
+            if r["file"] not in keep:
+                self._remove(r["file"])
+            backbones.add(r["backbone_file"])
+        for backbone_file in backbones - kept_backbones - {None}:
+            self._remove(backbone_file)
+        self.records = [r for r in self.records if r["file"] in keep]
+        self.backbone_sha1s = {
+            sha1: f for sha1, f in self.backbone_sha1s.items() if f in kept_backbones
+        }
+        _atomic_write_json(self.records, self.manifest_path)
+
+    def _remove(self, file):
+        path = os.path.join(self.directory, file)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            try:
+                self._write(*item)
+            except Exception as e:
+                print(f"CheckpointManager: writing {item[0]['file']} failed with {e!r}")
+            finally:
+                self.queue.task_done()
+
+    def best(self):
+        """record of the best checkpoint so far, None without metrics"""
+        scored = [r for r in self.records if r["metric"] is not None]
+        if not scored:
+            return None
+        return (min if self.mode == "min" else max)(scored, key=lambda r: r["metric"])
+
+    def flush(self):
+        """wait until all queued checkpoints are written"""
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
@@ -1,22 +1,26 @@
 import os
 
-# set environment variables to limit cpu usage
-os.environ["OMP_NUM_THREADS"] = "4"  # export OMP_NUM_THREADS=4
-os.environ["OPENBLAS_NUM_THREADS"] = "4"  # export OPENBLAS_NUM_THREADS=4
-os.environ["MKL_NUM_THREADS"] = "6"  # export MKL_NUM_THREADS=6
-os.environ["VECLIB_MAXIMUM_THREADS"] = "4"  # export VECLIB_MAXIMUM_THREADS=4
-os.environ["NUMEXPR_NUM_THREADS"] = "6"  # export NUMEXPR_NUM_THREADS=6
+# limit cpu usage, unless the thread counts are set in the environment
+os.environ.setdefault("OMP_NUM_THREADS", "4")  # export OMP_NUM_THREADS=4
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "4")  # export OPENBLAS_NUM_THREADS=4
+os.environ.setdefault("MKL_NUM_THREADS", "6")  # export MKL_NUM_THREADS=6
+os.environ.setdefault("VECLIB_MAXIMUM_THREADS", "4")  # export VECLIB_MAXIMUM_THREADS=4
+os.environ.setdefault("NUMEXPR_NUM_THREADS", "6")  # export NUMEXPR_NUM_THREADS=6
 
 import logging
+from collections import deque
+from contextlib import nullcontext
 import yaml
-import wandb
 import torch
-import numpy as np
+import torch.distributed as dist
 import torch.nn.functional as F
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 import shutil
 
+from utils import RunningStats, AsyncStatsWriter, InfoNCELoss, StepProfiler
+from batch_augmentation import BatchAugmentation
+
 torch.manual_seed(0)
 
 
@@ -50,26 +54,185 @@ def accuracy(output, target, topk=(1,)):
         return res
 
 
+class GatherLayer(torch.autograd.Function):
+    """all_gather that keeps the gradient flowing back to the local features.
+    Every rank computes the loss over the full gathered batch, so the incoming
+    gradients are summed over ranks before the local slice is returned"""
+
+    @staticmethod
+    def forward(ctx, x):
+        out = [torch.zeros_like(x) for _ in range(dist.get_world_size())]
+        dist.all_gather(out, x.contiguous())
+        return tuple(out)
+
+    @staticmethod
+    def backward(ctx, *grads):
+        all_grads = torch.stack(grads)
+        dist.all_reduce(all_grads)
+        return all_grads[dist.get_rank()]
+
+
+def gather_features(x):
+    """collect x of shape (mini_batch, ...) from all ranks into (mini_batch * world_size, ...)"""
+    return torch.cat(GatherLayer.apply(x), dim=0)
+
+
+class RandContext(object):
+    """captures the cpu/cuda RNG state on creation and restores it (in a forked RNG)
+    when entered, so that the replayed forward pass of a gradient cache step
+    draws the same drop path masks as the first no-grad pass"""
+
+    def __init__(self, *tensors):
+        self.cpu_state = torch.get_rng_state()
+        self.devices = list({t.get_device() for t in tensors if t.is_cuda})
+        self.cuda_states = [torch.cuda.get_rng_state(d) for d in self.devices]
+
+    def __enter__(self):
+        self._fork = torch.random.fork_rng(devices=self.devices, enabled=True)
+        self._fork.__enter__()
+        torch.set_rng_state(self.cpu_state)
+        for device, state in zip(self.devices, self.cuda_states):
+            torch.cuda.set_rng_state(state, device)
+
+    def __exit__(self, *exc):
+        self._fork.__exit__(*exc)
+        self._fork = None
+
+
+def guarded_step(optimizer, loss):
+    """optimizer.step() that leaves the parameters and their optimizer state unchanged if the
+    loss or a gradient is not finite. Like the skipped steps of GradScaler, but decided on the
+    device with torch.where, so that there is no host sync. Costs a copy of the parameters and
+    their state per step. Returns the (device) flag of a skipped step"""
+    params = [p for group in optimizer.param_groups for p in group["params"] if p.grad is not None]
+    nonfinite = ~torch.isfinite(loss.detach())
+    if params:
+        nonfinite = nonfinite | ~torch.stack([torch.isfinite(p.grad).all() for p in params]).all()
+
+    def tensors(p):
+        # AdamW keeps its step count on the cpu, it is not restored
+        return [p] + [
+            t for t in optimizer.state[p].values() if torch.is_tensor(t) and t.device == p.device
+        ]
+
+    with torch.no_grad():
+        before = {id(t): t.clone() for p in params for t in tensors(p)}
+        optimizer.step()
+        for p in params:
+            for t in tensors(p):
+                # state created by this step is reset to zeros
+                old = before.get(id(t))
+                t.copy_(torch.where(nonfinite, old if old is not None else torch.zeros_like(t), t))
+    return nonfinite
+
+
+class NonFiniteMonitor(object):
+    """Reads the flags of guarded_step on the host once the device got there (CUDA events),
+    so that the training loop does not wait for them. Keeps the samples of the pending steps
+    to return the first one that was skipped. With more than max_pending steps in flight, the
+    oldest one is waited for"""
+
+    def __init__(self, max_pending=8):
+        self.max_pending = max_pending
+        self.pending = deque()
+
+    def add(self, nonfinite, sample):
+        event = None
+        if nonfinite.is_cuda:
+            host_flag = torch.empty((), dtype=torch.bool, pin_memory=True)
+            host_flag.copy_(nonfinite, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+        else:
+            host_flag = nonfinite
+        self.pending.append((event, host_flag, sample))
+        if len(self.pending) > self.max_pending and self.pending[0][0] is not None:
+            self.pending[0][0].synchronize()
+
+    def first_nonfinite(self):
+        """sample of the first skipped step among the completed ones, None if there is none"""
+        while self.pending:
+            event, host_flag, sample = self.pending[0]
+            if event is not None and not event.query():
+                break
+            self.pending.popleft()
+            if host_flag.item():
+                self.pending.clear()
+                return sample
+        return None
+
+
 class SwinTrainer(object):
     def __init__(self, *args, **kwargs):
         self.args = kwargs["args"]
         self.model = kwargs["model"].to(self.args.device)
         self.optimizer = kwargs["optimizer"]
         self.scheduler = kwargs["scheduler"]
+        # loggers.build_logger, wandb/tensorboard/jsonl on the main process
+        self.logger = kwargs["logger"]
         self.use_logging = self.args.use_logging
         self.run_name = self.args.run_name
-        self.writer = SummaryWriter()
-        if self.use_logging:
+
+        # multi-process pretraining: the model is wrapped in DistributedDataParallel
+        # by the entry point and negatives are gathered from all ranks
+        self.distributed = dist.is_available() and dist.is_initialized()
+        self.world_size = dist.get_world_size() if self.distributed else 1
+        self.is_main_process = not self.distributed or dist.get_rank() == 0
+        if isinstance(self.model, torch.nn.parallel.DistributedDataParallel):
+            self.model_without_ddp = self.model.module
+        else:
+            self.model_without_ddp = self.model
+
+        self.writer = SummaryWriter() if self.is_main_process else None
+        # statistics stay on device and are only read back every log_interval steps,
+        # tqdm/wandb/TensorBoard are fed from a background thread
+        self.log_interval = self.args.get("log_interval", 100)
+        self.stats_writer = AsyncStatsWriter()
+        if self.use_logging and self.is_main_process:
             logging.basicConfig(
                 filename=os.path.join(self.writer.log_dir, "training.log"),
                 level=logging.DEBUG,
             )
         self.criterion = torch.nn.CrossEntropyLoss().to(self.args.device)
+        # same loss as info_nce_loss + criterion, from cached index tensors and
+        # optionally chunked over the rows for large batches
+        self.contrastive_loss = InfoNCELoss(
+            self.args.TRAIN.CONTRAST_TEMPERATURE,
+            n_views=self.args.n_views,
+            chunk_size=self.args.get("contrastive_chunk_size"),
+        )
+        # gradient cache mode: the loader batch is a logical batch that is embedded
+        # in sub-batches of grad_cache_chunk_size, see grad_cache_backward
+        self.grad_cache_chunk_size = self.args.get("grad_cache_chunk_size")
+        # training augmentation of the collated batch on the device, shared by s1 and s2
+        if self.args.get("batch_augmentation"):
+            self.batch_augmentation = BatchAugmentation(device=self.args.device)
+        else:
+            self.batch_augmentation = None
+        # per-stage step timing, see utils.StepProfiler
+        self.profiler = StepProfiler(
+            enabled=self.args.get("profile", False),
+            sample_every=self.args.get("profile_every", 10),
+            device=self.args.device,
+            trace_dir=self.args.get("profile_trace_dir"),
+        )
+
+    def gather_views(self, features):
+        """in multi-process mode, gather every view separately to keep the view-major
+        layout of the batch, the loss is then computed over the global batch"""
+        if not self.distributed:
+            return features
+        return torch.cat(
+            [gather_features(f) for f in features.chunk(self.args.n_views)]
+        )
 
     def info_nce_loss(self, features):
+        """reference implementation of the InfoNCE logits, see InfoNCELoss"""
+        features = self.gather_views(features)
+        batch_size = features.shape[0] // self.args.n_views
 
         labels = torch.cat(
-            [torch.arange(self.args.batch_size) for i in range(self.args.n_views)],
+            [torch.arange(batch_size) for i in range(self.args.n_views)],
             dim=0,
         )
         labels = (labels.unsqueeze(0) == labels.unsqueeze(1)).float()
@@ -104,55 +267,168 @@ class SwinTrainer(object):
         logits = logits / self.args.TRAIN.CONTRAST_TEMPERATURE
         return logits, labels
 
+    def grad_cache_backward(self, s1, s2):
+        """gradient caching (Gao et al., 2021) for batches that do not fit in activation memory:
+        1. embed the batch in no-grad sub-batches
+        2. compute the InfoNCE loss and its gradient w.r.t. the embeddings over the full batch
+        3. replay every sub-batch with gradients and backpropagate the cached embedding gradients
+        The parameter gradients equal those of a single pass over the full batch. The batch
+        augmentation is applied per sub-batch on the device and replayed with the same
+        random state, so only one sub-batch is on the device at a time."""
+        chunks = list(
+            zip(
+                s1.split(self.grad_cache_chunk_size),
+                s2.split(self.grad_cache_chunk_size),
+            )
+        )
+
+        s1_features, s2_features, rand_states = [], [], []
+        with torch.no_grad():
+            for s1_chunk, s2_chunk in chunks:
+                s1_chunk = s1_chunk.to(self.args.device, non_blocking=True)
+                s2_chunk = s2_chunk.to(self.args.device, non_blocking=True)
+                rand_states.append(RandContext(s1_chunk, s2_chunk))
+                feature_dict = self.model(self.augment_chunk(s1_chunk, s2_chunk))
+                s1_features.append(feature_dict["s1"])
+                s2_features.append(feature_dict["s2"])
+
+        s1_features = torch.cat(s1_features).requires_grad_()
+        s2_features = torch.cat(s2_features).requires_grad_()
+        features = torch.cat([s1_features, s2_features])
+        loss, accuracies = self.contrastive_loss(self.gather_views(features))
+        loss.backward()
+
+        s1_grads = s1_features.grad.split(self.grad_cache_chunk_size)
+        s2_grads = s2_features.grad.split(self.grad_cache_chunk_size)
+        for i, ((s1_chunk, s2_chunk), rand_state) in enumerate(zip(chunks, rand_states)):
+            # DistributedDataParallel only has to all_reduce after the last sub-batch
+            last_chunk = i == len(chunks) - 1
+            sync = nullcontext() if not self.distributed or last_chunk else self.model.no_sync()
+            with sync, rand_state:
+                feature_dict = self.model(
+                    self.augment_chunk(
+                        s1_chunk.to(self.args.device, non_blocking=True),
+                        s2_chunk.to(self.args.device, non_blocking=True),
+                    )
+                )
+                torch.autograd.backward(
+                    [feature_dict["s1"], feature_dict["s2"]], [s1_grads[i], s2_grads[i]]
+                )
+
+        return loss.detach(), accuracies
+
+    def augment_chunk(self, s1, s2):
+        """model input of a grad cache sub-batch, with the batch augmentation if enabled"""
+        images = {"s1": s1, "s2": s2}
+        if self.batch_augmentation is not None:
+            images = self.batch_augmentation(images)
+        return images
+
+    def has_nan(self, sample):
+        """some s1 scenes in sen12ms are known to have NaNs. In multi-process mode all ranks
+        have to skip the same step, otherwise the feature all_gather deadlocks.
+        The check is disabled with skip_nan_batches=false, e.g. when the invalid
+        observations are already excluded by the dataset (dataset_scan.py)"""
+        if not self.args.get("skip_nan_batches", True):
+            return False
+
+        has_nan = torch.isnan(sample["s1"]).any() or torch.isnan(sample["s2"]).any()
+        if self.distributed:
+            has_nan = torch.tensor(float(has_nan), device=self.args.device)
+            dist.all_reduce(has_nan, op=dist.ReduceOp.MAX)
+            has_nan = bool(has_nan.item())
+        return has_nan
+
+    def log_train_stats(self, stats, step):
+        """AsyncStatsWriter sink for the training statistics"""
+        if self.use_logging:
+            self.writer.add_scalar("loss", stats["loss"], global_step=step)
+            self.writer.add_scalar("acc/top1", stats["top1"], global_step=step)
+            self.writer.add_scalar("acc/top5", stats["top5"], global_step=step)
+            self.writer.add_scalar(
+                "learning_rate", stats["learning_rate"], global_step=step
+            )
+
+        self.logger.log(
+            {
+                "loss": stats["loss"],
+                "acc/top1": stats["top1"],
+                "acc/top5": stats["top5"],
+                "learning_rate": stats["learning_rate"],
+                "epoch": stats["epoch"],
+            },
+            step=step,
+        )
+
+    def log_profile_stats(self, stats, step):
+        """AsyncStatsWriter sink for the StepProfiler region means"""
+        for name, value in stats.items():
+            self.writer.add_scalar(name, value, global_step=step)
+        self.logger.log(stats, step=step)
+
+    def log_validation_stats(self, stats, step):
+        """AsyncStatsWriter sink for the validation statistics"""
+        self.writer.add_scalar("validation_loss", stats["loss"], global_step=step)
+        self.writer.add_scalar("validation_acc/top1", stats["top1"], global_step=step)
+        self.writer.add_scalar("validation_acc/top5", stats["top5"], global_step=step)
+
+        self.logger.log(
+            {
+                "validation_loss": stats["loss"],
+                "validation_acc/top1": stats["top1"],
+                "validation_acc/top5": stats["top5"],
+                "validation_epoch": stats["epoch"],
+            },
+            step=step,
+        )
+
     def validate(self, val_loader, epoch, n_iter):
         if self.use_logging:
             logging.info(f"Start D-Swin validation run at epoch {epoch}.")
 
-        acc1_per_logging = []
-        acc5_per_logging = []
-        loss_per_logging = []
+        val_stats = RunningStats(["loss", "top1", "top5"], self.log_interval)
 
-        pbar = tqdm(val_loader, total=len(val_loader))
+        pbar = tqdm(val_loader, total=len(val_loader), disable=not self.is_main_process)
 
         with torch.no_grad():
 
             for sample in pbar:
-                if torch.isnan(sample["s1"]).any() or torch.isnan(sample["s2"]).any():
+                if self.has_nan(sample):
                     continue
-                s1 = sample["s1"].to(self.args.device)
-                s2 = sample["s2"].to(self.args.device)
-
-                images = {"s1": s1, "s2": s2}
-                feature_dict = self.model(images)
-                features = torch.cat([feature_dict["s1"], feature_dict["s2"]])
-                logits, labels = self.info_nce_loss(features)
-                loss = self.criterion(logits, labels)
-
-                top1, top5 = accuracy(logits, labels, topk=(1, 5))
-                acc1_per_logging.append(top1[0].item())
-                acc5_per_logging.append(top5[0].item())
-                loss_per_logging.append(loss.item())
-
-                pbar.set_description(
-                    f"Validation epoch:{epoch}, Step:{n_iter}, Loss:{np.mean(loss_per_logging[-100:]):.4}"
-                )  # "{epoch_accuracy[-100:].mean():.4}")
-
-            mean_top1 = np.mean(acc1_per_logging)
-            mean_top5 = np.mean(acc5_per_logging)
-            mean_loss = np.mean(loss_per_logging)
-
-            self.writer.add_scalar("validation_loss", mean_loss, global_step=n_iter)
-            self.writer.add_scalar("validation_acc/top1", mean_top1, global_step=n_iter)
-            self.writer.add_scalar("validation_acc/top5", mean_top5, global_step=n_iter)
-
-            wandb.log(
-                {
-                    "validation_loss": mean_loss,
-                    "validation_acc/top1": mean_top1,
-                    "validation_acc/top5": mean_top5,
-                    "validation_epoch": epoch,
-                },
-                step=n_iter,
+                # in gradient cache mode the logical batch is embedded in sub-batches
+                chunk_size = self.grad_cache_chunk_size or sample["s1"].shape[0]
+                s1_features, s2_features = [], []
+                for s1, s2 in zip(
+                    sample["s1"].split(chunk_size), sample["s2"].split(chunk_size)
+                ):
+                    images = {
+                        "s1": s1.to(self.args.device),
+                        "s2": s2.to(self.args.device),
+                    }
+                    feature_dict = self.model(images)
+                    s1_features.append(feature_dict["s1"])
+                    s2_features.append(feature_dict["s2"])
+
+                features = torch.cat(s1_features + s2_features)
+                loss, (top1, top5) = self.contrastive_loss(self.gather_views(features))
+                val_stats.update(loss=loss, top1=top1, top5=top5)
+
+                if val_stats.ready():
+                    window = val_stats.window_means()
+                    if self.is_main_process:
+                        self.stats_writer.submit(
+                            lambda s: pbar.set_description(
+                                f"Validation epoch:{epoch}, Step:{n_iter}, Loss:{s['loss']:.4}"
+                            ),
+                            window,
+                        )
+
+            if not self.is_main_process:
+                return
+
+            self.stats_writer.submit(
+                lambda s: self.log_validation_stats(s, step=n_iter),
+                {**val_stats.means(), "epoch": epoch},
             )
 
     def train(self, train_loader, val_loader):
@@ -160,109 +436,125 @@ class SwinTrainer(object):
         # scaler = GradScaler(enabled=self.args.fp16_precision)
 
         # save config file
-        save_config_file(self.writer.log_dir, self.args)
+        if self.is_main_process:
+            save_config_file(self.writer.log_dir, self.args)
 
         n_iter = 0
         if self.use_logging:
             logging.info(f"Start D-Swin training for {self.args.TRAIN.EPOCHS} epochs.")
             logging.info(f"Training with gpu: {self.args.disable_cuda}.")
 
-        acc1_per_logging = []
-        acc5_per_logging = []
-        loss_per_logging = []
+        # window for the tqdm description and window between two wandb/TensorBoard logs
+        pbar_stats = RunningStats(["loss"], self.log_interval)
+        log_stats = RunningStats(["loss", "top1", "top5"])
+        nonfinite_monitor = NonFiniteMonitor()
 
         for epoch_counter in range(self.args.TRAIN.EPOCHS):
-            pbar = tqdm(train_loader)
-            for sample in pbar:
+            # DistributedSampler / ClassBalancedSampler reshuffle per epoch
+            if hasattr(train_loader.sampler, "set_epoch"):
+                train_loader.sampler.set_epoch(epoch_counter)
+
+            pbar = tqdm(train_loader, disable=not self.is_main_process)
+            for sample in self.profiler.iterate(pbar):
 
                 # s1 = sample["s1"] # use both Sentinel-1 channels
                 # s2 = sample["s2"][:, [4,3]] # use rg channels of Sentinel-2
 
-                if torch.isnan(sample["s1"]).any() or torch.isnan(sample["s2"]).any():
+                if self.has_nan(sample):
                     # some s1 scenes in sen12ms are known to have NaNs...
                     continue
 
-                s1 = sample["s1"].to(self.args.device)
-                s2 = sample["s2"].to(self.args.device)
-
-                # model processes s1 and s2 data through different backbones
-                images = {"s1": s1, "s2": s2}
-
-                # with autocast(enabled=self.args.fp16_precision):
-                feature_dict = self.model(images)
-
-                features = torch.cat([feature_dict["s1"], feature_dict["s2"]])
-                logits, labels = self.info_nce_loss(features)
-
-                loss = self.criterion(logits, labels)
-
-                if torch.isnan(loss):
-                    print("Loss is nan:", loss)
-                    return sample
-
                 self.optimizer.zero_grad()
-                loss.backward()
-                self.optimizer.step()
+                if self.grad_cache_chunk_size is not None:
+                    # sub-batches are moved to the device and augmented one at a time, the
+                    # forward and backward passes are interleaved and timed as one region
+                    s1, s2 = sample["s1"], sample["s2"]
+                    with self.profiler.region("grad_cache"):
+                        loss, (top1, top5) = self.grad_cache_backward(s1, s2)
+                else:
+                    with self.profiler.region("h2d"):
+                        if self.batch_augmentation is not None:
+                            sample = self.batch_augmentation(sample)
+                        s1 = sample["s1"].to(self.args.device)
+                        s2 = sample["s2"].to(self.args.device)
+
+                    # model processes s1 and s2 data through different backbones
+                    images = {"s1": s1, "s2": s2}
+
+                    # with autocast(enabled=self.args.fp16_precision):
+                    with self.profiler.region("forward"):
+                        feature_dict = self.model(images)
+                        features = torch.cat([feature_dict["s1"], feature_dict["s2"]])
+                    with self.profiler.region("loss"):
+                        loss, (top1, top5) = self.contrastive_loss(self.gather_views(features))
+                    with self.profiler.region("backward"):
+                        loss.backward()
+
+                # a non-finite loss or gradient skips the step on the device, the host
+                # stops the training once it sees the flag
+                with self.profiler.region("optimizer"):
+                    nonfinite = guarded_step(self.optimizer, loss)
+                nonfinite_monitor.add(nonfinite, sample)
 
                 # scaler.scale(loss).backward()
                 # scaler.step(self.optimizer)
                 # scaler.update()
 
-                top1, top5 = accuracy(logits, labels, topk=(1, 5))
-
-                acc1_per_logging.append(top1[0].item())
-                acc5_per_logging.append(top5[0].item())
-                loss_per_logging.append(loss.item())
+                with self.profiler.region("metrics"):
+                    pbar_stats.update(loss=loss)
+                    log_stats.update(loss=loss, top1=top1, top5=top5)
 
                 if n_iter % self.args.log_every_n_steps == 0:
                     # if n_iter == 0:
                     #    continue
-                    # top1, top5 = accuracy(logits, labels, topk=(1, 5))
-                    mean_top1 = np.mean(acc1_per_logging)
-                    mean_top5 = np.mean(acc5_per_logging)
-                    mean_loss = np.mean(loss_per_logging)
-
-                    if self.use_logging:
-                        self.writer.add_scalar("loss", mean_loss, global_step=n_iter)
-                        self.writer.add_scalar(
-                            "acc/top1", mean_top1, global_step=n_iter
-                        )
-                        self.writer.add_scalar(
-                            "acc/top5", mean_top5, global_step=n_iter
-                        )
-                        self.writer.add_scalar(
-                            "learning_rate",
-                            self.scheduler._get_lr(epoch_counter)[0],
-                            global_step=n_iter,
+                    stats = log_stats.window_means()
+                    if self.is_main_process:
+                        self.stats_writer.submit(
+                            lambda s, step=n_iter: self.log_train_stats(s, step=step),
+                            {
+                                **stats,
+                                "learning_rate": self.scheduler._get_lr(epoch_counter)[
+                                    0
+                                ],
+                                "epoch": epoch_counter,
+                            },
                         )
-
-                    wandb.log(
-                        {
-                            "loss": mean_loss,
-                            "acc/top1": mean_top1,
-                            "acc/top5": mean_top5,
-                            "learning_rate": self.scheduler._get_lr(epoch_counter)[0],
-                            "epoch": epoch_counter,
-                        },
-                        step=n_iter,
-                    )
-
-                    acc1_per_logging = []
-                    acc5_per_logging = []
-                    mean_loss = []
+                        if self.profiler.enabled:
+                            self.stats_writer.submit(
+                                lambda s, step=n_iter: self.log_profile_stats(s, step=step),
+                                self.profiler.log_dict(),
+                            )
 
                     # run over validation set and log metrics to wandb
                     self.validate(val_loader, epoch_counter, n_iter)
 
                 # n_iter += 1
-                n_iter += s1.shape[
-                    0
-                ]  # count the number of processed samples (i.e. batch_size * steps)
-                pbar.set_description(
-                    f"Epoch:{epoch_counter}, Step:{n_iter}, Loss:{np.mean(loss_per_logging[-100:]):.4}"
-                )  # "{epoch_accuracy[-100:].mean():.4}")
-
-            if epoch_counter % 50 == 0:
+                n_iter += (
+                    s1.shape[0] * self.world_size
+                )  # count the number of processed samples (i.e. batch_size * steps)
+
+                with self.profiler.region("logging"):
+                    nan_sample = nonfinite_monitor.first_nonfinite()
+                    if nan_sample is not None:
+                        print(f"Loss or gradients are not finite before step {n_iter}")
+                        self.stats_writer.close()
+                        self.profiler.close()
+                        return nan_sample
+                    if pbar_stats.ready():
+                        window = pbar_stats.window_means()
+                        if self.is_main_process:
+                            self.stats_writer.submit(
+                                lambda s, pbar=pbar, epoch=epoch_counter, step=n_iter: pbar.set_description(
+                                    f"Epoch:{epoch}, Step:{step}, Loss:{s['loss']:.4}"
+                                ),
+                                window,
+                            )
+                self.profiler.step()
+
+            if self.profiler.enabled and self.is_main_process:
+                self.profiler.save_json(os.path.join(self.writer.log_dir, "step_profile.json"))
+
+            if epoch_counter % 50 == 0 and self.is_main_process:
                 print("Saving checkpoint for epoch:", epoch_counter)
                 checkpoint_name = (
                     "checkpoints/d-swin"
@@ -275,7 +567,7 @@ class SwinTrainer(object):
                     {
                         "epoch": epoch_counter,
                         "arch": self.args.arch,
-                        "state_dict": self.model.state_dict(),
+                        "state_dict": self.model_without_ddp.state_dict(),
                         "optimizer": self.optimizer.state_dict(),
                     },
                     is_best=False,
@@ -287,11 +579,15 @@ class SwinTrainer(object):
                 self.scheduler.step(epoch_counter)
             if self.use_logging:
                 logging.debug(
-                    f"Epoch: {epoch_counter}\tLoss: {loss}\tTop1 accuracy: {top1[0]}"
+                    f"Epoch: {epoch_counter}\tLoss: {loss}\tTop1 accuracy: {top1}"
                 )
 
+        self.stats_writer.close()
+        self.profiler.close()
         if self.use_logging:
             logging.info("Training has finished.")
+        if not self.is_main_process:
+            return
         # save model checkpoints
         checkpoint_name = (
             "checkpoints/d-swin-"
@@ -304,7 +600,7 @@ class SwinTrainer(object):
             {
                 "epoch": epoch_counter,
                 "arch": self.args.arch,
-                "state_dict": self.model.state_dict(),
+                "state_dict": self.model_without_ddp.state_dict(),
                 "optimizer": self.optimizer.state_dict(),
             },
             is_best=False,
@@ -0,0 +1,124 @@
+"""One-time scan of a DFC/SEN12MS split for observations that can not be used
+(NaNs in the Sentinel-1/2 patches or unreadable files).
+
+The result is written to a sidecar csv next to the observations csv and is used by
+DFCDataset(exclude_invalid=True) to drop these observations before any I/O happens.
+
+Usage:
+    python dataset_scan.py /ds2/remote_sensing/sen12ms --mode sen12ms --num_workers 16
+"""
+
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from dfc_sen12ms_dataset import DFCSEN12MSDataset, Seasons, S1Bands, S2Bands, LCBands
+
+
+def get_invalid_index_path(base_dir, mode):
+    """location of the sidecar index for the observations csv of a split"""
+    return os.path.join(base_dir, mode + "_observations_invalid.csv")
+
+
+def check_observation(data, season, scene, patch_id, include_dfc=True):
+    """returns None for a usable observation, otherwise the reason why it is invalid"""
+    try:
+        s1, s2, *_ = data.get_s1_s2_lc_dfc_quad(
+            season,
+            scene,
+            patch_id,
+            s1_bands=S1Bands.ALL,
+            s2_bands=S2Bands.ALL,
+            lc_bands=LCBands.LC,
+            dfc_bands=LCBands.DFC,
+            include_dfc=include_dfc,
+        )
+    except Exception as e:
+        return "unreadable: " + type(e).__name__
+
+    if np.isnan(s1).any() or np.isnan(s2).any():
+        return "nan"
+
+    return None
+
+
+def _scan_chunk(args):
+    base_dir, include_dfc, rows = args
+    data = DFCSEN12MSDataset(base_dir)
+
+    invalid = []
+    for season, scene, patch_id in rows:
+        reason = check_observation(
+            data,
+            Seasons[season[len("Seasons.") :]],
+            scene,
+            int(patch_id),
+            include_dfc=include_dfc,
+        )
+        if reason is not None:
+            invalid.append([season, scene, patch_id, reason])
+
+    return invalid
+
+
+def scan_observations(base_dir, mode, num_workers=8, chunk_size=64, out_path=None):
+    """scan all observations of `mode` in parallel and write the invalid ones
+    (Season, Scene, ID, reason) to the sidecar index"""
+    observations = pd.read_csv(
+        os.path.join(base_dir, mode + "_observations.csv"),
+        header=None,
+        names=["Season", "Scene", "ID"],
+    )
+    # high-resolution LC (dfc) labels are not available for the sen12ms split
+    include_dfc = mode != "sen12ms"
+
+    rows = observations.values.tolist()
+    chunks = [
+        (base_dir, include_dfc, rows[i : i + chunk_size])
+        for i in range(0, len(rows), chunk_size)
+    ]
+
+    invalid = []
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        for chunk_invalid in tqdm(
+            executor.map(_scan_chunk, chunks), total=len(chunks), desc="Scanning"
+        ):
+            invalid.extend(chunk_invalid)
+
+    invalid = pd.DataFrame(invalid, columns=["Season", "Scene", "ID", "reason"])
+
+    if out_path is None:
+        out_path = get_invalid_index_path(base_dir, mode)
+    invalid.to_csv(out_path, index=False)
+    print(
+        f"{len(invalid)}/{len(observations)} invalid observations written to {out_path}"
+    )
+
+    return invalid
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="scan a split for unusable observations")
+    parser.add_argument("base_dir", type=str)
+    parser.add_argument(
+        "--mode",
+        default="sen12ms",
+        choices=["dfc", "sen12ms", "test", "validation"],
+        type=str,
+    )
+    parser.add_argument("--num_workers", default=8, type=int)
+    parser.add_argument("--chunk_size", default=64, type=int)
+    parser.add_argument("--out_path", default=None, type=str)
+    args = parser.parse_args()
+
+    scan_observations(
+        args.base_dir,
+        args.mode,
+        num_workers=args.num_workers,
+        chunk_size=args.chunk_size,
+        out_path=args.out_path,
+    )
@@ -13,6 +13,8 @@ import torch.nn.functional as F
 from torch.utils.data import Dataset
 
 from utils import AlbumentationsToTorchTransform
+from batch_augmentation import TwoViewAugmentation, UnaugmentedViews
+from dataset_scan import get_invalid_index_path
 from dfc_sen12ms_dataset import DFCSEN12MSDataset, Seasons, S1Bands, S2Bands, LCBands
 
 IGBP_map = {
@@ -94,10 +96,40 @@ s2_std = [
     20.4592,
 ]
 
+# one row of DFCDataset.observation_table, season indexes DFCDataset.season_lookup
+OBSERVATION_DTYPE = np.dtype(
+    [("season", np.uint8), ("scene", np.uint16), ("id", np.uint32), ("part", np.uint8)]
+)
+
 # Remapping IGBP classes to simplified DFC classes
 IGBP2DFC = np.array([0, 1, 1, 1, 1, 1, 2, 2, 3, 3, 4, 5, 6, 7, 6, 8, 9, 10])
 
 
+def clean_labels(x):
+    """set savanna and ice label to 255, which is ignore_index of loss function,
+    reduce other labels to 0-7 (see DFC_map_clean), in place"""
+    x[x == 3] = 0
+    x[x == 8] = 0
+    x[x >= 3] -= 1
+    x[x >= 8] -= 1
+    x -= 1
+    x[x == -1] = 255
+    return x
+
+
+def get_label_classes(x, min_fraction=0.1):
+    """most frequent class and the classes that make up at least min_fraction of a
+    cleaned label map, as per https://arxiv.org/pdf/2104.00704.pdf"""
+    unique, counts = np.unique(x, return_counts=True)
+    label = unique[counts.argmax()]
+    multilabel = [
+        class_idx
+        for class_idx, num in zip(unique, counts)
+        if num / x.size >= min_fraction and class_idx != 255
+    ]
+    return label, multilabel
+
+
 class DFCDataset(Dataset):
     """Pytorch wrapper for DFCSEN12MSDataset"""
 
@@ -116,9 +148,13 @@ class DFCDataset(Dataset):
         sampling_seed=42,
         normalize=False,
         moby_transform=None,
+        exclude_invalid=False,
+        invalid_index_path=None,
     ):
         """cover_all_parts: if image_px_size is not 256, this makes sure that during validation the entire image is used
-        during training, we read image parst at random parts of the original image, during vaildation, use a non-overlapping sliding window to cover the entire image"""
+        during training, we read image parst at random parts of the original image, during vaildation, use a non-overlapping sliding window to cover the entire image
+        exclude_invalid: drop the observations listed in the sidecar index written by dataset_scan.py
+        (NaNs or unreadable files), invalid_index_path defaults to <base_dir>/<mode>_observations_invalid.csv"""
         super(DFCDataset, self).__init__()
 
         self.clip_sample_values = clip_sample_values
@@ -165,31 +201,44 @@ class DFCDataset(Dataset):
         self.data = DFCSEN12MSDataset(base_dir)
 
         if self.balanced_classes:
-            self.observations = pd.read_csv(
+            observations = pd.read_csv(
                 os.path.join(base_dir, mode + "_observations_balanced_classes.csv"),
                 header=0,
                 # names=["Season", "Scene", "ID", "dfc_label", "copy_nr"],
             )
         else:
-            self.observations = pd.read_csv(
+            observations = pd.read_csv(
                 os.path.join(base_dir, mode + "_observations.csv"),
                 header=None,
                 names=["Season", "Scene", "ID"],
             )
+        if exclude_invalid:
+            if invalid_index_path is None:
+                invalid_index_path = get_invalid_index_path(base_dir, mode)
+            if not os.path.exists(invalid_index_path):
+                raise FileNotFoundError(
+                    f"No invalid observation index at {invalid_index_path}, run dataset_scan.py first"
+                )
+            invalid = pd.read_csv(invalid_index_path, header=0)
+            keys = pd.MultiIndex.from_frame(observations[["Season", "Scene", "ID"]])
+            invalid_keys = pd.MultiIndex.from_frame(invalid[["Season", "Scene", "ID"]])
+            observations = observations[~keys.isin(invalid_keys)]
+
         if self.cover_all_parts:
             num_img_parts = int(256**2 / self.image_px_size**2)
             obs = []
-            for season, scene, idx in self.observations.values:
+            for season, scene, idx in observations.values:
                 for i in range(num_img_parts):
                     obs.append([season, scene, idx, i])
 
-            self.observations = pd.DataFrame(
+            observations = pd.DataFrame(
                 obs, columns=["Season", "Scene", "ID", "ScenePart"]
             )
 
-        self.observations = self.observations.sample(
+        observations = observations.sample(
             frac=self.used_data_fraction, random_state=sampling_seed
         ).sort_index()
+        self._set_observation_table(observations)
         self.transforms = transforms
         self.mode = mode
 
@@ -216,9 +265,45 @@ class DFCDataset(Dataset):
 
         self.base_transform = AlbumentationsToTorchTransform(base_aug)
 
+    def _set_observation_table(self, observations):
+        """store the observations as a compact structured array (see OBSERVATION_DTYPE),
+        the season enums are looked up once per distinct season"""
+        season_names, season_codes = np.unique(
+            observations.Season.values.astype(str), return_inverse=True
+        )
+        self.season_names = season_names.tolist()
+        self.season_lookup = [
+            Seasons[name[len("Seasons.") :]] for name in self.season_names
+        ]
+
+        table = np.zeros(len(observations), dtype=OBSERVATION_DTYPE)
+        table["season"] = season_codes
+        columns = [("scene", "Scene"), ("id", "ID"), ("part", "ScenePart")]
+        for field, column in columns:
+            if column not in observations:
+                continue
+            values = observations[column].values.astype(np.int64)
+            if len(values) and values.max() > np.iinfo(table[field].dtype).max:
+                raise ValueError(f"{column} values do not fit into {table[field].dtype}")
+            table[field] = values
+        self.observation_table = table
+
+    @property
+    def observations(self):
+        """the observations as a DataFrame (Season, Scene, ID, ScenePart), built from the table"""
+        table = self.observation_table
+        return pd.DataFrame(
+            {
+                "Season": np.array(self.season_names)[table["season"]],
+                "Scene": table["scene"].astype(np.int64),
+                "ID": table["id"].astype(np.int64),
+                "ScenePart": table["part"],
+            }
+        )
+
     def __getitem__(self, idx, s2_bands=S2Bands.ALL, transform=True, normalize=True):
-        obs = self.observations.iloc[idx]
-        season = Seasons[obs.Season[len("Seasons.") :]]
+        season_code, scene, patch_id, _ = self.observation_table[idx].tolist()
+        season = self.season_lookup[season_code]
 
         if self.image_px_size != 256:
             # crop the data to self.image_px_size times self.image_px_size (e.g. 128x128)
@@ -234,8 +319,8 @@ class DFCDataset(Dataset):
                 x.astype(np.float32) if type(x) == np.ndarray else x
                 for x in self.data.get_s1_s2_lc_dfc_quad(
                     season,
-                    obs.Scene,
-                    int(obs.ID),
+                    scene,
+                    patch_id,
                     s1_bands=S1Bands.ALL,
                     s2_bands=s2_bands,
                     lc_bands=LCBands.LC,
@@ -244,26 +329,13 @@ class DFCDataset(Dataset):
                     window=window,
                 )
             ]
-            dfc[dfc == 3] = 0
-            dfc[dfc == 8] = 0
-            dfc[dfc >= 3] -= 1
-            dfc[dfc >= 8] -= 1
-            dfc -= 1
-            dfc[dfc == -1] = 255
-
-            dfc_unique, dfc_counts = np.unique(dfc, return_counts=True)
-            dfc_label = dfc_unique[
-                dfc_counts.argmax()
-            ]  # this is already mapped to dfc in data.get_s1_s2_lc_dfc_quad
+            clean_labels(dfc)
+
+            # this is already mapped to dfc in data.get_s1_s2_lc_dfc_quad
+            dfc_label, dfc_multilabel = get_label_classes(dfc)
             dfc_label_str = DFC_map_clean[int(dfc_label)]
 
-            dfc_multilabel = torch.tensor(
-                [
-                    class_idx
-                    for class_idx, num in zip(dfc_unique, dfc_counts)
-                    if num / self.image_px_size**2 >= 0.1 and class_idx != 255
-                ]
-            ).long()
+            dfc_multilabel = torch.tensor(dfc_multilabel).long()
             dfc_multilabel_one_hot = torch.nn.functional.one_hot(
                 dfc_multilabel.flatten(), num_classes=8
             ).float()
@@ -277,8 +349,8 @@ class DFCDataset(Dataset):
                 x.astype(np.float32) if type(x) == np.ndarray else x
                 for x in self.data.get_s1_s2_lc_dfc_quad(
                     season,
-                    obs.Scene,
-                    int(obs.ID),
+                    scene,
+                    patch_id,
                     s1_bands=S1Bands.ALL,
                     s2_bands=s2_bands,
                     lc_bands=LCBands.LC,
@@ -294,28 +366,14 @@ class DFCDataset(Dataset):
         # reduce other labels to 0-7
         # print("Number of savanna pixels:", lc[lc == 3].size)
         # print("Number of ice pixels:", lc[lc == 8].size)
-        lc[lc == 3] = 0
-        lc[lc == 8] = 0
-        lc[lc >= 3] -= 1
-        lc[lc >= 8] -= 1
-        lc -= 1
-        # print("Number of invalid pixels:", lc[lc == -1].size)
-        lc[lc == -1] = 255
+        clean_labels(lc)
 
         # use the most frequent MODIS class as pseudo label
-        lc_unique, lc_counts = np.unique(lc, return_counts=True)
-        lc_label = lc_unique[
-            lc_counts.argmax()
-        ]  # this is already mapped to dfc in data.get_s1_s2_lc_dfc_quad
+        # this is already mapped to dfc in data.get_s1_s2_lc_dfc_quad
+        lc_label, lc_multilabel = get_label_classes(lc)
         lc_label_str = DFC_map_clean[int(lc_label)]
 
-        lc_multilabel = torch.tensor(
-            [
-                class_idx
-                for class_idx, num in zip(lc_unique, lc_counts)
-                if num / self.image_px_size**2 >= 0.1 and class_idx != 255
-            ]
-        ).long()
+        lc_multilabel = torch.tensor(lc_multilabel).long()
         lc_multilabel_one_hot = torch.nn.functional.one_hot(
             lc_multilabel.flatten(), num_classes=8
         ).float()
@@ -332,6 +390,10 @@ class DFCDataset(Dataset):
 
         if self.moby_transform is not None:
             img = np.concatenate([s1, s2])
+            if isinstance(self.moby_transform, TwoViewAugmentation):
+                # both views are generated from the collated batch (get_moby_views)
+                return UnaugmentedViews(img=torch.from_numpy(img), idx=idx)
+
             img = np.moveaxis(img, 0, -1)
             img1 = self.moby_transform[0](image=img)
             img2 = self.moby_transform[1](image=img)
@@ -398,8 +460,8 @@ class DFCDataset(Dataset):
             "lc_multilabel": lc_multilabel.numpy().tolist(),
             "lc_multilabel_one_hot": lc_multilabel_one_hot,
             "season": str(season.value),
-            "scene": obs.Scene,
-            "id": obs.ID,
+            "scene": scene,
+            "id": patch_id,
         }
 
         output_tensor = {
@@ -435,7 +497,7 @@ class DFCDataset(Dataset):
             return output_tensor
 
     def __len__(self):
-        return self.observations.shape[0]
+        return len(self.observation_table)
 
     def visualize_observation(self, idx, transform=False):
         sample = self.__getitem__(idx, s2_bands=S2Bands.RGB, transform=transform)
@@ -14,6 +14,7 @@
 """
 
 import os
+import time
 import rasterio
 
 import numpy as np
@@ -85,6 +86,9 @@ IGBP2DFC = np.array([0, 1, 1, 1, 1, 1, 2, 2, 3, 3, 4, 5, 6, 7, 6, 8, 9, 10])
 class DFCSEN12MSDataset:
     def __init__(self, base_dir):
         self.base_dir = base_dir
+        # optional dict of accumulated seconds per stage of get_patch (open, read, remap),
+        # filled when set, e.g. by benchmark_data_loading.py
+        self.timings = None
 
         if not os.path.exists(self.base_dir):
             raise Exception("The specified base_dir for SEN12MS dataset does not exist")
@@ -185,17 +189,25 @@ class DFCSEN12MSDataset:
         filename = "{}_{}_p{}.tif".format(season, scene, patch_id)
         patch_path = os.path.join(self.base_dir, season, scene, filename)
 
+        start = time.perf_counter()
         with rasterio.open(patch_path) as patch:
+            opened = time.perf_counter()
             if window is not None:
                 data = patch.read(bands, window=window) 
             else:
                 data = patch.read(bands)
             bounds = patch.bounds
+        read = time.perf_counter()
 
         # Remap IGBP to DFC bands
         if sensor  == "lc":
             data = IGBP2DFC[data]
 
+        if self.timings is not None:
+            self.timings["open"] = self.timings.get("open", 0.0) + opened - start
+            self.timings["read"] = self.timings.get("read", 0.0) + read - opened
+            self.timings["remap"] = self.timings.get("remap", 0.0) + time.perf_counter() - read
+
         if len(data.shape) == 2:
             data = np.expand_dims(data, axis=0)
 
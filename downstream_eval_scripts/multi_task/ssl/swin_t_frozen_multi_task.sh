@@ -0,0 +1 @@
+python train_evaluation.py --batch_size=32 --checkpoint=checkpoints/d-swin-ruby-meadow-21-epoch299.pth --finetuning=False --image_px_size=224 --learning_rate=3e-06 --model=DoubleSwinTransformerDownstream --seed=44 --targets dfc_label dfc_multilabel_one_hot dfc --wandb_project=EV-SSL
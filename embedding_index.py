@@ -0,0 +1,273 @@
+"""Nearest-neighbour index over pooled backbone embeddings ("find patches that look like this one").
+
+Embeddings are the pooled features of DoubleSwinTransformer / SwinTransformer.forward_features
+(return_all_features=False) or any backbone that returns a (B, D) tensor. They are L2 normalised
+and stored in float16. Queries go through an inverted file (IVF) index: a spherical k-means
+assigns every embedding to one of `num_lists` lists, and a query only scores the embeddings of
+its `num_probes` closest lists exactly (cosine similarity).
+
+Usage:
+    python embedding_index.py checkpoints/d-swin-epoch150.pth /ds2/remote_sensing/sen12ms \
+        --mode sen12ms --out sen12ms_index.npz
+"""
+
+import os
+import json
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+
+
+@torch.no_grad()
+def extract_embeddings(model, data_loader, device, modalities=("s1", "s2")):
+    """pooled, L2 normalised embeddings of all samples in data_loader and their dataset indices.
+    For double backbones (dict output, e.g. DoubleSwinTransformer) the embeddings of `modalities`
+    are concatenated, single backbones get the modalities concatenated along the channels"""
+    model.eval()
+
+    embeddings = []
+    indices = []
+    for sample in tqdm(data_loader, desc="Extracting embeddings"):
+        inputs = {m: sample[m].to(device, non_blocking=True) for m in modalities}
+        if hasattr(model, "backbone1"):
+            out = model(inputs)
+            z = torch.cat([out[m] for m in modalities], dim=1)
+        else:
+            x = torch.cat([inputs[m] for m in modalities], dim=1)
+            if hasattr(model, "forward_features"):
+                z = model.forward_features(x, return_all_features=False)
+            else:
+                z = model(x)
+
+        embeddings.append(F.normalize(z.float(), dim=1).half().cpu())
+        indices.append(sample["idx"].cpu())
+
+    return torch.cat(embeddings), torch.cat(indices).long()
+
+
+def spherical_kmeans(x, num_clusters, num_iters=20, max_samples=100000, seed=42):
+    """cluster centroids (unit length) of the normalised vectors x, fit on at most max_samples"""
+    generator = torch.Generator().manual_seed(seed)
+    if x.shape[0] > max_samples:
+        x = x[torch.randperm(x.shape[0], generator=generator)[:max_samples].to(x.device)]
+    x = x.float()
+
+    init = torch.randperm(x.shape[0], generator=generator)[:num_clusters].to(x.device)
+    centroids = x[init].clone()
+    for _ in range(num_iters):
+        assignments = (x @ centroids.T).argmax(dim=1)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, x)
+        counts = torch.bincount(assignments, minlength=num_clusters)
+
+        # empty clusters are re-seeded with random points
+        empty = counts == 0
+        if empty.any():
+            reseed = torch.randint(
+                x.shape[0], (int(empty.sum()),), generator=generator
+            ).to(x.device)
+            sums[empty] = x[reseed]
+        centroids = F.normalize(sums, dim=1)
+
+    return centroids
+
+
+class EmbeddingIndex(object):
+    """IVF index over normalised embeddings (cosine similarity).
+
+    Vectors are kept in insertion order in float16, the lists are a permutation of them
+    (sorted by list) with offsets that is rebuilt lazily after add()"""
+
+    def __init__(self, dim, num_lists=None, num_probes=8, device="cpu"):
+        self.dim = dim
+        self.num_lists = num_lists
+        self.num_probes = num_probes
+        self.device = torch.device(device)
+
+        self.centroids = None
+        self.vectors = torch.zeros((0, dim), dtype=torch.float16, device=self.device)
+        self.ids = torch.zeros(0, dtype=torch.long, device=self.device)
+        self.assignments = torch.zeros(0, dtype=torch.long, device=self.device)
+
+        self._order = None
+        self._offsets = None
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def train(self, x, num_iters=20, seed=42):
+        """fit the coarse quantiser, num_lists defaults to ~sqrt(N)"""
+        x = F.normalize(x.to(self.device).float(), dim=1)
+        if self.num_lists is None:
+            self.num_lists = max(1, int(np.sqrt(x.shape[0])))
+        self.centroids = spherical_kmeans(
+            x, min(self.num_lists, x.shape[0]), num_iters=num_iters, seed=seed
+        )
+        self.num_lists = self.centroids.shape[0]
+        # existing vectors have to be re-assigned to the new lists
+        if len(self) > 0:
+            self.assignments = self._assign(self.vectors)
+            self._order = None
+        return self
+
+    def _assign(self, x, batch_size=65536):
+        return torch.cat(
+            [
+                (x[i : i + batch_size].float() @ self.centroids.T).argmax(dim=1)
+                for i in range(0, x.shape[0], batch_size)
+            ]
+        )
+
+    def add(self, x, ids=None):
+        """add (N, dim) embeddings, ids default to their running position in the index"""
+        if not self.is_trained:
+            self.train(x)
+
+        x = F.normalize(x.to(self.device).float(), dim=1)
+        if ids is None:
+            ids = torch.arange(len(self), len(self) + x.shape[0])
+        ids = torch.as_tensor(ids, dtype=torch.long).to(self.device)
+
+        self.vectors = torch.cat([self.vectors, x.half()])
+        self.ids = torch.cat([self.ids, ids])
+        self.assignments = torch.cat([self.assignments, self._assign(x)])
+        self._order = None
+        return self
+
+    def _build_lists(self):
+        self._order = torch.argsort(self.assignments)
+        counts = torch.bincount(self.assignments, minlength=self.num_lists)
+        self._offsets = torch.cat(
+            [torch.zeros(1, dtype=torch.long, device=self.device), counts.cumsum(0)]
+        ).tolist()
+
+    @torch.no_grad()
+    def search(self, queries, k=10, num_probes=None):
+        """k nearest neighbours of every query: (scores, ids), both (Q, k), ids are -1
+        where the probed lists hold less than k vectors"""
+        if self._order is None:
+            self._build_lists()
+        num_probes = min(num_probes or self.num_probes, self.num_lists)
+
+        queries = F.normalize(queries.to(self.device).float().reshape(-1, self.dim), dim=1)
+        probes = (queries @ self.centroids.T).topk(num_probes, dim=1)[1].tolist()
+
+        scores = torch.full((queries.shape[0], k), -float("inf"), device=self.device)
+        ids = torch.full((queries.shape[0], k), -1, dtype=torch.long, device=self.device)
+        for q, lists in enumerate(probes):
+            candidates = torch.cat(
+                [self._order[self._offsets[l] : self._offsets[l + 1]] for l in lists]
+            )
+            if candidates.numel() == 0:
+                continue
+            similarities = self.vectors[candidates].float() @ queries[q]
+            top_scores, top = similarities.topk(min(k, candidates.numel()))
+            scores[q, : top.numel()] = top_scores
+            ids[q, : top.numel()] = self.ids[candidates[top]]
+
+        return scores, ids
+
+    def save(self, path):
+        np.savez(
+            path,
+            dim=self.dim,
+            num_probes=self.num_probes,
+            centroids=self.centroids.cpu().numpy(),
+            vectors=self.vectors.cpu().numpy(),
+            ids=self.ids.cpu().numpy(),
+            assignments=self.assignments.cpu().numpy(),
+        )
+
+    @classmethod
+    def load(cls, path, device="cpu"):
+        data = np.load(path)
+        index = cls(
+            int(data["dim"]),
+            num_lists=data["centroids"].shape[0],
+            num_probes=int(data["num_probes"]),
+            device=device,
+        )
+        index.centroids = torch.from_numpy(data["centroids"]).to(index.device)
+        index.vectors = torch.from_numpy(data["vectors"]).to(index.device)
+        index.ids = torch.from_numpy(data["ids"]).to(index.device)
+        index.assignments = torch.from_numpy(data["assignments"]).to(index.device)
+        return index
+
+
+def load_double_swin(checkpoint_path, config_path="configs/backbone_config.json", device="cpu"):
+    """DoubleSwinTransformer with the backbones of a trained D-Swin checkpoint"""
+    from utils import dotdictify
+    from Transformer_SSL.models import build_model
+    from Transformer_SSL.models.swin_transformer import DoubleSwinTransformer
+
+    with open(config_path, "r") as fp:
+        swin_conf = dotdictify(json.load(fp))
+
+    swin_conf.model_config.MODEL.SWIN.IN_CHANS = swin_conf.s1_input_channels
+    s1_backbone = build_model(swin_conf.model_config)
+    swin_conf.model_config.MODEL.SWIN.IN_CHANS = swin_conf.s2_input_channels
+    s2_backbone = build_model(swin_conf.model_config)
+
+    weights = torch.load(checkpoint_path, map_location=torch.device("cpu"))["state_dict"]
+    s1_backbone.load_state_dict(
+        {k[len("backbone1.") :]: v for k, v in weights.items() if "backbone1" in k}
+    )
+    s2_backbone.load_state_dict(
+        {k[len("backbone2.") :]: v for k, v in weights.items() if "backbone2" in k}
+    )
+
+    return DoubleSwinTransformer(s1_backbone, s2_backbone).to(device), swin_conf
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="build an embedding index of a split")
+    parser.add_argument("checkpoint", type=str)
+    parser.add_argument("base_dir", type=str)
+    parser.add_argument(
+        "--mode",
+        default="sen12ms",
+        choices=["dfc", "sen12ms", "test", "validation"],
+        type=str,
+    )
+    parser.add_argument("--config", default="configs/backbone_config.json", type=str)
+    parser.add_argument("--num_lists", default=None, type=int)
+    parser.add_argument("--num_probes", default=8, type=int)
+    parser.add_argument("--batch_size", default=100, type=int)
+    parser.add_argument("--num_workers", default=8, type=int)
+    parser.add_argument("--out", default=None, type=str)
+    args = parser.parse_args()
+
+    from dfc_dataset import DFCDataset
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model, swin_conf = load_double_swin(args.checkpoint, args.config, device)
+
+    dataset = DFCDataset(
+        args.base_dir,
+        mode=args.mode,
+        clip_sample_values=True,
+        image_px_size=swin_conf.image_px_size,
+        normalize=True,
+    )
+    data_loader = torch.utils.data.DataLoader(
+        dataset,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        pin_memory=True,
+    )
+
+    embeddings, indices = extract_embeddings(model, data_loader, device)
+    index = EmbeddingIndex(
+        embeddings.shape[1], num_lists=args.num_lists, num_probes=args.num_probes, device=device
+    )
+    index.add(embeddings, ids=indices)
+
+    out = args.out or os.path.join(args.base_dir, args.mode + "_embedding_index.npz")
+    index.save(out)
+    print(f"{len(index)} embeddings in {index.num_lists} lists written to {out}")
@@ -0,0 +1,112 @@
+"""Experiment logging backends of the training entry points, selected with --logger
+(train_evaluation.py) or "logger" (configs/backbone_config.json):
+
+- wandb: Weights & Biases, as before. Needs the network unless WANDB_MODE=offline is set,
+  no wandb.login() is done, a stored API key or WANDB_API_KEY is used as is
+- tensorboard: TensorBoard event files in <log_dir>/<project>/<run name>
+- jsonl: one json line per log call in <log_dir>/<project>/<run name>/metrics.jsonl
+- none: nothing is logged (e.g. non-zero DDP ranks)
+
+Only the selected backend is imported. All of them expose .name, .id, .dir and .config of
+the run, log(stats, step) and finish(). tensorboard and jsonl also write config.json to the
+run directory. Passing the .id of an earlier run continues it: the same wandb run (resumed
+with resume="must") or the same run directory.
+"""
+
+import os
+import json
+import time
+
+from utils import dotdictify
+
+LOGGERS = ["wandb", "tensorboard", "jsonl", "none"]
+
+
+def _run_name():
+    return time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}"
+
+
+class NullLogger(object):
+    def __init__(self, project, config, log_dir="runs", run_id=None):
+        self.name = _run_name() if run_id is None else run_id
+        self.id = self.name
+        self.dir = os.path.join(log_dir, project, self.name)
+        self.config = dotdictify(dict(config))
+
+    def log(self, stats, step=None):
+        pass
+
+    def finish(self):
+        pass
+
+
+class JSONLLogger(NullLogger):
+    def __init__(self, project, config, log_dir="runs", run_id=None):
+        super().__init__(project, config, log_dir=log_dir, run_id=run_id)
+        os.makedirs(self.dir, exist_ok=True)
+        with open(os.path.join(self.dir, "config.json"), "w") as f:
+            json.dump(self.config, f, indent=2, default=str)
+        self.file = open(os.path.join(self.dir, "metrics.jsonl"), "a")
+
+    def log(self, stats, step=None):
+        self.file.write(
+            json.dumps({"step": step, "time": time.time(), **stats}, default=float) + "\n"
+        )
+        self.file.flush()
+
+    def finish(self):
+        self.file.close()
+
+
+class TensorBoardLogger(NullLogger):
+    def __init__(self, project, config, log_dir="runs", run_id=None):
+        super().__init__(project, config, log_dir=log_dir, run_id=run_id)
+        from torch.utils.tensorboard import SummaryWriter
+
+        self.writer = SummaryWriter(self.dir)
+        with open(os.path.join(self.dir, "config.json"), "w") as f:
+            json.dump(self.config, f, indent=2, default=str)
+
+    def log(self, stats, step=None):
+        for name, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.writer.add_scalar(name, value, global_step=step)
+
+    def finish(self):
+        self.writer.close()
+
+
+class WandbLogger(object):
+    def __init__(self, project, config, run_id=None):
+        import wandb
+
+        self.wandb = wandb
+        if run_id is None:
+            self.run = wandb.init(project=project, config=config)
+        else:
+            self.run = wandb.init(project=project, config=config, id=run_id, resume="must")
+        # sweeps may override values of the config
+        self.config = wandb.config
+        self.name = self.run.name
+        self.id = self.run.id
+        self.dir = self.run.dir
+
+    def log(self, stats, step=None):
+        self.wandb.log(stats, step=step)
+
+    def finish(self):
+        self.run.finish()
+
+
+def build_logger(backend, project, config, log_dir="runs", enabled=True, run_id=None):
+    """logger of the given backend, a NullLogger if not enabled (e.g. non-zero ranks).
+    run_id (the .id of an earlier run) continues that run"""
+    if backend not in LOGGERS:
+        raise ValueError(f"Unsupported logger {backend}, must be in {LOGGERS}")
+    if not enabled or backend == "none":
+        return NullLogger(project, config, log_dir=log_dir)
+    if backend == "wandb":
+        return WandbLogger(project, config, run_id=run_id)
+    if backend == "tensorboard":
+        return TensorBoardLogger(project, config, log_dir=log_dir, run_id=run_id)
+    return JSONLLogger(project, config, log_dir=log_dir, run_id=run_id)
@@ -1,90 +1,159 @@
 import numpy as np
-from collections import defaultdict
+import torch
+import torch.distributed as dist
 
 
-class ClasswiseAccuracy(object):
-    def __init__(self, num_classes):
+class ConfusionMatrix(object):
+    """Confusion matrix (rows: true class, columns: predicted class) that is
+    accumulated on the device of the incoming batches with torch.bincount.
+    Labels outside of [0, num_classes), e.g. the ignore_index 255, are not counted."""
+
+    def __init__(self, num_classes, device=None):
         self.num_classes = num_classes
-        self.tp_per_class = defaultdict(int)
-        self.count_per_class = defaultdict(int)
-        self.count = 0
-        self.tp = 0
+        self.matrix = torch.zeros(
+            (num_classes, num_classes), dtype=torch.long, device=device
+        )
 
     def add_batch(self, y, y_hat):
-        for true, pred in zip(y, y_hat):
-            self.count_per_class["class_" + str(true.item())] += 1
-            self.count += 1
-            if true == pred:
-                self.tp_per_class["class_" + str(true.item())] += 1
-                self.tp += 1
+        y = y.flatten().long()
+        y_hat = y_hat.flatten().long().to(y.device)
+        if self.matrix.device != y.device:
+            self.matrix = self.matrix.to(y.device)
+
+        n = self.num_classes
+        valid = (y >= 0) & (y < n) & (y_hat >= 0) & (y_hat < n)
+        # invalid entries go to an overflow bin instead of a boolean gather (no device sync)
+        bins = torch.where(valid, y * n + y_hat, torch.full_like(y, n * n))
+        counts = torch.bincount(bins, minlength=n * n + 1)[: n * n]
+        self.matrix += counts.view(n, n)
+
+    def all_reduce(self):
+        """sum the confusion matrices of all ranks"""
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(self.matrix)
+        return self
+
+    def state_dict(self):
+        return {"matrix": self.matrix.cpu()}
+
+    def load_state_dict(self, state):
+        self.matrix = state["matrix"].to(self.matrix.device)
+
+    def get_matrix(self):
+        return self.matrix.cpu().numpy()
+
+    def _class_stats(self):
+        matrix = self.get_matrix().astype(np.float64)
+        tp = np.diag(matrix)
+        count = matrix.sum(axis=1)  # number of true samples/pixels per class
+        predicted = matrix.sum(axis=0)
+        return tp, count, predicted
+
+    def get_iou(self):
+        """intersection over union for every class that occurs in labels or predictions"""
+        tp, count, predicted = self._class_stats()
+        union = count + predicted - tp
+        return {
+            "class_" + str(i): tp[i] / union[i]
+            for i in range(self.num_classes)
+            if union[i] > 0
+        }
+
+    def get_miou(self):
+        return np.mean(list(self.get_iou().values()))
+
+
+class ClasswiseAccuracy(ConfusionMatrix):
+    def __init__(self, num_classes, device=None):
+        super(ClasswiseAccuracy, self).__init__(num_classes, device=device)
 
     def get_classwise_accuracy(self):
-        return {k: self.tp_per_class[k] / count for k, count in self.count_per_class.items()}
+        tp, count, _ = self._class_stats()
+        return {
+            "class_" + str(i): tp[i] / count[i]
+            for i in range(self.num_classes)
+            if count[i] > 0
+        }
 
     def get_average_accuracy(self):
         cw_acc = self.get_classwise_accuracy()
         return np.mean(list(cw_acc.values()))
 
     def get_overall_accuracy(self):
-        return self.tp / self.count
+        tp, count, _ = self._class_stats()
+        return tp.sum() / count.sum()
 
 
 class ClasswiseMultilabelMetrics(object):
-    def __init__(self, num_classes, prefix="class_"):
+    def __init__(self, num_classes, prefix="class_", device=None):
         self.num_classes = num_classes
         self.prefix = prefix
-        self.data = {prefix + str(i): {"tp": 0, "tn": 0, "fp": 0, "fn": 0} for i in range(num_classes)}  # holds the classwise tp,tn,fp,fn
 
-        # hold the overall tp,tn,fp,fn
-        self.num_tp = 0
-        self.num_fp = 0
-        self.num_tn = 0
-        self.num_fn = 0
+        # classwise tp,tn,fp,fn, the overall numbers are their sums
+        self.counts = torch.zeros((4, num_classes), dtype=torch.long, device=device)
 
     def add_batch(self, y_batch, y_hat_batch):
-        for y, y_hat in zip(y_batch, y_hat_batch):
-            for i in range(self.num_classes):
-                class_data = self.data[self.prefix + str(i)]
-                if y_hat[i] == y[i]:
-                    # true-x
-                    if y_hat[i]:
-                        class_data["tp"] += 1
-                        self.num_tp += 1
-                    else:
-                        class_data["tn"] += 1
-                        self.num_tn += 1
-                else:
-                    # false-x
-                    if y_hat[i]:
-                        class_data["fp"] += 1
-                        self.num_fp += 1
-                    else:
-                        class_data["fn"] += 1
-                        self.num_fn += 1
+        y = y_batch.bool()
+        y_hat = y_hat_batch.bool().to(y.device)
+        if self.counts.device != y.device:
+            self.counts = self.counts.to(y.device)
+
+        self.counts += torch.stack(
+            [
+                (y & y_hat).sum(dim=0),  # tp
+                (~y & ~y_hat).sum(dim=0),  # tn
+                (~y & y_hat).sum(dim=0),  # fp
+                (y & ~y_hat).sum(dim=0),  # fn
+            ]
+        )
+
+    def all_reduce(self):
+        """sum the counts of all ranks"""
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(self.counts)
+        return self
+
+    def state_dict(self):
+        return {"counts": self.counts.cpu()}
+
+    def load_state_dict(self, state):
+        self.counts = state["counts"].to(self.counts.device)
+
+    def _get_counts(self):
+        tp, tn, fp, fn = self.counts.cpu().numpy().astype(np.float64)
+        return tp, tn, fp, fn
+
+    @property
+    def num_tp(self):
+        return int(self._get_counts()[0].sum())
+
+    @property
+    def num_tn(self):
+        return int(self._get_counts()[1].sum())
+
+    @property
+    def num_fp(self):
+        return int(self._get_counts()[2].sum())
+
+    @property
+    def num_fn(self):
+        return int(self._get_counts()[3].sum())
 
     def get_classwise_precision(self):
         # tp / (tp + fp)
-        out = {}
-        for i in range(self.num_classes):
-            class_data = self.data[self.prefix + str(i)]
-            if class_data["tp"] == 0:
-                out[self.prefix + str(i)] = 0
-            else:
-                out[self.prefix + str(i)] = class_data["tp"] / (class_data["tp"] + class_data["fp"])
-
-        return out
+        tp, _, fp, _ = self._get_counts()
+        return {
+            self.prefix + str(i): 0 if tp[i] == 0 else tp[i] / (tp[i] + fp[i])
+            for i in range(self.num_classes)
+        }
 
     def get_classwise_recall(self):
         # tp / (tp + fn)
-        out = {}
-        for i in range(self.num_classes):
-            class_data = self.data[self.prefix + str(i)]
-            if class_data["tp"] == 0:
-                out[self.prefix + str(i)] = 0
-            else:
-                out[self.prefix + str(i)] = class_data["tp"] / (class_data["tp"] + class_data["fn"])
-
-        return out
+        tp, _, _, fn = self._get_counts()
+        return {
+            self.prefix + str(i): 0 if tp[i] == 0 else tp[i] / (tp[i] + fn[i])
+            for i in range(self.num_classes)
+        }
 
     def get_classwise_f1(self):
         # 2 * (precision * recall) / (precision + recall)
@@ -120,17 +189,19 @@ class ClasswiseMultilabelMetrics(object):
 
     def get_overall_precision(self):
         # tp / (tp + fp)
-        if self.num_tp == 0:
+        num_tp, num_fp = self.num_tp, self.num_fp
+        if num_tp == 0:
             return 0
         else:
-            return self.num_tp / (self.num_tp + self.num_fp)
+            return num_tp / (num_tp + num_fp)
 
     def get_overall_recall(self):
         # tp / (tp + fn)
-        if self.num_tp == 0:
+        num_tp, num_fn = self.num_tp, self.num_fn
+        if num_tp == 0:
             return 0
         else:
-            return self.num_tp / (self.num_tp + self.num_fn)
+            return num_tp / (num_tp + num_fn)
 
     def get_overall_f1(self):
         # 2 * (precision * recall) / (precision + recall)
@@ -143,27 +214,25 @@ class ClasswiseMultilabelMetrics(object):
             return 2 * (precision * recall) / (precision + recall)
 
 
-class PixelwiseMetrics(object):
-    def __init__(self, num_classes):
-        self.num_classes = num_classes
-        self.count = 0
+class PixelwiseMetrics(ConfusionMatrix):
+    """pixel accuracy per class from the pixel counts accumulated over all batches
+    (not the mean of per-batch ratios, which over-weights batches with few pixels of a class)"""
 
-        self.data = {"pixelclass_" + str(i): {"acc": 0} for i in range(num_classes)}
-
-    def add_batch(self, y, y_hat):
-        self.count += 1
-
-        for c in range(self.num_classes):
-            class_data = self.data["pixelclass_" + str(c)]
-            preds_c = y_hat == c
-            targs_c = y == c
-            num_correct = (preds_c * targs_c).sum().cpu().detach().numpy()
-            num_pixels = np.sum(targs_c.cpu().detach().numpy())
-            class_data["acc"] += num_correct / num_pixels
+    def __init__(self, num_classes, device=None):
+        super(PixelwiseMetrics, self).__init__(num_classes, device=device)
 
     def get_classwise_accuracy(self):
-        return {k: el['acc'] / self.count for k, el in self.data.items()}
+        tp, count, _ = self._class_stats()
+        return {
+            "pixelclass_" + str(i): tp[i] / count[i]
+            for i in range(self.num_classes)
+            if count[i] > 0
+        }
 
     def get_average_accuracy(self):
         cw_acc = self.get_classwise_accuracy()
         return np.mean(list(cw_acc.values()))
+
+    def get_overall_accuracy(self):
+        tp, count, _ = self._class_stats()
+        return tp.sum() / count.sum()
@@ -0,0 +1,199 @@
+"""Several downstream targets on one backbone pass (train_evaluation.py --targets).
+
+Every target gets its own head, loss and metrics, and all of them are trained and
+validated in one run, on one read of the data and one backbone forward pass per batch:
+- dfc_label: single-label classification, linear head, cross entropy
+- dfc_multilabel_one_hot: multi-label classification, linear head, BCE on sigmoid outputs
+- dfc: pixel classification, the Swin decoders of DoubleSwinTransformerSegmentation
+  (swin-t and dual-swin-baseline models only)
+
+The backbone is trained or frozen per head as in the single-target runs: the swin-t
+backbones are frozen for the classification heads unless finetuning, but trained by the
+dfc decoders. The gradients of frozen heads are stopped at the features, but with dfc the
+classification heads see the features of a backbone that the dfc loss trains, unlike in a
+single-target run with a frozen backbone.
+
+The classification heads replace the final linear layer of the model built for --model.
+The training loss is the sum of the target losses. Statistics are reported per target as
+<split>_<target>_<statistic>, next to <split>_loss, the summed loss.
+
+Usage:
+    python train_evaluation.py --model=DoubleSwinTransformerDownstream \\
+        --checkpoint=checkpoints/d-swin-ruby-meadow-21-epoch299.pth \\
+        --targets dfc_label dfc_multilabel_one_hot dfc
+"""
+
+import functools
+
+import torch
+import torch.nn.functional as F
+
+from metrics import ClasswiseAccuracy, ClasswiseMultilabelMetrics, PixelwiseMetrics
+
+TARGET_NAMES = {
+    "dfc_label": "single-classification",
+    "dfc_multilabel_one_hot": "multi-classification",
+    "dfc": "pixel-classification",
+}
+# attribute paths of the final linear layer of the supported models
+HEAD_MODULES = ["fc", "head", "backbone.fc"]
+
+
+class Task(object):
+    """loss, predictions, metrics and statistics of one target"""
+
+    def __init__(self, target, num_classes, device):
+        self.target = target
+        self.target_name = TARGET_NAMES[target]
+        self.num_classes = num_classes
+
+        # ignore label 255 (dataset class sets labels 3,8 (savanna, ice) for lr lc map to 255)
+        if self.target_name == "multi-classification":
+            self.criterion = torch.nn.BCELoss(reduction="mean").to(device)
+        else:
+            self.criterion = torch.nn.CrossEntropyLoss(ignore_index=255).to(device)
+
+    def get_labels(self, sample, device):
+        y = sample[self.target]
+        if self.target_name == "single-classification":
+            return y.long().to(device)
+        elif self.target_name == "multi-classification":
+            return y.to(device)
+        return y.squeeze().long().to(device)
+
+    def loss_and_prediction(self, y_hat, y):
+        if self.target_name == "multi-classification":
+            y_hat = torch.sigmoid(y_hat)
+            return self.criterion(y_hat, y), y_hat.round()
+        loss = self.criterion(y_hat, y)
+        if self.target_name == "single-classification":
+            return loss, torch.argmax(y_hat, dim=1)
+        return loss, torch.argmax(F.softmax(y_hat, dim=1), dim=1)
+
+    def make_metrics(self):
+        if self.target_name == "single-classification":
+            return ClasswiseAccuracy(self.num_classes)
+        elif self.target_name == "multi-classification":
+            return ClasswiseMultilabelMetrics(self.num_classes)
+        return PixelwiseMetrics(self.num_classes)
+
+    def get_stats(self, split, mean_loss, metrics):
+        """the statistics of train_evaluation.py, as <split>_<target>_<statistic>"""
+        if self.target_name == "multi-classification":
+            stats = {
+                "loss": mean_loss,
+                "average_f1": metrics.get_average_f1(),
+                "overall_f1": metrics.get_overall_f1(),
+                "average_recall": metrics.get_average_recall(),
+                "overall_recall": metrics.get_overall_recall(),
+                "average_precision": metrics.get_average_precision(),
+                "overall_precision": metrics.get_overall_precision(),
+                **{"f1_" + k: v for k, v in metrics.get_classwise_f1().items()},
+            }
+        else:
+            stats = {
+                "loss": mean_loss,
+                "average_accuracy": metrics.get_average_accuracy(),
+                "overall_accuracy": metrics.get_overall_accuracy(),
+                **{"accuracy_" + k: v for k, v in metrics.get_classwise_accuracy().items()},
+            }
+            if self.target_name == "pixel-classification":
+                stats["miou"] = metrics.get_miou()
+        return {f"{split}_{self.target}_{k}": v for k, v in stats.items()}
+
+
+class MultiTaskMetrics(object):
+    """the metrics of all tasks, with the state_dict interface of the single metrics"""
+
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self.metrics = {task.target: task.make_metrics() for task in tasks}
+
+    def add_batch(self, ys, preds):
+        for target, metrics in self.metrics.items():
+            metrics.add_batch(ys[target], preds[target])
+
+    def get_stats(self, split, mean_losses):
+        stats = {f"{split}_loss": sum(mean_losses.values())}
+        for task in self.tasks:
+            stats.update(
+                task.get_stats(split, mean_losses[task.target], self.metrics[task.target])
+            )
+        return stats
+
+    def state_dict(self):
+        return {target: metrics.state_dict() for target, metrics in self.metrics.items()}
+
+    def load_state_dict(self, state):
+        for target, metrics in self.metrics.items():
+            metrics.load_state_dict(state[target])
+
+
+def multi_task_loss(tasks, outputs, ys):
+    """summed loss, {target: loss} and {target: prediction} of the outputs of one forward pass"""
+    losses, preds = {}, {}
+    for task in tasks:
+        losses[task.target], preds[task.target] = task.loss_and_prediction(
+            outputs[task.target], ys[task.target]
+        )
+    return sum(losses.values()), losses, preds
+
+
+class MultiHeadModel(torch.nn.Module):
+    """a classification model whose final linear layer is replaced by one linear head per
+    target, all of them on the same features"""
+
+    def __init__(self, model, targets, num_classes):
+        super(MultiHeadModel, self).__init__()
+        head_module = _find_head_module(model)
+        parent, _, name = head_module.rpartition(".")
+        parent = functools.reduce(getattr, parent.split("."), model) if parent else model
+        in_features = getattr(parent, name).in_features
+        setattr(parent, name, torch.nn.Identity())
+
+        self.model = model
+        self.heads = torch.nn.ModuleDict(
+            {target: torch.nn.Linear(in_features, num_classes) for target in targets}
+        )
+
+    def forward(self, x):
+        features = self.model(x)
+        return {target: head(features) for target, head in self.heads.items()}
+
+
+def _find_head_module(model):
+    for path in HEAD_MODULES:
+        try:
+            module = functools.reduce(getattr, path.split("."), model)
+        except AttributeError:
+            continue
+        if isinstance(module, torch.nn.Linear):
+            return path
+    raise ValueError(f"No final linear layer ({', '.join(HEAD_MODULES)}) in {type(model).__name__}")
+
+
+def build_multi_head_model(model, model_name, targets, num_classes, device, finetuning=False):
+    """heads for all targets on the model built for --model (with its classification head)"""
+    unknown = [target for target in targets if target not in TARGET_NAMES]
+    if unknown:
+        raise ValueError(f"Unsupported targets {unknown}, must be in {list(TARGET_NAMES)}")
+    if "dfc" not in targets:
+        return MultiHeadModel(model, targets, num_classes)
+
+    if model_name not in ["swin-t", "dual-swin-baseline"]:
+        raise ValueError(f"Pixel classification (dfc) is not supported for {model_name}")
+    from Transformer_SSL.models.swin_transformer import DoubleSwinTransformerMultiHead
+
+    return DoubleSwinTransformerMultiHead(
+        model.backbone1,
+        model.backbone2,
+        {target: num_classes for target in targets if target != "dfc"},
+        device,
+        seg_out_dim=num_classes,
+        seg_name="dfc",
+        # as the single-target runs: DoubleSwinTransformerDownstream freezes the swin-t
+        # backbones unless finetuning, DoubleSwinTransformerSegmentation and the baseline
+        # train them
+        freeze_fc_backbone=model_name == "swin-t" and not finetuning,
+        freeze_seg_backbone=False,
+    )
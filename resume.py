@@ -0,0 +1,183 @@
+"""Exact resume of preempted train_evaluation.py runs.
+
+The resume state has the layout of utils.save_checkpoint_single_model (model_weights,
+optim_state, val_stats, epochs), plus
+- step, and batch_idx: the training batches of epoch `epochs` already consumed,
+- rng_states: python, numpy, torch and cuda generators of the main process,
+- loss_stats and metrics: the accumulators of the running epoch,
+- checkpoint_prefix and logger_id: the prefix of the run's checkpoints and the id of its
+  logger run (the wandb run id), so that a restarted run continues the same checkpoint
+  manifest and retention, and the same wandb run.
+The learning rate schedule position is part of optim_state (the lr of the param groups).
+
+The order of the training samples is a function of (seed, epoch) only: EpochRandomSampler
+replaces shuffle=True, ClassBalancedSampler already works that way. ResumableSampler skips
+the consumed positions of the order without loading them, and gives every position its own
+seed, with which SeededDataset loads the sample. Random crops and transforms in the loader
+workers therefore do not depend on the number of workers or on where a run was resumed.
+
+It is only written with --resume, at the end of every epoch and, with
+--resume_every_n_steps, every that many batches. The writer thread of the run's
+checkpointing.CheckpointManager writes it, so the training loop only waits for the CPU
+copies. As in the head-only checkpoints, the frozen backbone is not part of the file, but
+referenced in <checkpoint_dir>. The state is read from the --resume file if it exists and
+written back to it, so the same command starts a run and continues it after preemption:
+    python train_evaluation.py ... --resume checkpoints/my-run-resume.pth
+"""
+
+import os
+import random
+import itertools
+
+import numpy as np
+import torch
+
+from checkpointing import merge_backbone
+
+
+def get_rng_states():
+    states = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        states["cuda"] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states):
+    random.setstate(states["python"])
+    np.random.set_state(states["numpy"])
+    torch.set_rng_state(states["torch"])
+    if "cuda" in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states["cuda"])
+
+
+def sample_seed(seed, epoch, position):
+    """seed of the sample at `position` of the order of `epoch`"""
+    return int(np.random.SeedSequence([seed, epoch, position]).generate_state(1)[0])
+
+
+class EpochRandomSampler(torch.utils.data.Sampler):
+    """random permutation of the dataset, seeded by seed + epoch. Call set_epoch every epoch"""
+
+    def __init__(self, data_source, seed=0):
+        self.num_samples = len(data_source)
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        return iter(torch.randperm(self.num_samples, generator=g).tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    """(index, seed) pairs of a sampler whose order only depends on its epoch, from
+    start_index on. start_index applies to the next iteration only"""
+
+    def __init__(self, sampler, seed=0):
+        self.sampler = sampler
+        self.seed = seed
+        self.epoch = 0
+        self.start_index = 0
+
+    def __iter__(self):
+        start_index, self.start_index = self.start_index, 0
+        positions = itertools.islice(enumerate(self.sampler), start_index, None)
+        return (
+            (index, sample_seed(self.seed, self.epoch, position))
+            for position, index in positions
+        )
+
+    def __len__(self):
+        return len(self.sampler) - self.start_index
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.sampler.set_epoch(epoch)
+
+    def set_start_index(self, start_index):
+        self.start_index = start_index
+
+
+class SeededDataset(torch.utils.data.Dataset):
+    """loads dataset[index] for the (index, seed) pairs of ResumableSampler with the python,
+    numpy and torch generators seeded by seed. In the main process (num_workers=0) their
+    states are restored afterwards, so the training loop is not affected"""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, item):
+        index, seed = item
+        in_worker = torch.utils.data.get_worker_info() is not None
+        states = None if in_worker else get_rng_states()
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        try:
+            return self.dataset[index]
+        finally:
+            if states is not None:
+                set_rng_states(states)
+
+
+def save_resume_state(
+    checkpoints,
+    path,
+    model,
+    optimizer,
+    val_stats,
+    epoch,
+    batch_idx,
+    step,
+    loss_stats,
+    metrics,
+    logger_id=None,
+):
+    """queues the state on checkpoints (a CheckpointManager). batch_idx training batches of
+    epoch are done, batch_idx 0 at the start of an epoch"""
+    checkpoints.save_state(
+        path,
+        model,
+        optim_state=optimizer.state_dict(),
+        val_stats=val_stats,
+        epochs=epoch,
+        step=step,
+        batch_idx=batch_idx,
+        rng_states=get_rng_states(),
+        loss_stats=None if loss_stats is None else loss_stats.state_dict(),
+        metrics=None if metrics is None else metrics.state_dict(),
+        checkpoint_prefix=checkpoints.prefix,
+        logger_id=logger_id,
+    )
+
+
+def read_resume_state(path):
+    """the resume state at path, None if there is none (yet)"""
+    if path is None or not os.path.exists(path):
+        return None
+    return torch.load(path, map_location="cpu", weights_only=False)
+
+
+def load_resume_state(path, model, optimizer, state=None):
+    """restores model and optimizer, returns the state for the training loop. The rng
+    states are restored with set_rng_states once the run is set up. state is the file
+    already read with read_resume_state"""
+    if state is None:
+        state = read_resume_state(path)
+    model.load_state_dict(merge_backbone(state["model_weights"], os.path.dirname(path)))
+    optimizer.load_state_dict(state["optim_state"])
+    print(f"==> Resuming from {path}: epoch {state['epochs']}, batch {state['batch_idx']}")
+    return state
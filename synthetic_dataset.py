@@ -0,0 +1,260 @@
+"""Writes a synthetic SEN12MS / DFC2020 dataset with the directory layout, file names, band
+counts, dtypes and CRS of the real data, plus the observation csvs that DFCDataset reads.
+
+    <base_dir>/<season>/<sensor>_<scene>/<season>_<sensor>_<scene>_p<id>.tif
+
+- s1: 2 bands (VV, VH), float32 backscatter in dB
+- s2: 13 bands, uint16 reflectances (0-10000)
+- lc: 4 bands, uint8, IGBP classes in band 1 (remapped to DFC classes by get_patch)
+- dfc: 1 band, uint8 DFC classes (not written for the sen12ms mode, as in the real data)
+
+All patches are 256 x 256 pixels at 10m in the UTM zone (EPSG:326xx) of their scene. The
+label maps consist of a dominant DFC class and a few rectangles of other classes, drawn
+from --class_weights, and the S1/S2 values depend on the class so that the labels can be
+learned. --nan_fraction of the S1 patches get a block of NaNs, like the known broken scenes
+of SEN12MS (see dataset_scan.py).
+
+Per mode <mode>_observations.csv and <mode>_observations_balanced_classes.csv (minority
+classes repeated up to the size of the largest class) are written next to the seasons.
+
+Usage:
+    python synthetic_dataset.py /tmp/synthetic-sen12ms --modes sen12ms validation \\
+        --scenes_per_season 4 --patches_per_scene 64 --nan_fraction 0.01 --num_workers 8
+"""
+
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+from tqdm import tqdm
+
+from dfc_sen12ms_dataset import Seasons, IGBP2DFC
+
+MODE_SEASONS = {
+    "dfc": [Seasons.AUTUMN_DFC, Seasons.SPRING_DFC, Seasons.SUMMER_DFC, Seasons.WINTER_DFC],
+    "test": [Seasons.TESTSET],
+    "validation": [Seasons.VALSET],
+    "sen12ms": [Seasons.SPRING, Seasons.SUMMER, Seasons.FALL, Seasons.WINTER],
+}
+
+PATCH_SIZE = 256
+RESOLUTION = 10
+NUM_DFC_CLASSES = 10
+# one IGBP class per DFC class (1-10), IGBP2DFC maps them back
+DFC2IGBP = np.array([0, 1, 6, 8, 10, 11, 12, 13, 15, 16, 17], dtype=np.uint8)
+assert (IGBP2DFC[DFC2IGBP] == np.arange(NUM_DFC_CLASSES + 1)).all()
+
+
+def make_label_map(rng, class_probs, max_regions=3):
+    """(256, 256) map of DFC classes 1-10, a dominant class and up to max_regions rectangles"""
+    classes = rng.choice(NUM_DFC_CLASSES, size=max_regions + 1, p=class_probs) + 1
+    label_map = np.full((PATCH_SIZE, PATCH_SIZE), classes[0], dtype=np.uint8)
+    for region_class in classes[1 : 1 + rng.integers(0, max_regions + 1)]:
+        h, w = rng.integers(32, PATCH_SIZE // 2 + 32, size=2)
+        y, x = rng.integers(0, PATCH_SIZE - h), rng.integers(0, PATCH_SIZE - w)
+        label_map[y : y + h, x : x + w] = region_class
+    return label_map
+
+
+def make_s1(rng, label_map, nan):
+    """class dependent VV/VH backscatter in dB"""
+    vv = -20.0 + 1.2 * label_map + rng.normal(0, 1.5, label_map.shape)
+    vh = vv - 7.0 + rng.normal(0, 1.0, label_map.shape)
+    s1 = np.stack([vv, vh]).astype(np.float32)
+    if nan:
+        h, w = rng.integers(8, PATCH_SIZE // 2, size=2)
+        y, x = rng.integers(0, PATCH_SIZE - h), rng.integers(0, PATCH_SIZE - w)
+        s1[:, y : y + h, x : x + w] = np.nan
+    return s1
+
+
+def make_s2(rng, label_map):
+    """class and band dependent reflectances, uint16 in [0, 10000]"""
+    bands = np.arange(13)[:, None, None]
+    base = 400.0 + 250.0 * ((label_map[None] * 7 + bands * 3) % 11)
+    s2 = base + rng.normal(0, 150, (13,) + label_map.shape)
+    return np.clip(s2, 0, 10000).astype(np.uint16)
+
+
+def _write_tif(path, data, crs, transform):
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=PATCH_SIZE,
+        height=PATCH_SIZE,
+        count=data.shape[0],
+        dtype=data.dtype,
+        crs=crs,
+        transform=transform,
+    ) as f:
+        f.write(data)
+
+
+def _write_scene(args):
+    base_dir, season, scene, patch_ids, class_probs, nan_fraction, include_dfc, seed = args
+    rng = np.random.default_rng(seed)
+
+    # every scene lies in one UTM zone, its patches overlap by half like in SEN12MS
+    crs = CRS.from_epsg(32600 + int(rng.integers(1, 61)))
+    west, north = rng.uniform(2e5, 7e5), rng.uniform(1e6, 9e6)
+    stride = PATCH_SIZE // 2 * RESOLUTION
+    patches_per_row = int(np.ceil(np.sqrt(len(patch_ids))))
+
+    for sensor in ["s1", "s2", "lc"] + (["dfc"] if include_dfc else []):
+        os.makedirs(os.path.join(base_dir, season.value, f"{sensor}_{scene}"), exist_ok=True)
+
+    rows = []
+    for i, patch_id in enumerate(patch_ids):
+        transform = from_origin(
+            west + (i % patches_per_row) * stride,
+            north - (i // patches_per_row) * stride,
+            RESOLUTION,
+            RESOLUTION,
+        )
+        dfc = make_label_map(rng, class_probs)
+        igbp = DFC2IGBP[dfc]
+        lc = np.stack([igbp] + [np.zeros_like(igbp)] * 3)  # IGBP, LCCS_LC, LCCS_LU, LCCS_SH
+        patches = {
+            "s1": make_s1(rng, dfc, rng.random() < nan_fraction),
+            "s2": make_s2(rng, dfc),
+            "lc": lc,
+        }
+        if include_dfc:
+            patches["dfc"] = dfc[None]
+
+        for sensor, data in patches.items():
+            path = os.path.join(
+                base_dir,
+                season.value,
+                f"{sensor}_{scene}",
+                f"{season.value}_{sensor}_{scene}_p{patch_id}.tif",
+            )
+            _write_tif(path, data, crs, transform)
+
+        # majority class of the label map DFCDataset uses, cleaned to 0-7 / 255
+        values, counts = np.unique(dfc, return_counts=True)
+        rows.append([str(season), scene, patch_id, int(values[counts.argmax()])])
+
+    return rows
+
+
+def clean_label(dfc_class):
+    """DFC class 1-10 -> 0-7, savanna and snow/ice -> 255 (see dfc_dataset.clean_labels)"""
+    return {3: 255, 8: 255}.get(dfc_class, dfc_class - 1 - (dfc_class > 3) - (dfc_class > 8))
+
+
+def write_observations(base_dir, mode, rows):
+    observations = pd.DataFrame(rows, columns=["Season", "Scene", "ID", "dfc_label"])
+    observations["dfc_label"] = observations.dfc_label.map(clean_label)
+    observations[["Season", "Scene", "ID"]].to_csv(
+        os.path.join(base_dir, mode + "_observations.csv"), header=False, index=False
+    )
+
+    # repeat the observations of each class up to the size of the largest class
+    largest = observations.dfc_label.value_counts().max()
+    balanced = []
+    for _, group in observations.groupby("dfc_label"):
+        copies = np.arange(largest)
+        num_observations = len(group)
+        group = group.iloc[copies % num_observations].copy()
+        group["copy_nr"] = copies // num_observations
+        balanced.append(group)
+    pd.concat(balanced).sort_index(kind="stable").to_csv(
+        os.path.join(base_dir, mode + "_observations_balanced_classes.csv"), index=False
+    )
+
+
+def generate_dataset(
+    base_dir,
+    modes,
+    scenes_per_season=4,
+    patches_per_scene=64,
+    class_weights=None,
+    nan_fraction=0.0,
+    num_workers=8,
+    seed=0,
+):
+    if class_weights is None:
+        class_weights = np.ones(NUM_DFC_CLASSES)
+    class_probs = np.asarray(class_weights, dtype=np.float64)
+    if len(class_probs) != NUM_DFC_CLASSES or (class_probs < 0).any() or class_probs.sum() == 0:
+        raise ValueError(f"class_weights must be {NUM_DFC_CLASSES} non-negative weights")
+    class_probs = class_probs / class_probs.sum()
+
+    rng = np.random.default_rng(seed)
+    for mode in modes:
+        jobs = []
+        for season in MODE_SEASONS[mode]:
+            if mode in ["test", "validation"]:
+                # the DFC2020 validation and test sets are one scene (0) with many patches
+                scenes, num_patches = [0], scenes_per_season * patches_per_scene
+            else:
+                scenes = sorted(rng.choice(np.arange(1, 200), scenes_per_season, replace=False))
+                num_patches = patches_per_scene
+            for scene in scenes:
+                # patch ids are not contiguous in the real data either
+                patch_ids = sorted(rng.choice(4 * num_patches, num_patches, replace=False) + 1)
+                jobs.append(
+                    (
+                        base_dir,
+                        season,
+                        int(scene),
+                        [int(i) for i in patch_ids],
+                        class_probs,
+                        nan_fraction,
+                        mode != "sen12ms",
+                        int(rng.integers(2**31)),
+                    )
+                )
+
+        rows = []
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            for scene_rows in tqdm(
+                executor.map(_write_scene, jobs), total=len(jobs), desc=f"Writing {mode}"
+            ):
+                rows.extend(scene_rows)
+
+        write_observations(base_dir, mode, rows)
+        print(f"{len(rows)} {mode} observations written to {base_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="write a synthetic SEN12MS/DFC dataset")
+    parser.add_argument("base_dir", type=str)
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        default=["sen12ms", "validation"],
+        choices=list(MODE_SEASONS),
+        type=str,
+    )
+    parser.add_argument("--scenes_per_season", default=4, type=int)
+    parser.add_argument("--patches_per_scene", default=64, type=int)
+    parser.add_argument(
+        "--class_weights",
+        nargs=NUM_DFC_CLASSES,
+        default=None,
+        type=float,
+        help="relative frequency of the DFC classes 1-10",
+    )
+    parser.add_argument("--nan_fraction", default=0.0, type=float)
+    parser.add_argument("--num_workers", default=8, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    args = parser.parse_args()
+
+    generate_dataset(
+        args.base_dir,
+        args.modes,
+        scenes_per_season=args.scenes_per_season,
+        patches_per_scene=args.patches_per_scene,
+        class_weights=args.class_weights,
+        nan_fraction=args.nan_fraction,
+        num_workers=args.num_workers,
+        seed=args.seed,
+    )
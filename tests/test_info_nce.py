@@ -0,0 +1,52 @@
+"""InfoNCELoss, with and without chunks, against SwinTrainer.info_nce_loss on the cpu: loss,
+feature gradients and top-1/top-5 accuracies (see benchmark_info_nce.py for the timings).
+
+Usage (from the repository root):
+    python -m pytest tests
+"""
+
+import pytest
+import torch
+
+from utils import InfoNCELoss
+from benchmark_info_nce import reference_loss
+
+TEMPERATURE = 0.2
+
+
+def _loss_and_grad(loss_fn, features):
+    features = features.detach().clone().requires_grad_()
+    loss, accuracies = loss_fn(features)
+    loss.backward()
+    return loss.detach(), features.grad, [float(acc) for acc in accuracies]
+
+
+@pytest.mark.parametrize("batch_size,n_views,chunk_size", [(16, 2, None), (16, 2, 5), (12, 3, 8)])
+def test_info_nce_matches_reference(batch_size, n_views, chunk_size):
+    generator = torch.Generator().manual_seed(batch_size + n_views)
+    features = torch.randn(batch_size * n_views, 32, generator=generator)
+
+    ref_loss, ref_grad, ref_acc = _loss_and_grad(
+        lambda f: reference_loss(f, TEMPERATURE, n_views), features
+    )
+    loss, grad, acc = _loss_and_grad(
+        InfoNCELoss(TEMPERATURE, n_views=n_views, chunk_size=chunk_size), features
+    )
+
+    assert torch.allclose(loss, ref_loss, rtol=1e-5, atol=1e-6)
+    assert torch.allclose(grad, ref_grad, rtol=1e-4, atol=1e-7)
+    assert acc == pytest.approx([float(a) for a in ref_acc], abs=1e-3)
+
+
+def test_chunked_info_nce_matches_unchunked():
+    generator = torch.Generator().manual_seed(0)
+    features = torch.randn(2 * 20, 32, generator=generator)
+
+    loss, grad, acc = _loss_and_grad(InfoNCELoss(TEMPERATURE), features)
+    chunked_loss, chunked_grad, chunked_acc = _loss_and_grad(
+        InfoNCELoss(TEMPERATURE, chunk_size=7), features
+    )
+
+    assert torch.allclose(chunked_loss, loss, rtol=1e-6, atol=1e-7)
+    assert torch.allclose(chunked_grad, grad, rtol=1e-5, atol=1e-8)
+    assert chunked_acc == acc
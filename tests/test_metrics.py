@@ -0,0 +1,127 @@
+"""The confusion-matrix metrics against the per-sample / per-class loops they replaced, on
+random labels that include the ignore_index 255.
+
+Usage (from the repository root):
+    python -m pytest tests
+"""
+
+from collections import defaultdict
+
+import pytest
+import torch
+
+from metrics import ClasswiseAccuracy, ClasswiseMultilabelMetrics, PixelwiseMetrics
+from utils import class_wise_acc
+
+NUM_CLASSES = 8
+IGNORE_INDEX = 255
+
+
+def random_labels(generator, shape, ignored_fraction=0.1):
+    y = torch.randint(0, NUM_CLASSES, shape, generator=generator)
+    ignored = torch.rand(shape, generator=generator) < ignored_fraction
+    return torch.where(ignored, torch.full_like(y, IGNORE_INDEX), y)
+
+
+def test_classwise_accuracy_matches_sample_loop():
+    generator = torch.Generator().manual_seed(0)
+    metrics = ClasswiseAccuracy(NUM_CLASSES)
+    tp_per_class, count_per_class = defaultdict(int), defaultdict(int)
+
+    for _ in range(5):
+        y = random_labels(generator, (64,))
+        y_hat = torch.randint(0, NUM_CLASSES, (64,), generator=generator)
+        metrics.add_batch(y, y_hat)
+
+        # the loop of the previous ClasswiseAccuracy, the ignored label is not a class
+        for true, pred in zip(y, y_hat):
+            if true == IGNORE_INDEX:
+                continue
+            count_per_class["class_" + str(true.item())] += 1
+            tp_per_class["class_" + str(true.item())] += int(true == pred)
+
+    expected = {k: tp_per_class[k] / count for k, count in count_per_class.items()}
+    assert metrics.get_classwise_accuracy() == pytest.approx(expected)
+    assert metrics.get_overall_accuracy() == pytest.approx(
+        sum(tp_per_class.values()) / sum(count_per_class.values())
+    )
+
+
+def test_pixelwise_metrics_match_class_wise_acc():
+    generator = torch.Generator().manual_seed(1)
+    metrics = PixelwiseMetrics(NUM_CLASSES)
+    results = defaultdict(float)
+    intersection, union = defaultdict(int), defaultdict(int)
+
+    for _ in range(3):
+        logits = torch.randn(4, NUM_CLASSES, 16, 16, generator=generator)
+        y = random_labels(generator, (4, 16, 16))
+        y_hat = torch.argmax(logits, dim=1)
+        metrics.add_batch(y, y_hat)
+
+        class_wise_acc(logits, y, results, num_classes=NUM_CLASSES)
+        valid = y != IGNORE_INDEX
+        for c in range(NUM_CLASSES):
+            intersection[c] += int(((y == c) & (y_hat == c) & valid).sum())
+            union[c] += int((((y == c) | (y_hat == c)) & valid).sum())
+
+    # accuracies of the pixel counts accumulated over all batches
+    expected = {
+        "pixelclass_" + str(c): float(results[f"{c}_correct"]) / results[f"{c}_total"]
+        for c in range(NUM_CLASSES)
+        if results[f"{c}_total"] > 0
+    }
+    assert metrics.get_classwise_accuracy() == pytest.approx(expected)
+    expected_iou = {"class_" + str(c): intersection[c] / union[c] for c in union if union[c]}
+    assert metrics.get_iou() == pytest.approx(expected_iou)
+
+
+def test_multilabel_metrics_match_class_loop():
+    generator = torch.Generator().manual_seed(2)
+    metrics = ClasswiseMultilabelMetrics(NUM_CLASSES)
+    counts = {i: {"tp": 0, "tn": 0, "fp": 0, "fn": 0} for i in range(NUM_CLASSES)}
+
+    for _ in range(5):
+        y = (torch.rand(32, NUM_CLASSES, generator=generator) < 0.3).float()
+        y_hat = (torch.rand(32, NUM_CLASSES, generator=generator) < 0.3).float()
+        metrics.add_batch(y, y_hat)
+
+        # the loop of the previous ClasswiseMultilabelMetrics
+        for sample_y, sample_y_hat in zip(y, y_hat):
+            for i in range(NUM_CLASSES):
+                if sample_y_hat[i] == sample_y[i]:
+                    counts[i]["tp" if sample_y_hat[i] else "tn"] += 1
+                else:
+                    counts[i]["fp" if sample_y_hat[i] else "fn"] += 1
+
+    tp, tn, fp, fn = metrics._get_counts()
+    for i in range(NUM_CLASSES):
+        assert (tp[i], tn[i], fp[i], fn[i]) == tuple(
+            counts[i][k] for k in ["tp", "tn", "fp", "fn"]
+        )
+
+    precision = {
+        "class_" + str(i): 0 if c["tp"] == 0 else c["tp"] / (c["tp"] + c["fp"])
+        for i, c in counts.items()
+    }
+    recall = {
+        "class_" + str(i): 0 if c["tp"] == 0 else c["tp"] / (c["tp"] + c["fn"])
+        for i, c in counts.items()
+    }
+    assert metrics.get_classwise_precision() == pytest.approx(precision)
+    assert metrics.get_classwise_recall() == pytest.approx(recall)
+    num_tp = sum(c["tp"] for c in counts.values())
+    assert metrics.get_overall_precision() == pytest.approx(
+        num_tp / (num_tp + sum(c["fp"] for c in counts.values()))
+    )
+
+
+def test_confusion_matrix_state_dict_round_trip():
+    generator = torch.Generator().manual_seed(3)
+    metrics = ClasswiseAccuracy(NUM_CLASSES)
+    metrics.add_batch(
+        random_labels(generator, (64,)), torch.randint(0, NUM_CLASSES, (64,), generator=generator)
+    )
+    restored = ClasswiseAccuracy(NUM_CLASSES)
+    restored.load_state_dict(metrics.state_dict())
+    assert (restored.get_matrix() == metrics.get_matrix()).all()
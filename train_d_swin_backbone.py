@@ -1,22 +1,24 @@
 import os
 
-# set environment variables to limit cpu usage
-os.environ["OMP_NUM_THREADS"] = "4"  # export OMP_NUM_THREADS=4
-os.environ["OPENBLAS_NUM_THREADS"] = "4"  # export OPENBLAS_NUM_THREADS=4
-os.environ["MKL_NUM_THREADS"] = "6"  # export MKL_NUM_THREADS=6
-os.environ["VECLIB_MAXIMUM_THREADS"] = "4"  # export VECLIB_MAXIMUM_THREADS=4
-os.environ["NUMEXPR_NUM_THREADS"] = "6"  # export NUMEXPR_NUM_THREADS=6
+# limit cpu usage, unless the thread counts are set in the environment
+os.environ.setdefault("OMP_NUM_THREADS", "4")  # export OMP_NUM_THREADS=4
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "4")  # export OPENBLAS_NUM_THREADS=4
+os.environ.setdefault("MKL_NUM_THREADS", "6")  # export MKL_NUM_THREADS=6
+os.environ.setdefault("VECLIB_MAXIMUM_THREADS", "4")  # export VECLIB_MAXIMUM_THREADS=4
+os.environ.setdefault("NUMEXPR_NUM_THREADS", "6")  # export NUMEXPR_NUM_THREADS=6
 
 import random
 import sys
 import json
-import wandb
 import numpy as np
 import torch
+import torch.distributed as dist
 
 from utils import dotdictify
+from loggers import build_logger
 from d_swin_utils import SwinTrainer
 from dfc_dataset import DFCDataset
+from balanced_sampler import build_balanced_sampler
 
 sys.path.insert(0, "./Transformer_SSL")
 from Transformer_SSL.models import build_model
@@ -24,14 +26,6 @@ from Transformer_SSL.models.swin_transformer import DoubleSwinTransformer
 from Transformer_SSL.optimizer import build_optimizer
 from Transformer_SSL.lr_scheduler import build_scheduler
 
-# os.environ['WANDB_MODE'] = 'offline'
-wandb.login()
-
-if torch.cuda.is_available():
-    device = torch.device("cuda")
-else:
-    device = torch.device("cpu:0")
-
 if torch.cuda.is_available():
     device = torch.device("cuda")
 else:
@@ -40,12 +34,40 @@ else:
 with open("configs/backbone_config.json", "r") as fp:
     config = json.load(fp)
 
-run = wandb.init(config=config, project="d-swin-backbone")
+# multi-process pretraining, launched with e.g.
+# torchrun --nproc_per_node=4 train_d_swin_backbone.py
+distributed = int(os.environ.get("WORLD_SIZE", 1)) > 1
+if distributed:
+    rank = int(os.environ["RANK"])
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    backend = config.get("dist_backend")
+    if backend is None:
+        backend = "nccl" if torch.cuda.is_available() else "gloo"
+    if backend == "nccl":
+        torch.cuda.set_device(local_rank)
+        device = torch.device("cuda", local_rank)
+    else:
+        device = torch.device("cpu")
+    dist.init_process_group(backend=backend, init_method="env://")
+    print(f"rank {rank}/{dist.get_world_size()} initialised with {backend} on {device}")
+else:
+    rank = 0
+
+# only the first rank reports, to wandb, tensorboard or jsonl ("logger" of the config)
+logger = build_logger(
+    config.get("logger", "wandb"),
+    "d-swin-backbone",
+    config,
+    log_dir=config.get("log_dir", "runs"),
+    enabled=rank == 0,
+)
 
-config = wandb.config
-config["run_name"] = run.name
+config = logger.config
+config["run_name"] = logger.name
 
 config = dotdictify(config)
+if distributed:
+    config.device = str(device)
 
 # Input sizes don't change
 torch.backends.cudnn.benchmark = True
@@ -62,6 +84,9 @@ print(f"{config.image_px_size=}")
 print(f"{config.model_config.DATA.IMG_SIZE=}")
 
 assert config.image_px_size == config.model_config.DATA.IMG_SIZE
+if config.get("batch_augmentation"):
+    # the trainer augments the collated batches on the device instead
+    assert config.transforms is None, "batch_augmentation replaces transforms"
 
 
 train_dataset = DFCDataset(
@@ -73,6 +98,7 @@ train_dataset = DFCDataset(
     image_px_size=config.image_px_size,
     cover_all_parts=config.cover_all_parts_train,
     balanced_classes=config.balanced_classes_train,
+    exclude_invalid=config.exclude_invalid_observations,
 )
 val_dataset = DFCDataset(
     config.val_dir,
@@ -82,12 +108,36 @@ val_dataset = DFCDataset(
     image_px_size=config.image_px_size,
     cover_all_parts=config.cover_all_parts_validation,
     balanced_classes=config.balanced_classes_validation,
+    exclude_invalid=config.exclude_invalid_observations,
 )
 
+# batch_size is per process, the global batch is batch_size * world_size
+if config.get("balanced_sampling") is not None:
+    # sharded over the ranks by the sampler itself
+    train_sampler = build_balanced_sampler(
+        train_dataset,
+        weighting=config.balanced_sampling,
+        label="lc" if config.train_mode == "sen12ms" else "dfc",
+        num_samples=config.get("samples_per_epoch"),
+        seed=config.seed,
+    )
+    val_sampler = (
+        torch.utils.data.DistributedSampler(val_dataset, shuffle=False)
+        if distributed
+        else None
+    )
+elif distributed:
+    train_sampler = torch.utils.data.DistributedSampler(train_dataset, shuffle=True)
+    val_sampler = torch.utils.data.DistributedSampler(val_dataset, shuffle=False)
+else:
+    train_sampler = None
+    val_sampler = None
+
 train_loader = torch.utils.data.DataLoader(
     train_dataset,
     batch_size=config.batch_size,
-    shuffle=True,
+    shuffle=train_sampler is None,
+    sampler=train_sampler,
     pin_memory=True,
     num_workers=config.dataloader_workers,
     drop_last=True,
@@ -96,6 +146,7 @@ val_loader = torch.utils.data.DataLoader(
     val_dataset,
     batch_size=config.batch_size,
     shuffle=False,
+    sampler=val_sampler,
     num_workers=config.dataloader_workers,
     drop_last=True,
 )
@@ -105,11 +156,29 @@ config.model_config.MODEL.SWIN.IN_CHANS = 13
 s2_backbone = build_model(config.model_config)
 model = DoubleSwinTransformer(s1_backbone, s2_backbone)
 
+if distributed:
+    # the classification heads are not used during pretraining, freeze them
+    # so DDP does not wait for their gradients
+    for backbone in [s1_backbone, s2_backbone]:
+        for param in backbone.head.parameters():
+            param.requires_grad = False
+
 optimizer = build_optimizer(config, model)
 lr_scheduler = build_scheduler(config, optimizer, len(train_loader))
 
+if distributed:
+    model = torch.nn.parallel.DistributedDataParallel(
+        model.to(device),
+        device_ids=[local_rank] if device.type == "cuda" else None,
+        broadcast_buffers=False,
+    )
+
 trainer = SwinTrainer(
-    model=model, optimizer=optimizer, scheduler=lr_scheduler, args=config
+    model=model, optimizer=optimizer, scheduler=lr_scheduler, args=config, logger=logger
 )
 
 s = trainer.train(train_loader, val_loader)
+logger.finish()
+
+if distributed:
+    dist.destroy_process_group()
@@ -1,34 +1,52 @@
 import os
 
-os.environ["OMP_NUM_THREADS"] = "4"  # export OMP_NUM_THREADS=4
-os.environ["OPENBLAS_NUM_THREADS"] = "4"  # export OPENBLAS_NUM_THREADS=4
-os.environ["MKL_NUM_THREADS"] = "4"  # export MKL_NUM_THREADS=6
-os.environ["VECLIB_MAXIMUM_THREADS"] = "4"  # export VECLIB_MAXIMUM_THREADS=4
-os.environ["NUMEXPR_NUM_THREADS"] = "4"  # export NUMEXPR_NUM_THREADS=6
+# limit cpu usage, unless the thread counts are set in the environment
+os.environ.setdefault("OMP_NUM_THREADS", "4")  # export OMP_NUM_THREADS=4
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "4")  # export OPENBLAS_NUM_THREADS=4
+os.environ.setdefault("MKL_NUM_THREADS", "4")  # export MKL_NUM_THREADS=6
+os.environ.setdefault("VECLIB_MAXIMUM_THREADS", "4")  # export VECLIB_MAXIMUM_THREADS=4
+os.environ.setdefault("NUMEXPR_NUM_THREADS", "4")  # export NUMEXPR_NUM_THREADS=6
 
 import json
 import random
 import argparse
+import importlib
 from distutils.util import strtobool
 
 import numpy as np
 from tqdm import tqdm
-import wandb
 import torch
-from torchvision.models import resnet18, resnet50
 import torch.nn.functional as F
 
 from dfc_dataset import DFCDataset
-from dfc_model import DualBaseline
-from resnet_simclr import NormalSimCLRDownstream, DoubleResNetSimCLRDownstream
 from metrics import ClasswiseMultilabelMetrics, ClasswiseAccuracy, PixelwiseMetrics
-from utils import save_checkpoint_single_model, dotdictify
+from utils import (
+    save_checkpoint_single_model,
+    dotdictify,
+    RunningStats,
+    AsyncStatsWriter,
+    StepProfiler,
+)
 from validation_utils import validate_all
-from Transformer_SSL.models import build_model
-from Transformer_SSL.models.swin_transformer import (
-    DoubleSwinTransformerSegmentation,
-    DoubleSwinTransformerDownstream,
-    DownstreamSharedDSwin,
+from balanced_sampler import build_balanced_sampler, WEIGHTINGS
+from batch_augmentation import BatchAugmentation
+from checkpointing import CheckpointManager
+from resume import (
+    EpochRandomSampler,
+    ResumableSampler,
+    SeededDataset,
+    save_resume_state,
+    read_resume_state,
+    load_resume_state,
+    set_rng_states,
+)
+from loggers import build_logger, LOGGERS
+from multi_task import (
+    TARGET_NAMES,
+    Task,
+    MultiTaskMetrics,
+    multi_task_loss,
+    build_multi_head_model,
 )
 
 model_name_map = {
@@ -46,6 +64,18 @@ model_name_map = {
     "DownstreamSharedDSwin": "shared-swin-t",
     "SharedDSwinBaseline": "shared-swin-t-baseline",
 }
+# modules of the --model classes, only the selected one is imported
+model_module_map = {
+    "resnet18": "torchvision.models",
+    "resnet50": "torchvision.models",
+    "DualBaseline": "dfc_model",
+    "NormalSimCLRDownstream": "resnet_simclr",
+    "DoubleAlignmentDownstream": "dfc_model",
+    "DoubleResNetSimCLRDownstream": "resnet_simclr",
+    "DoubleSwinTransformerDownstream": "Transformer_SSL.models.swin_transformer",
+    "DoubleSwinTransformerSegmentation": "Transformer_SSL.models.swin_transformer",
+    "DownstreamSharedDSwin": "Transformer_SSL.models.swin_transformer",
+}
 target_name_map = {
     "dfc_label": "single-classification",
     "dfc_multilabel_one_hot": "multi-classification",
@@ -59,9 +89,15 @@ bool_args = [
     "cover_all_parts_train",
     "balanced_classes_train",
     "balanced_classes_validation",
+    "balanced_sampling_multilabel",
     "s1_normalization_fixed",
     "finetuning",
     "simclr_dataset",
+    "exclude_invalid_observations",
+    "skip_nan_batches",
+    "head_only_checkpoints",
+    "batch_augmentation",
+    "profile",
 ]
 
 parser = argparse.ArgumentParser(description="train_evaluation_script")
@@ -94,6 +130,9 @@ parser.add_argument(
 parser.add_argument("--val_mode", default="test", type=str)
 parser.add_argument("--clip_sample_values", default="True", type=str)
 parser.add_argument("--transforms", default=None)
+# same augmentation as --transforms, but applied to the collated batch on the device with
+# one shared geometry for s1, s2 and the label maps (batch_augmentation.py)
+parser.add_argument("--batch_augmentation", default="False", type=str)
 parser.add_argument("--num_classes", default=8, type=int)
 parser.add_argument("--only_rgb", default="False", type=str)
 parser.add_argument("--rgb_plus_s1", default="False", type=str)
@@ -106,8 +145,27 @@ parser.add_argument("--cover_all_parts_validation", default="True", type=str)
 parser.add_argument("--cover_all_parts_train", default="False", type=str)
 parser.add_argument("--balanced_classes_train", default="True", type=str)
 parser.add_argument("--balanced_classes_validation", default="False", type=str)
+# weighted sampling from the label index (balanced_sampler.py) instead of the duplicated
+# rows of the balanced csv, use with --balanced_classes_train False
+parser.add_argument(
+    "--balanced_sampling", default="none", choices=["none"] + WEIGHTINGS, type=str
+)
+parser.add_argument("--balanced_sampling_multilabel", default="False", type=str)
+parser.add_argument("--balanced_sampling_max_ratio", default=10.0, type=float)
+# number of training samples per epoch for balanced sampling (default: dataset size)
+parser.add_argument("--train_samples_per_epoch", default=None, type=int)
 parser.add_argument("--s1_normalization_fixed", default="True", type=str)
 parser.add_argument("--simclr_dataset", default="False", type=str)
+# drop observations listed by dataset_scan.py instead of discarding whole batches
+parser.add_argument("--exclude_invalid_observations", default="False", type=str)
+parser.add_argument("--skip_nan_batches", default="True", type=str)
+# number of steps between host syncs for the running loss (tqdm)
+parser.add_argument("--log_interval", default=100, type=int)
+# per-stage timing of the training steps (utils.StepProfiler), every profile_every-th step,
+# optionally with a torch.profiler trace of a few steps written to profile_trace_dir
+parser.add_argument("--profile", default="False", type=str)
+parser.add_argument("--profile_every", default=10, type=int)
+parser.add_argument("--profile_trace_dir", default=None, type=str)
 parser.add_argument(
     "--out_dim", default=128, type=int
 )  # as used in normal-simclr trained checkpoint
@@ -145,27 +203,68 @@ parser.add_argument(
     choices=["dfc_label", "dfc_multilabel_one_hot", "dfc"],
     type=str,
 )
+parser.add_argument(
+    "--targets",
+    nargs="+",
+    default=None,
+    choices=list(TARGET_NAMES),
+    type=str,
+    help="train heads for all these targets on one backbone pass, replaces --target",
+)
 parser.add_argument("--finetuning", default="False", type=str)
 parser.add_argument("--checkpoint", default=None, type=str)
 parser.add_argument("--embedding_size", default=256, type=int)
+# model snapshots, written in the background (see checkpointing.py)
+parser.add_argument("--checkpoint_dir", default="checkpoints", type=str)
+parser.add_argument("--keep_last_checkpoints", default=2, type=int)
+parser.add_argument("--keep_best_checkpoints", default=1, type=int)
+parser.add_argument("--best_metric", default="validation_loss", type=str)
+parser.add_argument("--best_metric_mode", default="min", choices=["min", "max"], type=str)
+# state for an exact restart, resumed from if the file exists (see resume.py)
+parser.add_argument("--resume", default=None, type=str)
+parser.add_argument(
+    "--resume_every_n_steps",
+    default=0,
+    type=int,
+    help="training batches between resume states, 0: only at the end of every epoch",
+)
+parser.add_argument(
+    "--head_only_checkpoints",
+    default="True",
+    type=str,
+    help="write frozen backbones once and reference them from the epoch checkpoints",
+)
 parser.add_argument("--wandb_project", default=None, type=str)
+parser.add_argument("--logger", default="wandb", choices=LOGGERS, type=str)
+parser.add_argument("--log_dir", default="runs", type=str, help="for tensorboard and jsonl")
 
 args = parser.parse_args()
 model_name = model_name_map[args.model]
-target_name = target_name_map[args.target]
+if args.targets is not None:
+    # one run for several targets (see multi_task.py)
+    target_name = "multi-task"
+else:
+    target_name = target_name_map[args.target]
 
 if args.wandb_project is not None and args.wandb_project != "None":
     project = args.wandb_project
 else:
     project = "-".join(["EV", model_name, target_name])
 
-# set up wandb logging
-wandb.login()
-run = wandb.init(
-    project=project,
-    config={k: strtobool(v) if k in bool_args else v for k, v in vars(args).items()},
+# a restarted run continues its logger run and its checkpoints (see resume.py)
+stored_state = read_resume_state(args.resume)
+if stored_state is None:
+    stored_state = {}
+
+# set up logging (wandb, tensorboard, jsonl or none)
+logger = build_logger(
+    args.logger,
+    project,
+    {k: strtobool(v) if k in bool_args else v for k, v in vars(args).items()},
+    log_dir=args.log_dir,
+    run_id=stored_state.get("logger_id"),
 )
-config = wandb.config
+config = logger.config
 
 # remove this to enable different LR for backbone and head!! (for finetuning)
 # config.classifier_lr = config.learning_rate
@@ -198,11 +297,19 @@ else:
 
 print(f"model_name {model_name}")
 
+
+def get_model_class(name):
+    return getattr(importlib.import_module(model_module_map[name]), name)
+
+
+if "swin" in model_name or model_name == "moby":
+    from Transformer_SSL.models import build_model
+
 if model_name == "baseline" or model_name == "swin-baseline":
     input_channels = config.s1_input_channels + config.s2_input_channels
 
     if model_name == "baseline":
-        model = eval(config.model)(pretrained=False, num_classes=config.num_classes)
+        model = get_model_class(config.model)(pretrained=False, num_classes=config.num_classes)
         model.conv1 = torch.nn.Conv2d(
             input_channels,
             64,
@@ -227,7 +334,7 @@ if model_name == "baseline" or model_name == "swin-baseline":
 
 elif model_name == "dual-baseline":
     if config.base_model == "resnet50":
-        model = eval(config.model)(
+        model = get_model_class(config.model)(
             config.base_model,
             config.s1_input_channels,
             config.s2_input_channels,
@@ -235,7 +342,7 @@ elif model_name == "dual-baseline":
         )
     else:
         # resnet18
-        model = eval(config.model)(
+        model = get_model_class(config.model)(
             config.base_model, config.s1_input_channels, config.s2_input_channels
         )
 
@@ -253,7 +360,7 @@ elif model_name == "dual-swin-baseline":
     swin_conf.model_config.MODEL.SWIN.IN_CHANS = 13
     s2_backbone = build_model(swin_conf.model_config)
 
-    model = DoubleSwinTransformerDownstream(
+    model = get_model_class("DoubleSwinTransformerDownstream")(
         s1_backbone,
         s2_backbone,
         out_dim=config.num_classes,
@@ -263,7 +370,7 @@ elif model_name == "dual-swin-baseline":
 
 elif model_name == "normal-simclr":
     checkpoint = torch.load(config.checkpoint, map_location=lambda device, loc: device)
-    model = eval(config.model)(
+    model = get_model_class(config.model)(
         base_model=config.base_model,
         out_dim=config.out_dim,
         checkpoint=checkpoint,
@@ -271,7 +378,7 @@ elif model_name == "normal-simclr":
     )
 
 elif model_name == "alignment":
-    model = eval(config.model)(config.base_model, device, config)
+    model = get_model_class(config.model)(config.base_model, device, config)
 
     # load trained weights
     checkpoint = torch.load(config.checkpoint, map_location=lambda device, loc: device)
@@ -279,7 +386,7 @@ elif model_name == "alignment":
 
 elif model_name == "simclr":
     input_channels = config.s1_input_channels + config.s2_input_channels
-    model = eval(config.model)(config.base_model, config.num_classes)
+    model = get_model_class(config.model)(config.base_model, config.num_classes)
     model.backbone1.conv1 = torch.nn.Conv2d(
         config.s1_input_channels,
         64,
@@ -327,11 +434,11 @@ elif model_name == "swin-t":
     s2_backbone.load_state_dict(s2_weights)
 
     if target_name == "pixel-classification":
-        model = DoubleSwinTransformerSegmentation(
+        model = get_model_class("DoubleSwinTransformerSegmentation")(
             s1_backbone, s2_backbone, out_dim=8, device=device
         )
     else:
-        model = DoubleSwinTransformerDownstream(
+        model = get_model_class("DoubleSwinTransformerDownstream")(
             s1_backbone, s2_backbone, out_dim=8, device=device
         )
 
@@ -346,7 +453,7 @@ elif model_name == "shared-swin-t":
     weights = checkpoint["state_dict"]
 
     ssl_model.load_state_dict(weights)
-    model = DownstreamSharedDSwin(ssl_model, config.num_classes)
+    model = get_model_class("DownstreamSharedDSwin")(ssl_model, config.num_classes)
 
 elif model_name == "shared-swin-t-baseline":
     with open("configs/shared_backbone_config.json", "r") as fp:
@@ -355,13 +462,13 @@ elif model_name == "shared-swin-t-baseline":
     assert config.image_px_size == swin_conf.model_config.DATA.IMG_SIZE
 
     ssl_model = build_model(swin_conf.model_config)
-    model = DownstreamSharedDSwin(ssl_model, config.num_classes)
+    model = get_model_class("DownstreamSharedDSwin")(ssl_model, config.num_classes)
 
 elif model_name == "moby":
     with open("configs/moby_config.json", "r") as fp:
         moby_conf = dotdictify(json.load(fp))
 
-    weights = torch.load(config.checkpoint)
+    weights = torch.load(config.checkpoint, map_location=torch.device("cpu"))
     # assert config.image_px_size == config.model_config.DATA.IMG_SIZE
     assert moby_conf.model_config.AMP_OPT_LEVEL == "O0"
     assert moby_conf.model_config.MODEL.TYPE == "moby"
@@ -381,6 +488,19 @@ elif model_name == "moby":
 else:
     raise ValueError("Invalid model specified")
 
+if target_name == "multi-task":
+    model = build_multi_head_model(
+        model,
+        model_name,
+        config.targets,
+        config.num_classes,
+        device,
+        finetuning=config.finetuning,
+    )
+    tasks = [Task(target, config.num_classes, device) for target in config.targets]
+else:
+    tasks = None
+
 model = model.to(device)
 
 # ignore label 255 (dataset class sets labels 3,8 (savanna, ice) for lr lc map to 255)
@@ -391,6 +511,9 @@ elif target_name == "single-classification":
     criterion = torch.nn.CrossEntropyLoss(ignore_index=255, reduction="mean").to(device)
 elif target_name == "pixel-classification":
     criterion = torch.nn.CrossEntropyLoss(ignore_index=255).to(device)
+elif target_name == "multi-task":
+    # one criterion per target, see Task
+    criterion = None
 else:
     raise ValueError("Invalid target specified")
 
@@ -408,11 +531,22 @@ if model_name in [
         # train all parameters
         param_backbone = []
         param_head = []
+        if target_name == "multi-task" and "dfc" in config.targets:
+            # DoubleSwinTransformerMultiHead does not freeze its backbones when finetuning,
+            # split by module: backbone1/2 vs fcs and decoders
+            backbone_ids = {
+                id(p)
+                for backbone in [model.backbone1, model.backbone2]
+                for p in backbone.parameters()
+            }
+            frozen = lambda p: id(p) in backbone_ids
+        else:
+            frozen = lambda p: not p.requires_grad
         for p in model.parameters():
-            if p.requires_grad:
-                param_head.append(p)
-            else:
+            if frozen(p):
                 param_backbone.append(p)
+            else:
+                param_head.append(p)
             p.requires_grad = True
         # parameters = model.parameters()
         parameters = [
@@ -438,6 +572,10 @@ optimizer = torch.optim.Adam(
     weight_decay=config.weight_decay,
 )
 
+resume_state = None
+if stored_state:
+    resume_state = load_resume_state(config.resume, model, optimizer, state=stored_state)
+
 train_dataset = DFCDataset(
     config.train_dir,
     mode=config.train_mode,
@@ -449,6 +587,7 @@ train_dataset = DFCDataset(
     cover_all_parts=config.cover_all_parts_train,
     balanced_classes=config.balanced_classes_train,
     seed=config.seed,
+    exclude_invalid=config.exclude_invalid_observations,
 )
 # if config.create_validation_set:
 #    # create subsampler from training set
@@ -462,15 +601,34 @@ val_dataset = DFCDataset(
     cover_all_parts=config.cover_all_parts_validation,
     balanced_classes=config.balanced_classes_validation,
     seed=config.seed,
+    exclude_invalid=config.exclude_invalid_observations,
 )
 
 
+if config.balanced_sampling != "none":
+    assert not config.balanced_classes_train, "balanced_sampling replaces balanced_classes_train"
+    train_sampler = build_balanced_sampler(
+        train_dataset,
+        weighting=config.balanced_sampling,
+        label="lc" if config.train_mode == "sen12ms" else "dfc",
+        use_multilabels=config.balanced_sampling_multilabel,
+        max_weight_ratio=config.balanced_sampling_max_ratio,
+        num_samples=config.train_samples_per_epoch,
+        seed=config.seed,
+    )
+else:
+    # shuffled by (seed, epoch), so that a resumed run sees the same order
+    train_sampler = EpochRandomSampler(train_dataset, seed=config.seed)
+train_sampler = ResumableSampler(train_sampler, seed=config.seed)
+
 train_loader = torch.utils.data.DataLoader(
-    train_dataset,
+    SeededDataset(train_dataset),
     batch_size=config.batch_size,
-    shuffle=True,
+    sampler=train_sampler,
     pin_memory=True,
     num_workers=config.dataloader_workers,
+    # worker seeds are not drawn from the global generator restored on resume
+    generator=torch.Generator().manual_seed(config.seed),
 )
 val_loader = torch.utils.data.DataLoader(
     val_dataset,
@@ -479,102 +637,191 @@ val_loader = torch.utils.data.DataLoader(
     num_workers=config.dataloader_workers,
 )
 
+if config.batch_augmentation:
+    assert config.transforms is None, "batch_augmentation replaces transforms"
+    batch_augmentation = BatchAugmentation(device=device)
+else:
+    batch_augmentation = None
+
 step = 0
+stats_writer = AsyncStatsWriter()
+checkpoints = CheckpointManager(
+    config.checkpoint_dir,
+    stored_state.get("checkpoint_prefix")
+    or "-".join([model_name, target_name, str(logger.name)]),
+    keep_last=config.keep_last_checkpoints,
+    keep_best=config.keep_best_checkpoints,
+    mode=config.best_metric_mode,
+    head_only=config.head_only_checkpoints,
+)
+profiler = StepProfiler(
+    enabled=config.profile,
+    sample_every=config.profile_every,
+    device=device,
+    trace_dir=config.profile_trace_dir,
+)
 
-for epoch in range(config.epochs):
+start_epoch, start_batch, val_stats = 0, 0, None
+if resume_state is not None:
+    # keeps the backbone file the resume state references
+    checkpoints.track_state(config.resume, resume_state["model_weights"])
+    start_epoch, start_batch = resume_state["epochs"], resume_state["batch_idx"]
+    step, val_stats = resume_state["step"], resume_state["val_stats"]
+    set_rng_states(resume_state["rng_states"])
+
+for epoch in range(start_epoch, config.epochs):
     model.train()
-    step += 1
+    # continue an epoch that was interrupted after start_batch batches
+    resumed = resume_state is not None and epoch == start_epoch and start_batch > 0
+    if not resumed:
+        step += 1
+    train_sampler.set_epoch(epoch)
+    if resumed:
+        # skips the consumed batches without loading them
+        train_sampler.set_start_index(start_batch * config.batch_size)
 
     pbar = tqdm(train_loader)
 
     # track performance
-    epoch_losses = torch.Tensor()
+    loss_names = ["loss"] + (config.targets if target_name == "multi-task" else [])
+    loss_stats = RunningStats(loss_names, log_interval=config.log_interval)
     if target_name == "single-classification":
         metrics = ClasswiseAccuracy(config.num_classes)
     elif target_name == "multi-classification":
         metrics = ClasswiseMultilabelMetrics(config.num_classes)
     elif target_name == "pixel-classification":
         metrics = PixelwiseMetrics(config.num_classes)
-
-    if config.learning_rate_schedule.get(epoch) is not None:
+    elif target_name == "multi-task":
+        metrics = MultiTaskMetrics(tasks)
+
+    if resumed:
+        # the schedule of this epoch is already part of the restored optimizer state
+        loss_stats.load_state_dict(resume_state["loss_stats"])
+        metrics.load_state_dict(resume_state["metrics"])
+    elif config.learning_rate_schedule.get(epoch) is not None:
         for g in optimizer.param_groups:
             g["lr"] = g["lr"] * config.learning_rate_schedule.get(epoch)
 
-    for idx, sample in enumerate(pbar):
+    for idx, sample in enumerate(profiler.iterate(pbar), start=start_batch if resumed else 0):
 
-        if "x" in sample.keys():
-            if torch.isnan(sample["x"]).any():
-                # some s1 scenes are known to have NaNs...
-                continue
-        else:
-            if torch.isnan(sample["s1"]).any() or torch.isnan(sample["s2"]).any():
-                # some s1 scenes are known to have NaNs...
-                continue
-
-        if model_name == "baseline" or model_name == "swin-baseline":
-            s1 = sample["s1"]
-            s2 = sample["s2"]
-            if config.s1_input_channels == 0:
-                # no data fusion
-                img = s2.to(device)
-            elif config.s2_input_channels == 0:
-                img = s1.to(device)
+        if config.skip_nan_batches:
+            if "x" in sample.keys():
+                if torch.isnan(sample["x"]).any():
+                    # some s1 scenes are known to have NaNs...
+                    continue
             else:
-                # data fusion
-                img = torch.cat([s1, s2], dim=1).to(device)
-
-        elif model_name == "normal-simclr":
-            x = sample["x"]
-            img = x.to(device)
-
-        elif model_name == "moby":
-            img = torch.cat([sample["s1"], sample["s2"]], dim=1).to(device)
-
-        elif model_name in [
-            "dual-baseline",
-            "dual-swin-baseline",
-            "alignment",
-            "simclr",
-            "swin-t",
-            "shared-swin-t",
-            "shared-swin-t-baseline",
-        ]:
-            s1 = sample["s1"].to(device)
-            s2 = sample["s2"].to(device)
-            img = {"s1": s1, "s2": s2}
-
-        if target_name == "single-classification":
-            y = sample[config.target].long().to(device)
-        elif target_name == "multi-classification":
-            y = sample[config.target].to(device)
-        elif target_name == "pixel-classification":
-            y = sample[config.target].squeeze().type(torch.LongTensor).to(device)
-
-        y_hat = model(img)
-
-        if target_name == "multi-classification":
-            y_hat = sigmoid(y_hat)
-
-        loss = criterion(y_hat, y)
-
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-
-        if target_name == "multi-classification":
-            pred = y_hat.round()
-        elif target_name == "single-classification":
-            _, pred = torch.max(y_hat, dim=1)
-        elif target_name == "pixel-classification":
-            probas = F.softmax(y_hat, dim=1)
-            pred = torch.argmax(probas, axis=1)
-
-        epoch_losses = torch.cat([epoch_losses, loss[None].detach().cpu()])
-        metrics.add_batch(y, pred)
-
-        pbar.set_description(f"Epoch:{epoch}, Loss:{epoch_losses[-100:].mean():.4}")
-
-    mean_loss = epoch_losses.mean()
+                if torch.isnan(sample["s1"]).any() or torch.isnan(sample["s2"]).any():
+                    # some s1 scenes are known to have NaNs...
+                    continue
+
+        with profiler.region("h2d"):
+            if batch_augmentation is not None:
+                sample = batch_augmentation(sample)
+
+            if model_name == "baseline" or model_name == "swin-baseline":
+                s1 = sample["s1"]
+                s2 = sample["s2"]
+                if config.s1_input_channels == 0:
+                    # no data fusion
+                    img = s2.to(device)
+                elif config.s2_input_channels == 0:
+                    img = s1.to(device)
+                else:
+                    # data fusion
+                    img = torch.cat([s1, s2], dim=1).to(device)
+
+            elif model_name == "normal-simclr":
+                x = sample["x"]
+                img = x.to(device)
+
+            elif model_name == "moby":
+                img = torch.cat([sample["s1"], sample["s2"]], dim=1).to(device)
+
+            elif model_name in [
+                "dual-baseline",
+                "dual-swin-baseline",
+                "alignment",
+                "simclr",
+                "swin-t",
+                "shared-swin-t",
+                "shared-swin-t-baseline",
+            ]:
+                s1 = sample["s1"].to(device)
+                s2 = sample["s2"].to(device)
+                img = {"s1": s1, "s2": s2}
+
+            if target_name == "single-classification":
+                y = sample[config.target].long().to(device)
+            elif target_name == "multi-classification":
+                y = sample[config.target].to(device)
+            elif target_name == "pixel-classification":
+                y = sample[config.target].squeeze().long().to(device)
+            elif target_name == "multi-task":
+                y = {task.target: task.get_labels(sample, device) for task in tasks}
+
+        with profiler.region("forward"):
+            y_hat = model(img)
+
+            if target_name == "multi-classification":
+                y_hat = sigmoid(y_hat)
+
+        with profiler.region("loss"):
+            if target_name == "multi-task":
+                loss, losses, pred = multi_task_loss(tasks, y_hat, y)
+            else:
+                loss = criterion(y_hat, y)
+
+        with profiler.region("backward"):
+            optimizer.zero_grad()
+            loss.backward()
+        with profiler.region("optimizer"):
+            optimizer.step()
+
+        with profiler.region("metrics"):
+            if target_name == "multi-classification":
+                pred = y_hat.round()
+            elif target_name == "single-classification":
+                _, pred = torch.max(y_hat, dim=1)
+            elif target_name == "pixel-classification":
+                probas = F.softmax(y_hat, dim=1)
+                pred = torch.argmax(probas, axis=1)
+
+            if target_name == "multi-task":
+                loss_stats.update(loss=loss, **losses)
+            else:
+                loss_stats.update(loss=loss)
+            metrics.add_batch(y, pred)
+
+        with profiler.region("logging"):
+            if loss_stats.ready():
+                stats_writer.submit(
+                    lambda s, pbar=pbar, epoch=epoch: pbar.set_description(
+                        f"Epoch:{epoch}, Loss:{s['loss']:.4}"
+                    ),
+                    loss_stats.window_means(),
+                )
+        profiler.step()
+
+        if (
+            config.resume is not None
+            and config.resume_every_n_steps > 0
+            and (idx + 1) % config.resume_every_n_steps == 0
+        ):
+            save_resume_state(
+                checkpoints,
+                config.resume,
+                model,
+                optimizer,
+                val_stats,
+                epoch,
+                idx + 1,
+                step,
+                loss_stats,
+                metrics,
+                logger_id=logger.id,
+            )
+
+    mean_loss = loss_stats.means()["loss"]
 
     if target_name == "single-classification":
         train_stats = {
@@ -603,31 +850,62 @@ for epoch in range(config.epochs):
         train_stats = {
             "train_loss": mean_loss.item(),
             "train_average_accuracy": metrics.get_average_accuracy(),
+            "train_overall_accuracy": metrics.get_overall_accuracy(),
+            "train_miou": metrics.get_miou(),
             **{
                 "train_accuracy_" + k: v
                 for k, v in metrics.get_classwise_accuracy().items()
             },
         }
-    wandb.log(train_stats, step=step)
+
+    elif target_name == "multi-task":
+        means = loss_stats.means()
+        train_stats = metrics.get_stats(
+            "train", {target: means[target].item() for target in config.targets}
+        )
+    stats_writer.submit(lambda s, step=step: logger.log(s, step=step), train_stats)
+    if config.profile:
+        stats_writer.submit(lambda s, step=step: logger.log(s, step=step), profiler.log_dict())
+        profiler.save_json(os.path.join(logger.dir, "step_profile.json"))
+        profiler.reset()
 
     if epoch % 2 == 0:
         val_stats = validate_all(
-            model, val_loader, criterion, device, config, model_name, target_name
+            model,
+            val_loader,
+            criterion,
+            device,
+            config,
+            model_name,
+            target_name,
+            stats_writer=stats_writer,
+            tasks=tasks,
         )
         print(f"Epoch:{epoch}", val_stats)
-        wandb.log(val_stats, step=step)
+        stats_writer.submit(lambda s, step=step: logger.log(s, step=step), val_stats)
 
     #if epoch % 200 == 0: ADAPTED TO SHORTEN PROCESS FOR TESTING PURPOSES
-    if epoch % 2 == 0:
-        if epoch == 0:
-            continue
-
-        save_weights_path = (
-            "checkpoints/" + "-".join([model_name, target_name, str(run.name), "epoch", str(epoch)]) + ".pth"
+    if epoch % 2 == 0 and epoch != 0:
+        # <checkpoint_dir>/<model_name>-<target_name>-<run name>-epoch-<epoch>.pth
+        checkpoints.save(model, epoch, metric=val_stats.get(config.best_metric))
+
+    if config.resume is not None:
+        # a restarted run continues with the next epoch
+        save_resume_state(
+            checkpoints,
+            config.resume,
+            model,
+            optimizer,
+            val_stats,
+            epoch + 1,
+            0,
+            step,
+            None,
+            None,
+            logger_id=logger.id,
         )
 
-        torch.save(model.state_dict(), save_weights_path) # code from Jupyter Notebook version
-
-        '''save_checkpoint_single_model( # commented out as don't know how to use sub-keys
-            model, optimizer, val_stats, epoch, save_weights_path
-        )'''
+stats_writer.close()
+profiler.close()
+checkpoints.close()
+logger.finish()
@@ -1,5 +1,13 @@
+import os
+import json
+import time
+import queue
+import threading
+from contextlib import contextmanager, nullcontext
+
 from tqdm import tqdm
 import torch
+import torch.utils.checkpoint
 import numpy as np
 import torch.nn.functional as F
 import albumentations as A
@@ -41,13 +49,46 @@ class RandomGrayscale(A.ToGray):
         return img
 
 
-def get_batch_corrrelations(scan_embeds_1, scan_embeds_2, device):
+CORRELATION_BACKENDS = ["conv", "fft", "matmul", "auto"]
+
+
+def get_correlation_backend(scan_embeds_1, scan_embeds_2, backend="conv"):
+    """resolve "auto": equally sized embedding maps only have a single correlation
+    offset, which is a plain dot product (matmul), everything else uses conv2d"""
+    if backend not in CORRELATION_BACKENDS:
+        raise ValueError(f"Unsupported correlation backend {backend}, must be in {CORRELATION_BACKENDS}")
+    same_size = scan_embeds_1.shape[-2:] == scan_embeds_2.shape[-2:]
+    if backend == "auto":
+        return "matmul" if same_size else "conv"
+    if backend == "matmul" and not same_size:
+        raise ValueError("The matmul backend requires embedding maps of equal size")
+    return backend
+
+
+def fft_correlations(scan_embeds_1, scan_embeds_2):
+    """same result as F.conv2d(scan_embeds_1, scan_embeds_2) (valid cross-correlation of every
+    pair), computed in the frequency domain. The circular correlation of the zero-padded kernel
+    does not wrap around for the valid offsets, so no padding of the input is needed"""
+    _, _, H, W = scan_embeds_1.shape
+    _, _, h, w = scan_embeds_2.shape
+
+    f1 = torch.fft.rfft2(scan_embeds_1.float())
+    f2 = torch.fft.rfft2(F.pad(scan_embeds_2.float(), (0, W - w, 0, H - h)))
+    spectrum = torch.einsum("ichw,jchw->ijhw", f1, f2.conj())
+    correlations = torch.fft.irfft2(spectrum, s=(H, W))
+    return correlations[..., : H - h + 1, : W - w + 1]
+
+
+def get_batch_corrrelations(scan_embeds_1, scan_embeds_2, device, backend="conv"):
     """gets correlations between scan embeddings"""
     batch_size, channels, h, w = scan_embeds_2.shape
 
     scan_embeds_1 = F.normalize(scan_embeds_1, dim=1).to(device)
     scan_embeds_2 = F.normalize(scan_embeds_2, dim=1).to(device)
-    correlation_maps = F.conv2d(scan_embeds_1, scan_embeds_2) / (h * w)
+    if get_correlation_backend(scan_embeds_1, scan_embeds_2, backend) == "fft":
+        correlation_maps = fft_correlations(scan_embeds_1, scan_embeds_2) / (h * w)
+    else:
+        correlation_maps = F.conv2d(scan_embeds_1, scan_embeds_2) / (h * w)
     return correlation_maps
 
 
@@ -66,6 +107,78 @@ class NCELoss(torch.nn.Module):
         return loss
 
 
+class InfoNCELoss(torch.nn.Module):
+    """InfoNCE over n_views stacked views (view-major, like SwinTrainer.info_nce_loss), without
+    the label matrix, identity mask and boolean gathers of the similarity matrix.
+
+    For every row the target is the first other view of the same sample, all remaining columns
+    but the row itself are in the denominator, so the loss is
+    logsumexp_{j != i}(s_ij / T) - s_{i,pos(i)} / T.
+    With chunk_size, the rows are processed in chunks that are recomputed in the backward pass
+    (activation checkpointing), so only a chunk_size x N block of logits is alive at a time."""
+
+    def __init__(self, temperature, n_views=2, chunk_size=None, topk=(1, 5)):
+        super().__init__()
+        self.temperature = temperature
+        self.n_views = n_views
+        self.chunk_size = chunk_size
+        self.topk = topk
+        self._index_cache = {}
+
+    def _indices(self, batch_size, device):
+        """row indices and positive column of every row, cached per (batch size, views, device)"""
+        key = (batch_size, self.n_views, device)
+        if key not in self._index_cache:
+            rows = torch.arange(batch_size * self.n_views, device=device)
+            # the first view's positive is in the second view, all others point to the first view
+            positives = rows % batch_size + batch_size * (rows < batch_size)
+            self._index_cache[key] = (rows, positives)
+        return self._index_cache[key]
+
+    def _chunk_loss(self, queries, features, rows, positives):
+        logits = queries @ features.T / self.temperature
+        # exclude the similarity of every row with itself
+        logits = logits.index_put(
+            (torch.arange(rows.shape[0], device=rows.device), rows),
+            torch.tensor(-float("inf"), dtype=logits.dtype, device=logits.device),
+        )
+        positive_logits = logits.gather(1, positives.unsqueeze(1))
+        losses = torch.logsumexp(logits, dim=1) - positive_logits.squeeze(1)
+        # rank of the positive among all other columns, for the top-k accuracies
+        ranks = (logits.detach() > positive_logits.detach()).sum(dim=1)
+        return losses.sum(), ranks
+
+    def forward(self, features):
+        """returns the mean loss and the top-k accuracies (in percent, as accuracy())"""
+        features = F.normalize(features.float(), dim=1)
+        rows, positives = self._indices(features.shape[0] // self.n_views, features.device)
+
+        chunk_size = self.chunk_size or features.shape[0]
+        loss = 0
+        ranks = []
+        for start in range(0, features.shape[0], chunk_size):
+            chunk = slice(start, start + chunk_size)
+            if chunk_size < features.shape[0] and torch.is_grad_enabled():
+                chunk_loss, chunk_ranks = torch.utils.checkpoint.checkpoint(
+                    self._chunk_loss,
+                    features[chunk],
+                    features,
+                    rows[chunk],
+                    positives[chunk],
+                    use_reentrant=False,
+                )
+            else:
+                chunk_loss, chunk_ranks = self._chunk_loss(
+                    features[chunk], features, rows[chunk], positives[chunk]
+                )
+            loss = loss + chunk_loss
+            ranks.append(chunk_ranks)
+
+        ranks = torch.cat(ranks)
+        accuracies = [(ranks < k).float().mean() * 100.0 for k in self.topk]
+        return loss / features.shape[0], accuracies
+
+
 def normalise_channels(scan_img, eps=1e-5):
     # normalize each channel
     scan_min = scan_img.flatten(start_dim=-2).min(dim=-1)[0][:, None, None]
@@ -114,58 +227,183 @@ def save_checkpoint(
     return
 
 
-def get_rank_statistics(similarities_matrix):
-    sorted_similarities_values, sorted_similarities_idxs = similarities_matrix.sort(
-        dim=1, descending=True
-    )
-    ranks = []
-    for idx, row in enumerate(tqdm(sorted_similarities_idxs)):
-        rank = torch.where(row == idx)[0][0]
-        ranks.append(rank.cpu())
-    ranks = np.array(ranks)
-    mean_rank = np.mean(ranks)
-    median_rank = np.median(ranks)
-    top_10 = np.sum(ranks < 10) / len(ranks)
-    top_5 = np.sum(ranks < 5) / len(ranks)
-    top_1 = np.sum(ranks < 1) / len(ranks)
-
-    ranks_stats = {
-        "mean_rank": mean_rank,
-        "median_rank": median_rank,
-        "top_10": top_10,
-        "top_5": top_5,
-        "top_1": top_1,
+def _summarise_ranks(ranks):
+    ranks = np.asarray(ranks)
+    return {
+        "mean_rank": np.mean(ranks),
+        "median_rank": np.median(ranks),
+        "top_10": np.sum(ranks < 10) / len(ranks),
+        "top_5": np.sum(ranks < 5) / len(ranks),
+        "top_1": np.sum(ranks < 1) / len(ranks),
     }
 
-    return ranks_stats
 
+def get_rank_statistics(similarities_matrix, block_size=1024):
+    """rank of the matching pair (the diagonal) in every row, computed as the number
+    of larger scores in the row (no sort). Works on tensors and (memory-mapped) arrays"""
+    num_rows = similarities_matrix.shape[0]
+    ranks = []
+    for start in range(0, num_rows, block_size):
+        block = similarities_matrix[start : start + block_size]
+        if not torch.is_tensor(block):
+            block = torch.as_tensor(np.asarray(block))
+        rows = torch.arange(block.shape[0], device=block.device)
+        diag = block[rows, rows + start]
+        ranks.append((block > diag[:, None]).sum(dim=1).cpu())
+    ranks = torch.cat(ranks).numpy()
+
+    return _summarise_ranks(ranks)
+
+
+def _block_similarities(scan_embeds_1, scan_embeds_2, backend="conv"):
+    """max spatial correlation between all pairs of two blocks of normalised embeddings"""
+    _, _, h, w = scan_embeds_2.shape
+    if backend == "matmul":
+        return scan_embeds_1.flatten(start_dim=1) @ scan_embeds_2.flatten(start_dim=1).T / (h * w)
+    elif backend == "fft":
+        correlations = fft_correlations(scan_embeds_1, scan_embeds_2) / (h * w)
+    else:
+        correlations = F.conv2d(scan_embeds_1, scan_embeds_2) / (h * w)
+    return correlations.flatten(start_dim=2).max(dim=-1)[0]
+
+
+def _pairwise_similarities(scan_embeds_1, scan_embeds_2, backend="conv"):
+    """max spatial correlation of the matching pairs scan_embeds_1[i], scan_embeds_2[i]
+    (instead of computing the full block)"""
+    batch_size, channels, h, w = scan_embeds_2.shape
+    _, _, H, W = scan_embeds_1.shape
+    if backend == "matmul":
+        return (scan_embeds_1 * scan_embeds_2).flatten(start_dim=1).sum(dim=1) / (h * w)
+    elif backend == "fft":
+        f1 = torch.fft.rfft2(scan_embeds_1.float())
+        f2 = torch.fft.rfft2(F.pad(scan_embeds_2.float(), (0, W - w, 0, H - h)))
+        correlations = torch.fft.irfft2((f1 * f2.conj()).sum(dim=1), s=(H, W))
+        correlations = correlations[..., : H - h + 1, : W - w + 1] / (h * w)
+        return correlations.flatten(start_dim=1).max(dim=-1)[0]
+
+    # one grouped convolution, every s1 embedding is only correlated with its s2 match
+    correlations = F.conv2d(
+        scan_embeds_1.reshape(1, batch_size * channels, H, W),
+        scan_embeds_2,
+        groups=batch_size,
+    ) / (h * w)
+    return correlations.flatten(start_dim=2).max(dim=-1)[0].squeeze(0)
+
+
+def open_similarities_memmap(path, ds_size):
+    """(ds_size, ds_size) float32 .npy file for similarity matrices that do not fit into memory"""
+    return np.lib.format.open_memmap(
+        path, mode="w+", dtype=np.float32, shape=(ds_size, ds_size)
+    )
 
-def get_dataset_similarities(scan_embeds_1, scan_embeds_2, device, batch_size=50):
-    """Gets similarities for entire dataset.
-    Splits job into batches to reduce GPU memory"""
-    ds_size, channels, h, w = scan_embeds_2.shape
-    ds_similarities = torch.zeros(ds_size, ds_size)
-
-    for batch_1_start_idx in tqdm(range(0, ds_size, batch_size)):
-        for batch_2_start_idx in range(0, ds_size, batch_size):
-
-            batch_1_end_idx = batch_1_start_idx + batch_size
-            batch_2_end_idx = batch_2_start_idx + batch_size
-            if batch_2_end_idx >= ds_size:
-                batch_2_end_idx = ds_size
-            if batch_1_end_idx >= ds_size:
-                batch_1_end_idx = ds_size
-
-            correlations = get_batch_corrrelations(
-                scan_embeds_1[batch_1_start_idx:batch_1_end_idx],
-                scan_embeds_2[batch_2_start_idx:batch_2_end_idx],
-                device,
+
+def get_retrieval_statistics(
+    scan_embeds_1,
+    scan_embeds_2,
+    device,
+    batch_size=50,
+    column_batch_size=1024,
+    top_k=10,
+    out=None,
+    backend="conv",
+):
+    """Retrieval of scan_embeds_2[i] for every query scan_embeds_1[i] without materialising
+    the dataset similarity matrix: the similarities are computed on device in
+    (batch_size x column_batch_size) blocks, the rank of the matching pair is counted
+    and the top-k candidates are kept as a running top-k.
+    out: optional (N, N) tensor/array (e.g. open_similarities_memmap) that receives all similarities
+    backend: how the spatial correlations are computed, see CORRELATION_BACKENDS and
+    benchmark_correlation.py
+    returns rank statistics, top-k similarities and top-k indices (N x top_k)"""
+    ds_size = scan_embeds_1.shape[0]
+    top_k = min(top_k, ds_size)
+    backend = get_correlation_backend(scan_embeds_1, scan_embeds_2, backend)
+
+    ranks = torch.zeros(ds_size, dtype=torch.long)
+    top_k_values = torch.zeros(ds_size, top_k)
+    top_k_indices = torch.zeros(ds_size, top_k, dtype=torch.long)
+
+    # the embeddings may stay on the cpu, blocks are moved to device and normalised there
+    def to_device(block):
+        return F.normalize(block.to(device), dim=1)
+
+    with torch.no_grad():
+        for row_start in tqdm(range(0, ds_size, batch_size)):
+            row_end = min(row_start + batch_size, ds_size)
+            queries = to_device(scan_embeds_1[row_start:row_end])
+            matches = _pairwise_similarities(
+                queries, to_device(scan_embeds_2[row_start:row_end]), backend
             )
-            similarities, _ = torch.max(correlations.flatten(start_dim=2), dim=-1)
-            ds_similarities[
-                batch_1_start_idx:batch_1_end_idx, batch_2_start_idx:batch_2_end_idx
-            ] = similarities
-    return ds_similarities
+
+            row_ranks = torch.zeros(row_end - row_start, dtype=torch.long, device=device)
+            row_values = None
+            for column_start in range(0, ds_size, column_batch_size):
+                column_end = min(column_start + column_batch_size, ds_size)
+                similarities = _block_similarities(
+                    queries, to_device(scan_embeds_2[column_start:column_end]), backend
+                )
+                greater = similarities > matches[:, None]
+                # the matching pair itself is never counted, whatever the rounding
+                overlap_start = max(row_start, column_start)
+                overlap_end = min(row_end, column_end)
+                if overlap_start < overlap_end:
+                    idx = torch.arange(overlap_start, overlap_end, device=device)
+                    greater[idx - row_start, idx - column_start] = False
+                row_ranks += greater.sum(dim=1)
+
+                # running top-k over the column blocks
+                column_indices = torch.arange(
+                    column_start, column_end, device=device
+                ).expand_as(similarities)
+                if row_values is not None:
+                    similarities_k = torch.cat([row_values, similarities], dim=1)
+                    column_indices = torch.cat([row_indices, column_indices], dim=1)
+                else:
+                    similarities_k = similarities
+                k = min(top_k, similarities_k.shape[1])
+                row_values, idx = similarities_k.topk(k, dim=1)
+                row_indices = column_indices.gather(1, idx)
+
+                if out is not None:
+                    out[row_start:row_end, column_start:column_end] = (
+                        similarities.cpu().numpy()
+                        if isinstance(out, np.ndarray)
+                        else similarities.cpu()
+                    )
+
+            ranks[row_start:row_end] = row_ranks.cpu()
+            top_k_values[row_start:row_end] = row_values.cpu()
+            top_k_indices[row_start:row_end] = row_indices.cpu()
+
+    return _summarise_ranks(ranks.numpy()), top_k_values, top_k_indices
+
+
+def get_dataset_similarities(
+    scan_embeds_1,
+    scan_embeds_2,
+    device,
+    batch_size=50,
+    column_batch_size=1024,
+    out=None,
+    backend="conv",
+):
+    """Gets similarities for entire dataset.
+    Splits job into blocks to reduce GPU memory, out can be a memory-mapped array
+    (open_similarities_memmap) for datasets where the dense matrix does not fit into memory"""
+    ds_size = scan_embeds_2.shape[0]
+    if out is None:
+        out = torch.zeros(ds_size, ds_size)
+
+    get_retrieval_statistics(
+        scan_embeds_1,
+        scan_embeds_2,
+        device,
+        batch_size=batch_size,
+        column_batch_size=column_batch_size,
+        out=out,
+        backend=backend,
+    )
+    return out
 
 
 class AverageMeter(object):
@@ -193,6 +431,249 @@ class AverageMeter(object):
         return fmtstr.format(**self.__dict__)
 
 
+class RunningStats(object):
+    """Running means of scalar tensors that stay on the device they were computed on.
+    Reading them back to the host is the only sync point, so the training loops
+    only do that every `log_interval` steps (through AsyncStatsWriter)"""
+
+    def __init__(self, names, log_interval=100):
+        self.log_interval = log_interval
+        self.steps = 0
+        self.window_steps = 0
+        self.sums = {k: torch.zeros((), dtype=torch.float64) for k in names}
+        self.window_sums = {k: torch.zeros((), dtype=torch.float64) for k in names}
+
+    def update(self, **values):
+        for k, v in values.items():
+            v = torch.as_tensor(v).detach()
+            if self.sums[k].device != v.device:
+                self.sums[k] = self.sums[k].to(v.device)
+                self.window_sums[k] = self.window_sums[k].to(v.device)
+            self.sums[k] += v
+            self.window_sums[k] += v
+        self.steps += 1
+        self.window_steps += 1
+
+    def ready(self):
+        """True every log_interval steps"""
+        return self.steps > 0 and self.steps % self.log_interval == 0
+
+    def window_means(self):
+        """means since the last call (still on device), resets the window"""
+        means = {k: v / self.window_steps for k, v in self.window_sums.items()}
+        for v in self.window_sums.values():
+            v.zero_()
+        self.window_steps = 0
+        return means
+
+    def means(self):
+        """means over all updates (still on device), nan if there were none"""
+        return {k: v / self.steps for k, v in self.sums.items()}
+
+    def state_dict(self):
+        return {
+            "steps": self.steps,
+            "window_steps": self.window_steps,
+            "sums": {k: v.cpu() for k, v in self.sums.items()},
+            "window_sums": {k: v.cpu() for k, v in self.window_sums.items()},
+        }
+
+    def load_state_dict(self, state):
+        self.steps = state["steps"]
+        self.window_steps = state["window_steps"]
+        self.sums = dict(state["sums"])
+        self.window_sums = dict(state["window_sums"])
+
+
+class AsyncStatsWriter(object):
+    """Copies statistics to the host without blocking and hands them to a background
+    thread, which waits for the copy and calls the sink (tqdm, wandb, TensorBoard, ...)
+    with plain floats. Sinks are called in submission order."""
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, sink, stats):
+        host_stats = {}
+        event = None
+        for k, v in stats.items():
+            if torch.is_tensor(v):
+                if v.is_cuda and event is None:
+                    event = torch.cuda.Event()
+                v = v.detach().to("cpu", non_blocking=True)
+            host_stats[k] = v
+        if event is not None:
+            event.record()
+        self.queue.put((sink, host_stats, event))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            sink, stats, event = item
+            try:
+                if event is not None:
+                    event.synchronize()
+                sink({k: v.item() if torch.is_tensor(v) else v for k, v in stats.items()})
+            except Exception as e:
+                print(f"AsyncStatsWriter: sink failed with {e!r}")
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """wait until all submitted statistics are written"""
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+
+class StepProfiler(object):
+    """Named timing regions (data, h2d, forward, loss, backward, optimizer, metrics, ...)
+    for the steps of a training or inference loop.
+
+    Only every sample_every-th step is timed, on the other steps a region costs one
+    comparison. On a timed step a CUDA device is synchronised at the region boundaries, so a
+    region includes its kernels. With trace_dir, a torch.profiler trace of trace_steps steps
+    starting at step trace_start is written for the TensorBoard profiler plugin.
+    Disabled profilers do nothing, so the regions can stay in the loops.
+
+    Usage:
+        for sample in profiler.iterate(loader):  # times the data wait
+            with profiler.region("forward"):
+                ...
+            profiler.step()
+
+    Loops whose stages cannot be wrapped in `with` blocks use start(name) ... stop().
+    """
+
+    def __init__(
+        self,
+        enabled=False,
+        sample_every=10,
+        device=None,
+        trace_dir=None,
+        trace_start=10,
+        trace_steps=5,
+    ):
+        self.enabled = enabled
+        self.sample_every = max(int(sample_every), 1)
+        self.device = torch.device(device) if device is not None else None
+        self.sync = self.device is not None and self.device.type == "cuda"
+        self.steps = 0
+        self.seconds = {}
+        self.step_start = None
+        self.open_region = None
+
+        self.trace = None
+        if enabled and trace_dir is not None:
+            self.trace = torch.profiler.profile(
+                schedule=torch.profiler.schedule(
+                    wait=max(trace_start - 1, 0), warmup=1, active=trace_steps, repeat=1
+                ),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+            )
+            self.trace.start()
+
+    def sampled(self):
+        return self.enabled and self.steps % self.sample_every == 0
+
+    @contextmanager
+    def _timed(self, name):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        start = time.perf_counter()
+        with torch.profiler.record_function(name) if self.trace is not None else nullcontext():
+            yield
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        self.seconds.setdefault(name, []).append(time.perf_counter() - start)
+
+    def region(self, name):
+        if self.sampled():
+            return self._timed(name)
+        if self.trace is not None:
+            return torch.profiler.record_function(name)
+        return nullcontext()
+
+    def start(self, name):
+        """starts region `name`, ends the region started before"""
+        self.stop()
+        self.open_region = self.region(name)
+        self.open_region.__enter__()
+
+    def stop(self):
+        """ends the region started last, if any"""
+        if self.open_region is not None:
+            region, self.open_region = self.open_region, None
+            region.__exit__(None, None, None)
+
+    def iterate(self, iterable, name="data"):
+        """yields from iterable, the wait for every item is timed as region `name`"""
+        iterator = iter(iterable)
+        while True:
+            with self.region(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def step(self):
+        """marks the end of a step, the time since the previous call is the region "step" """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.sampled() and self.step_start is not None:
+            self.seconds.setdefault("step", []).append(now - self.step_start)
+        self.step_start = now
+        self.steps += 1
+        if self.trace is not None:
+            self.trace.step()
+
+    def summary(self):
+        """mean/p50/p99 milliseconds of every region and its share of the mean step time"""
+        step_mean = np.mean(self.seconds["step"]) if self.seconds.get("step") else None
+        summary = {}
+        for name, seconds in self.seconds.items():
+            seconds = np.array(seconds)
+            summary[name] = {
+                "count": len(seconds),
+                "mean_ms": 1000 * seconds.mean(),
+                "p50_ms": 1000 * np.percentile(seconds, 50),
+                "p99_ms": 1000 * np.percentile(seconds, 99),
+                "fraction": seconds.mean() / step_mean if step_mean else None,
+            }
+        return summary
+
+    def log_dict(self, prefix="profile/"):
+        """flat {prefix + region + "_ms": mean} for wandb / TensorBoard"""
+        return {prefix + name + "_ms": s["mean_ms"] for name, s in self.summary().items()}
+
+    def reset(self):
+        self.seconds = {}
+
+    def save_json(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(
+                {"sample_every": self.sample_every, "steps": self.steps, "regions": self.summary()},
+                f,
+                indent=2,
+            )
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
+
+
 def multi_acc(pred, label):
     """compute pixel-wise accuracy across a batch"""
     _, tags = torch.max(pred, dim=1)
@@ -1,26 +1,48 @@
 import os
 
-# set environment variables to limit cpu usage
-os.environ["OMP_NUM_THREADS"] = "4"  # export OMP_NUM_THREADS=4
-os.environ["OPENBLAS_NUM_THREADS"] = "4"  # export OPENBLAS_NUM_THREADS=4
-os.environ["MKL_NUM_THREADS"] = "6"  # export MKL_NUM_THREADS=6
-os.environ["VECLIB_MAXIMUM_THREADS"] = "4"  # export VECLIB_MAXIMUM_THREADS=4
-os.environ["NUMEXPR_NUM_THREADS"] = "6"  # export NUMEXPR_NUM_THREADS=6
+# limit cpu usage, unless the thread counts are set in the environment
+os.environ.setdefault("OMP_NUM_THREADS", "4")  # export OMP_NUM_THREADS=4
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "4")  # export OPENBLAS_NUM_THREADS=4
+os.environ.setdefault("MKL_NUM_THREADS", "6")  # export MKL_NUM_THREADS=6
+os.environ.setdefault("VECLIB_MAXIMUM_THREADS", "4")  # export VECLIB_MAXIMUM_THREADS=4
+os.environ.setdefault("NUMEXPR_NUM_THREADS", "6")  # export NUMEXPR_NUM_THREADS=6
 
 from tqdm import tqdm
 import torch
 import torch.nn.functional as F
 
-from utils import get_dataset_similarities, get_rank_statistics
+from utils import (
+    get_retrieval_statistics,
+    open_similarities_memmap,
+    RunningStats,
+    AsyncStatsWriter,
+)
 from metrics import ClasswiseAccuracy, ClasswiseMultilabelMetrics, PixelwiseMetrics
-
-
-def validate_all(model, val_loader, criterion, device, config, model_name, target_name):
+from multi_task import MultiTaskMetrics, multi_task_loss
+
+
+def validate_all(
+    model,
+    val_loader,
+    criterion,
+    device,
+    config,
+    model_name,
+    target_name,
+    stats_writer=None,
+    tasks=None,
+):
+    """tasks: the multi_task.Task of every target for target_name "multi-task", whose
+    criteria replace criterion"""
     model.eval()
     pbar = tqdm(val_loader)
 
     # track performance
-    epoch_losses = torch.Tensor()
+    loss_names = ["loss"] + ([task.target for task in tasks] if tasks else [])
+    loss_stats = RunningStats(loss_names, log_interval=config.get("log_interval", 100))
+    close_stats_writer = stats_writer is None
+    if close_stats_writer:
+        stats_writer = AsyncStatsWriter()
     if target_name == "single-classification":
         metrics = ClasswiseAccuracy(config.num_classes)
     elif target_name == "multi-classification":
@@ -28,18 +50,25 @@ def validate_all(model, val_loader, criterion, device, config, model_name, targe
         metrics = ClasswiseMultilabelMetrics(config.num_classes)
     elif target_name == "pixel-classification":
         metrics = PixelwiseMetrics(config.num_classes)
+    elif target_name == "multi-task":
+        metrics = MultiTaskMetrics(tasks)
 
     with torch.no_grad():
         for idx, sample in enumerate(pbar):
 
-            if "x" in sample.keys():
-                if torch.isnan(sample["x"]).any():
-                    # some s1 scenes are known to have NaNs...
-                    continue
-            else:
-                if torch.isnan(sample["s1"]).any() or torch.isnan(sample["s2"]).any():
-                    # some s1 scenes are known to have NaNs...
-                    continue
+            # can be disabled if invalid observations are excluded up front (dataset_scan.py)
+            if config.get("skip_nan_batches", True):
+                if "x" in sample.keys():
+                    if torch.isnan(sample["x"]).any():
+                        # some s1 scenes are known to have NaNs...
+                        continue
+                else:
+                    if (
+                        torch.isnan(sample["s1"]).any()
+                        or torch.isnan(sample["s2"]).any()
+                    ):
+                        # some s1 scenes are known to have NaNs...
+                        continue
 
             if model_name == "baseline" or model_name == "swin-baseline":
                 s1 = sample["s1"]
@@ -78,14 +107,19 @@ def validate_all(model, val_loader, criterion, device, config, model_name, targe
             elif target_name == "multi-classification":
                 y = sample[config.target].to(device)
             elif target_name == "pixel-classification":
-                y = sample[config.target].squeeze().type(torch.LongTensor).to(device)
+                y = sample[config.target].squeeze().long().to(device)
+            elif target_name == "multi-task":
+                y = {task.target: task.get_labels(sample, device) for task in tasks}
 
             y_hat = model(img)
 
             if target_name == "multi-classification":
                 y_hat = sigmoid(y_hat)
 
-            loss = criterion(y_hat, y)
+            if target_name == "multi-task":
+                loss, losses, pred = multi_task_loss(tasks, y_hat, y)
+            else:
+                loss = criterion(y_hat, y)
 
             if target_name == "multi-classification":
                 pred = y_hat.round()
@@ -95,12 +129,21 @@ def validate_all(model, val_loader, criterion, device, config, model_name, targe
                 probas = F.softmax(y_hat, dim=1)
                 pred = torch.argmax(probas, axis=1)
 
-            epoch_losses = torch.cat([epoch_losses, loss[None].detach().cpu()])
+            if target_name == "multi-task":
+                loss_stats.update(loss=loss, **losses)
+            else:
+                loss_stats.update(loss=loss)
             metrics.add_batch(y, pred)
 
-            pbar.set_description(f"Loss:{epoch_losses[-100:].mean():.4}")
+            if loss_stats.ready():
+                stats_writer.submit(
+                    lambda s: pbar.set_description(f"Loss:{s['loss']:.4}"),
+                    loss_stats.window_means(),
+                )
 
-        mean_loss = epoch_losses.mean()
+        mean_loss = loss_stats.means()["loss"]
+        if close_stats_writer:
+            stats_writer.close()
 
         if target_name == "single-classification":
             val_stats = {
@@ -132,12 +175,20 @@ def validate_all(model, val_loader, criterion, device, config, model_name, targe
             val_stats = {
                 "validation_loss": mean_loss.item(),
                 "validation_average_accuracy": metrics.get_average_accuracy(),
+                "validation_overall_accuracy": metrics.get_overall_accuracy(),
+                "validation_miou": metrics.get_miou(),
                 **{
                     "validation_accuracy_" + k: v
                     for k, v in metrics.get_classwise_accuracy().items()
                 },
             }
 
+        elif target_name == "multi-task":
+            means = loss_stats.means()
+            val_stats = metrics.get_stats(
+                "validation", {task.target: means[task.target].item() for task in tasks}
+            )
+
         return val_stats
 
 
@@ -166,14 +217,27 @@ def validate_alignment_backbone(
     all_s2_ses = torch.cat(all_s2_ses)
 
     # now correlate encodings
+    # the embeddings stay on the cpu, get_retrieval_statistics moves one block at a time
     s1_b, s1_c, s1_h, s1_w = all_s1_ses.size()
-    all_s1_ses = all_s1_ses.to(device)
-    all_s2_ses = all_s2_ses.to(device)
 
     print("Calculating encoding similarities + statistics")
-    similarities = get_dataset_similarities(all_s1_ses, all_s2_ses, device)
+    # the dense similarity matrix is only kept if requested, optionally memory-mapped
+    if not return_similarities:
+        similarities = None
+    elif config.get("similarities_path") is not None:
+        similarities = open_similarities_memmap(config.similarities_path, num_scans)
+    else:
+        similarities = torch.zeros(num_scans, num_scans)
+
+    rank_stats, _, _ = get_retrieval_statistics(
+        all_s1_ses,
+        all_s2_ses,
+        device,
+        batch_size=config.get("retrieval_batch_size", 50),
+        out=similarities,
+        backend=config.get("correlation_backend", "conv"),
+    )
     # corrs = (F.conv2d(all_dxa_ses, all_mri_ses)/(mri_h*mri_w)).view(num_scans,num_scans,-1)
-    rank_stats = get_rank_statistics(similarities)
     rank_stats = {"validation_" + k: v for k, v in rank_stats.items()}
 
     if not return_similarities:
@@ -27,6 +27,7 @@ from dfc_dataset_sandbox import DFCDataset # use sandbox version
 
 from Transformer_SSL.models.swin_transformer import * # refine to classes required
 from utils import save_checkpoint_single_model, dotdictify
+from checkpointing import load_model_weights
 from Transformer_SSL.models import build_model
 
 if torch.cuda.is_available():
@@ -81,7 +82,7 @@ model = DoubleSwinTransformerSegmentation(s1_backbone, s2_backbone, out_dim=data
 currentPatch = 45 #iterator
 
 # load desired segmentation checkpoint
-model.load_state_dict(torch.load("checkpoints/swin-t-pixel-classification-balmy-universe-47-epoch-200.pth", map_location='cpu')) # replace path with desired checkpoint
+model.load_state_dict(load_model_weights("checkpoints/swin-t-pixel-classification-balmy-universe-47-epoch-200.pth", map_location='cpu')) # replace path with desired checkpoint
 model.to(device)
 
 # prepare input
@@ -6,16 +6,13 @@ import csv
 import numpy as np
 import torch
 import torch.nn.functional as F
-import torch.nn as nn
-from distutils.util import strtobool
-from tqdm import tqdm
-from torchvision.models import resnet18, resnet50
 import rasterio
 
 from dfc_dataset_sandbox import DFCDataset # use sandbox version
 
-from Transformer_SSL.models.swin_transformer import * # refine to classes required
-from utils import dotdictify
+from Transformer_SSL.models.swin_transformer import DoubleSwinTransformerSegmentationS2
+from utils import dotdictify, StepProfiler
+from checkpointing import load_model_weights
 from Transformer_SSL.models import build_model
 from PyQt5.QtCore import QThread, pyqtSignal
 import time
@@ -28,7 +25,7 @@ class SegmentationThread(QThread):
     resetProgressSignal = pyqtSignal()
     updatePieChartSignal = pyqtSignal(object)
 
-    def __init__(self, model_file_path, patch_names):
+    def __init__(self, model_file_path, patch_names, profile=False):
         super(SegmentationThread, self).__init__()
         print("Patch Names:", patch_names)
         print("Model File Path:", model_file_path)
@@ -36,6 +33,8 @@ class SegmentationThread(QThread):
         self.patch_names = patch_names
         self.is_stopped = False
         self.is_paused = False
+        # per-stage timing of every patch (read, normalise, h2d, forward, output)
+        self.profiler = StepProfiler(enabled=profile, sample_every=1)
         
     def run(self):
         try:
@@ -89,7 +88,7 @@ class SegmentationThread(QThread):
                 # model.load_state_dict(torch.load("swin-t-pixel-classification-final-epoch-200.pth", map_location='cpu')) # replace path with desired checkpoint
                 
                 # print(type(self.model_file_path), self.model_file_path)
-                model.load_state_dict(torch.load(self.model_file_path, map_location='cpu'))
+                model.load_state_dict(load_model_weights(self.model_file_path, map_location='cpu'))
                 model.to(device)
 
                     # array of patch names (feed in from input.csv file or pick in GUI)
@@ -108,10 +107,12 @@ class SegmentationThread(QThread):
                         patch_file = os.path.join(input_folder, patch_name)
 
                         # adapted from dfc_sen12ms_dataset
+                        self.profiler.start("read")
                         with rasterio.open(patch_file) as patch:
                             patch_data = patch.read()
                             bounds = patch.bounds
 
+                        self.profiler.start("normalise")
                         mpc_tensor = torch.from_numpy(patch_data.astype('float32')) # create input tensor of float32 values
 
                         # Code for normalisation of patch - credit dfc_dataset.py
@@ -190,9 +191,11 @@ class SegmentationThread(QThread):
                                     mpc_tensor = F.pad(mpc_tensor, (0, y_l, 0, x_l, 0, 0, 0, 0), "constant", 0) # append difference to x, append difference to y
                             # print(mpc_tensor)
                             # print(mpc_tensor.shape)
-                        patch_img = {"s2": mpc_tensor} # create dictionary using same format as DFC
+                        self.profiler.start("h2d")
+                        patch_img = {"s2": mpc_tensor.to(device)} # create dictionary using same format as DFC
 
                         # evaluate using model
+                        self.profiler.start("forward")
                         model.eval() # sets the model in evaluation mode
                         output = model(patch_img) # pass input to model, 'output' is instance of DoubleSwinTransformerSegmentation
                         #output = model(img)
@@ -207,6 +210,7 @@ class SegmentationThread(QThread):
                         
 
                         
+                        self.profiler.start("output")
                         # CSV OUTPUT
 
                         # Get the spatial information from the GeoTIFF file
@@ -280,10 +284,16 @@ class SegmentationThread(QThread):
 
 
                         print(f"All arrays saved to '{combined_npy_filename}'.")        
+                        self.profiler.stop()
+                        self.profiler.step()
 
                 # VISUALISATION CODE
                 # val_dataset.test_visual_mpc(mpc_tensor, output_arrays)
    
+                if self.profiler.enabled:
+                    print(self.profiler.summary())
+                    self.profiler.save_json(os.path.join("output", "segmentation_profile.json"))
+
                 self.finishedSignal.emit("Segmentation Finished!")
 
         except Exception as e: